@@ -1,3 +1,83 @@
+import os
+
+from django.conf import settings
 from django.contrib import admin
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from .models import RequestProfile, SlowQuery
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    # Profiles are only created by core.profiling; staff view, download and delete them here
+    list_display = ('created_at', 'method', 'path', 'view_name', 'status_code', 'profiler', 'duration_ms', 'user', 'download')
+    list_select_related = ('user',)
+    list_filter = ('profiler', 'view_name')
+    search_fields = ('path', 'view_name')
+    readonly_fields = [field.name for field in RequestProfile._meta.fields] + ['download']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:profile_id>/download/', self.admin_site.admin_view(self.download_view), name='core_requestprofile_download'),
+        ] + super().get_urls()
+
+    @admin.display(description='Profile')
+    def download(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse('admin:core_requestprofile_download', args=[obj.id]), obj.file_name)
+
+    def download_view(self, request, profile_id):
+        if not self.has_view_permission(request):
+            raise Http404
+        profile = get_object_or_404(RequestProfile, id=profile_id)
+        try:
+            return FileResponse(open(os.path.join(settings.PROFILE_DIR, profile.file_name), 'rb'), as_attachment=True)
+        except FileNotFoundError:
+            raise Http404('The profile file is gone.')
+
+
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    # The slow query log is written by core.slow_queries; staff read and clear it here
+    list_display = ('short_shape', 'count', 'total_ms', 'p50', 'p95', 'p99', 'max_ms', 'view_name', 'call_site', 'last_seen')
+    list_filter = ('database', 'view_name')
+    search_fields = ('shape', 'call_site')
+    fields = (
+        'shape', 'database', 'count', 'total_ms', 'p50', 'p95', 'p99', 'max_ms', 'view_name', 'call_site',
+        'example_sql', 'example_params', 'formatted_plan', 'first_seen', 'last_seen',
+    )
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description='Statement')
+    def short_shape(self, obj):
+        return obj.shape if len(obj.shape) <= 120 else f'{obj.shape[:117]}...'
+
+    @admin.display(description='p50 ms')
+    def p50(self, obj):
+        return obj.percentile(50)
+
+    @admin.display(description='p95 ms')
+    def p95(self, obj):
+        return obj.percentile(95)
+
+    @admin.display(description='p99 ms')
+    def p99(self, obj):
+        return obj.percentile(99)
 
-# Register your models here.
+    @admin.display(description='Plan')
+    def formatted_plan(self, obj):
+        return format_html('<pre>{}</pre>', obj.plan or 'Not captured.')
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Connects the signals keeping the user and consumer lookup caches, catalog cache and search index current,
+        # the ones timing each connection's queries for the request metrics and the slow query log, and the one
+        # deleting profile files
+        from . import auth, catalog, consumers, metrics, profiling, search, slow_queries  # noqa: F401
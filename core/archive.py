@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedTransaction, Transaction
+
+ARCHIVED_FIELDS = [
+    'id', 'transaction_type', 'user_id', 'amount', 'timestamp', 'status', 'reference_id', 'legacy_reference_id',
+]
+
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = settings.TRANSACTION_ARCHIVE_AFTER_DAYS
+    return timezone.now() - timedelta(days=days)
+
+
+def reaches_archive(date_from):
+    """Whether a history starting at date_from (None meaning 'from the beginning') may include archived rows."""
+    return date_from is None or date_from < archive_cutoff().date()
+
+
+def archivable(cutoff, shard='default'):
+    # Bill payments keep pointing at their Transaction, so those rows stay in the hot table
+    return Transaction.objects.on_shard(shard).filter(status='completed', timestamp__lt=cutoff, bill_payment__isnull=True)
+
+
+def oldest_archivable(cutoff, batch_size, shard='default'):
+    # The rows archive_batch moves next; check_query_plans explains this same query
+    return archivable(cutoff, shard).order_by('timestamp', 'id').values(*ARCHIVED_FIELDS)[:batch_size]
+
+
+def archive_batch(cutoff, batch_size, shard='default'):
+    """
+    Move up to batch_size of the oldest archivable transactions on a shard into
+    its archive table. Each batch is one DB transaction, so an interrupted run
+    loses nothing and the next run simply continues with the rows that are
+    left. Returns the number of rows moved.
+    """
+    with transaction.atomic(using=shard):
+        rows = list(oldest_archivable(cutoff, batch_size, shard))
+        if not rows:
+            return 0
+        ArchivedTransaction.objects.on_shard(shard).bulk_create(
+            [ArchivedTransaction(**row) for row in rows], ignore_conflicts=True
+        )
+        Transaction.objects.on_shard(shard).filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import AgentProfile, ConsumerProfile, MerchantProfile, User
+
+# The reverse one-to-one of each role's profile; a user has at most one of them, the one of its user_type
+PROFILES = {'agent': 'agent_profile', 'consumer': 'consumer_profile', 'merchant': 'merchant_profile'}
+
+# Balances change with every posting, through UPDATEs that send no signal to invalidate a cached user by;
+# they are left out of the join and read fresh when used
+_DEFERRED = ['consumer_profile__balance', 'merchant_profile__balance']
+
+
+def _cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def _joined_profiles():
+    # Consumer profiles are sharded: with more than one shard, a user's may not be on the primary to join
+    return [
+        relation for role, relation in PROFILES.items()
+        if role != 'consumer' or settings.DATABASE_SHARDS == ['default']
+    ]
+
+
+def _users():
+    joined = _joined_profiles()
+    return User.objects.select_related(*joined).defer(
+        *(field for field in _DEFERRED if field.split('__')[0] in joined)
+    )
+
+
+class ProfileBackend(ModelBackend):
+    """
+    ModelBackend whose get_user() loads the session's user together with its
+    role's profile, in one joined query, so request.user.<role>_profile costs
+    no query of its own. The user is also cached for AUTH_USER_CACHE_TTL
+    seconds in the default cache, sparing the query on the following
+    requests; saving or deleting the user or its profile drops the cached
+    copy, so a changed password or a deactivation takes effect at once.
+    """
+
+    def get_user(self, user_id):
+        key = _cache_key(user_id)
+        user = cache.get(key) if settings.AUTH_USER_CACHE_TTL else None
+        if user is None:
+            try:
+                user = _users().get(pk=user_id)
+            except User.DoesNotExist:
+                return None
+            if settings.AUTH_USER_CACHE_TTL:
+                cache.set(key, user, settings.AUTH_USER_CACHE_TTL)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        # The cache lookup needs no thread hop; a miss is served by the async ORM
+        key = _cache_key(user_id)
+        user = await cache.aget(key) if settings.AUTH_USER_CACHE_TTL else None
+        if user is None:
+            try:
+                user = await _users().aget(pk=user_id)
+            except User.DoesNotExist:
+                return None
+            if settings.AUTH_USER_CACHE_TTL:
+                await cache.aset(key, user, settings.AUTH_USER_CACHE_TTL)
+        return user if self.user_can_authenticate(user) else None
+
+
+def _check_token_user(token, user):
+    if user is None:
+        raise AuthenticationFailed('No active account found for the given token.', code='no_active_account')
+    # Tokens made before a password change are refused, as sessions are
+    if token.get(jwt_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+        raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+    return user
+
+
+def token_user(token):
+    """The active user a validated JWT was issued to; raises AuthenticationFailed otherwise."""
+    return _check_token_user(token, ProfileBackend().get_user(token.get(jwt_settings.USER_ID_CLAIM)))
+
+
+class ProfileJWTAuthentication(JWTAuthentication):
+    """
+    simplejwt's JWTAuthentication, loading the token's user through
+    ProfileBackend as sessions do: with its role's profile, and from the user
+    cache, so a warm API request runs no query to authenticate.
+    """
+
+    def get_user(self, validated_token):
+        return token_user(validated_token)
+
+    async def aauthenticate(self, request):
+        # For plain async views, which DRF does not authenticate; only the user lookup touches the database
+        header = self.get_header(request)
+        raw_token = self.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        user = await ProfileBackend().aget_user(validated_token.get(jwt_settings.USER_ID_CLAIM))
+        return _check_token_user(validated_token, user), validated_token
+
+
+def forget_user(user_id):
+    # Now, and again after commit, so a request running meanwhile cannot cache the row from before the change
+    cache.delete(_cache_key(user_id))
+    transaction.on_commit(lambda: cache.delete(_cache_key(user_id)))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    forget_user(instance.pk)
+
+
+@receiver(post_save, sender=AgentProfile)
+@receiver(post_save, sender=ConsumerProfile)
+@receiver(post_save, sender=MerchantProfile)
+@receiver(post_delete, sender=AgentProfile)
+@receiver(post_delete, sender=ConsumerProfile)
+@receiver(post_delete, sender=MerchantProfile)
+def invalidate_profile(sender, instance, **kwargs):
+    forget_user(instance.user_id)
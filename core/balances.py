@@ -0,0 +1,135 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db.models import Case, F, Q, Sum, When
+from django.db.models.functions import Coalesce
+
+from .models import ArchivedTransaction, BalanceSnapshot, ConsumerProfile, MerchantProfile, Transaction
+from .money import MoneyField, money
+from .routers import use_primary
+from .sharding import group_by_shard, is_sharded
+
+TOTAL_FIELDS = [choice for choice, _ in Transaction.TRANSACTION_TYPE_CHOICES]
+
+_money = MoneyField()
+
+# Users per snapshot UPDATE, keeping the CASE parameters under SQLite's 999 limit
+UPDATE_CHUNK_SIZE = 100
+
+# Profiles compared with their snapshots per round trip by drift()
+DRIFT_CHUNK_SIZE = 500
+
+
+def apply_entries(entries):
+    """
+    Add freshly posted Transaction rows to their owners' snapshots. All users
+    and transaction types touched by the posting are updated in one UPDATE
+    per shard (one per UPDATE_CHUNK_SIZE users for large batches).
+    """
+    deltas = defaultdict(lambda: defaultdict(Decimal))
+    for entry in entries:
+        if entry.transaction_type in TOTAL_FIELDS:
+            deltas[entry.transaction_type][entry.user_id] += Decimal(entry.amount)
+    if not deltas:
+        return
+
+    shards = group_by_shard(sorted({user_id for per_user in deltas.values() for user_id in per_user}))
+    for alias, user_ids in shards.items():
+        for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+            chunk = user_ids[start:start + UPDATE_CHUNK_SIZE]
+            updates = {}
+            for field, per_user in deltas.items():
+                whens = [When(user_id=user_id, then=money(per_user[user_id])) for user_id in chunk if user_id in per_user]
+                if whens:
+                    updates[field] = F(field) + Case(*whens, default=money(0), output_field=_money)
+            BalanceSnapshot.objects.on_shard(alias).filter(user_id__in=chunk).update(**updates)
+
+
+def totals_query():
+    return {
+        field: Coalesce(Sum('amount', filter=Q(transaction_type=field)), money(0), output_field=_money)
+        for field in TOTAL_FIELDS
+    }
+
+
+def totals_from_history(user_id):
+    # DB-side aggregate over the user's full history, hot and archived, used when no snapshot exists yet
+    totals = Transaction.objects.for_user(user_id).aggregate(**totals_query())
+    archived = ArchivedTransaction.objects.for_user(user_id).aggregate(**totals_query())
+    return {field: totals[field] + archived[field] for field in TOTAL_FIELDS}
+
+
+def get_snapshot(user_id):
+    try:
+        return BalanceSnapshot.objects.for_user(user_id).get()
+    except BalanceSnapshot.DoesNotExist:
+        # Built from the primary: a lagging replica's history would be stored as the user's totals
+        with use_primary():
+            snapshot, _ = BalanceSnapshot.objects.for_user(user_id).get_or_create(
+                user_id=user_id, defaults=totals_from_history(user_id)
+            )
+        return snapshot
+
+
+async def aget_snapshot(user_id):
+    # get_snapshot for async views; the rare first-time build from history runs in a worker thread
+    try:
+        return await BalanceSnapshot.objects.for_user(user_id).aget()
+    except BalanceSnapshot.DoesNotExist:
+        return await sync_to_async(get_snapshot)(user_id)
+
+
+def rebuild(user_ids):
+    """Recompute the snapshots of the given users from their hot and archived transaction history."""
+    totals = {user_id: dict.fromkeys(TOTAL_FIELDS, Decimal('0')) for user_id in user_ids}
+    for alias, shard_user_ids in group_by_shard(user_ids).items():
+        for model in (Transaction, ArchivedTransaction):
+            grouped = (
+                model.objects.on_shard(alias).filter(user_id__in=shard_user_ids, transaction_type__in=TOTAL_FIELDS)
+                .values('user_id', 'transaction_type')
+                .annotate(total=Sum('amount'))
+                .order_by()
+            )
+            for row in grouped:
+                totals[row['user_id']][row['transaction_type']] += row['total']
+    BalanceSnapshot.objects.bulk_create(
+        [BalanceSnapshot(user_id=user_id, **fields) for user_id, fields in totals.items()],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=TOTAL_FIELDS,
+    )
+    return len(totals)
+
+
+def _snapshot_balances(user_ids):
+    balances = {}
+    for alias, shard_user_ids in group_by_shard(user_ids).items():
+        snapshots = BalanceSnapshot.objects.on_shard(alias).filter(user_id__in=shard_user_ids)
+        for user_id, *totals in snapshots.values_list('user_id', *TOTAL_FIELDS):
+            totals = dict(zip(TOTAL_FIELDS, totals))
+            balances[user_id] = totals['cash_in'] - totals['cash_out'] - totals['bill_payment']
+    return balances
+
+
+def drift():
+    """
+    Yield (profile, snapshot_balance) for every consumer or merchant whose stored
+    balance disagrees with the balance implied by their transaction history.
+    Profiles and snapshots may be on different shards, so they are compared
+    here, DRIFT_CHUNK_SIZE profiles at a time.
+    """
+    for model in (ConsumerProfile, MerchantProfile):
+        querysets = model.objects.across_shards() if is_sharded(model) else [model.objects.all()]
+        for queryset in querysets:
+            last_id = 0
+            while True:
+                profiles = list(queryset.filter(id__gt=last_id).order_by('id')[:DRIFT_CHUNK_SIZE])
+                if not profiles:
+                    break
+                last_id = profiles[-1].id
+                snapshot_balances = _snapshot_balances([profile.user_id for profile in profiles])
+                for profile in profiles:
+                    snapshot_balance = snapshot_balances.get(profile.user_id, Decimal('0'))
+                    if profile.balance != snapshot_balance:
+                        yield profile, snapshot_balance
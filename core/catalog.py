@@ -0,0 +1,164 @@
+import time
+from collections import defaultdict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Product, Service
+from .routers import use_primary
+
+# A browsable listing: the rows it shows, and the template rendering one merchant's block of them
+Catalog = namedtuple('Catalog', ['rows', 'template', 'context_name'])
+
+CATALOGS = {
+    'products': Catalog(
+        lambda: Product.objects.filter(merchant__user_type='merchant'), 'browse_products_merchant.html', 'products'
+    ),
+    'services': Catalog(lambda: Service.objects.all(), 'browse_services_merchant.html', 'services'),
+}
+
+# The scope whose version covers which merchants appear in a catalog at all
+INDEX = 'index'
+
+# How often a request waiting on another one's recomputation checks for the result
+POLL_INTERVAL = 0.05
+
+
+def _version_key(kind, scope):
+    return f'catalog:{kind}:{scope}:version'
+
+
+def _versions(kind, scopes):
+    keys = {scope: _version_key(kind, scope) for scope in scopes}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for scope, key in keys.items():
+        if key not in found:
+            # Start from the clock, so a counter lost to eviction never reuses an old version
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key) or time.time_ns()
+        versions[scope] = found[key]
+    return versions
+
+
+def bump(kind, *scopes):
+    # Cached entries are keyed by version, so bumping makes the old ones unreachable
+    for scope in scopes:
+        key = _version_key(kind, scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def _get_or_compute(key, compute):
+    """
+    Return the cached value for key, computing and caching it on a miss. Only
+    one caller at a time computes a given key (the lock is a cache.add, so
+    this holds across processes sharing the cache); the others wait for its
+    result instead of all running the same queries. A waiter that outlasts
+    CATALOG_RECOMPUTE_TIMEOUT stops waiting and computes the value itself.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    timeout = settings.CATALOG_RECOMPUTE_TIMEOUT
+    deadline = time.monotonic() + timeout
+    locked = cache.add(lock_key, 1, timeout=timeout)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        locked = cache.add(lock_key, 1, timeout=timeout)
+
+    try:
+        # The previous holder may have finished between our miss and taking the lock
+        value = cache.get(key) if locked else None
+        if value is None:
+            # A lagging replica would cache old rows under the new version until the next change
+            with use_primary():
+                value = compute()
+            cache.set(key, value, settings.CATALOG_CACHE_TTL)
+        return value
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+def render_catalog(kind):
+    """
+    Return the rendered blocks of a catalog listing, one per merchant in
+    merchant id order, ready to be placed in the page. Each block is cached
+    under its merchant's current version, so a product or service change
+    only re-renders the block of the merchant it belongs to. A warm catalog
+    is served with four cache round trips, however many merchants it has, and
+    no database queries; a cold one with two queries.
+    """
+    catalog = CATALOGS[kind]
+    index_version = _versions(kind, [INDEX])[INDEX]
+    merchant_ids = _get_or_compute(
+        f'catalog:{kind}:{INDEX}:v{index_version}',
+        lambda: list(catalog.rows().order_by('merchant_id').values_list('merchant_id', flat=True).distinct()),
+    )
+
+    versions = _versions(kind, merchant_ids)
+    keys = {merchant_id: f'catalog:{kind}:merchant:{merchant_id}:v{versions[merchant_id]}' for merchant_id in merchant_ids}
+    found = cache.get_many(keys.values())
+
+    # The rows of every block missing from the cache come from one query, not one per merchant
+    missing = [merchant_id for merchant_id, key in keys.items() if key not in found]
+    rows = defaultdict(list)
+    if missing:
+        with use_primary():
+            for row in catalog.rows().filter(merchant_id__in=missing).order_by('id'):
+                rows[row.merchant_id].append(row)
+
+    blocks = []
+    for merchant_id, key in keys.items():
+        block = found.get(key)
+        if block is None:
+            block = _get_or_compute(key, lambda: render_to_string(catalog.template, {
+                catalog.context_name: rows[merchant_id],
+            }))
+        blocks.append(mark_safe(block))
+    return blocks
+
+
+async def arender_catalog(kind):
+    # render_catalog for async views; the cache backends and template engine are synchronous
+    return await sync_to_async(render_catalog)(kind)
+
+
+def _changed(kind, instance, membership):
+    # Bump after commit: bumping earlier would let a concurrent request cache the pre-commit rows as current
+    scopes = [instance.merchant_id, INDEX] if membership else [instance.merchant_id]
+    transaction.on_commit(lambda: bump(kind, *scopes))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    _changed('products', instance, membership=created)
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    _changed('products', instance, membership=True)
+
+
+@receiver(post_save, sender=Service)
+def service_saved(sender, instance, created, **kwargs):
+    _changed('services', instance, membership=created)
+
+
+@receiver(post_delete, sender=Service)
+def service_deleted(sender, instance, **kwargs):
+    _changed('services', instance, membership=True)
@@ -0,0 +1,103 @@
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ConsumerProfile, User
+
+# What the agent views need to know about a consumer; id is the user id, as on User
+ConsumerRef = namedtuple('ConsumerRef', ['id', 'username', 'profile_id'])
+
+# Fields whose change can make a cached lookup wrong; other saves (e.g. last_login on login) keep it
+_USER_FIELDS = {'username', 'user_type'}
+
+
+def _name_key(username):
+    # Usernames come from forms as typed, so they are hashed into a key every cache backend accepts
+    return f'consumers:name:{hashlib.md5(username.encode(), usedforsecurity=False).hexdigest()}'
+
+
+def _id_key(user_id):
+    # The username a user id was last cached under, so a rename can drop the entry for the old name
+    return f'consumers:id:{user_id}'
+
+
+def _consumer_users():
+    return User.objects.filter(user_type='consumer').only('id', 'username')
+
+
+def _lookup(username, user, profile_id):
+    if profile_id is None:
+        raise User.DoesNotExist(f'Consumer {username!r} has no profile.')
+    consumer = ConsumerRef(user.id, user.username, profile_id)
+    entries = {_name_key(username): consumer, _id_key(user.id): username}
+    return consumer, entries
+
+
+def resolve_consumer(username):
+    """
+    Return the ConsumerRef for a consumer username, raising User.DoesNotExist
+    if there is no consumer with a profile by that name. Repeat lookups are
+    answered from the default cache, shared by every process when
+    CACHE_BACKEND is, for CONSUMER_CACHE_TTL seconds; a miss costs two
+    queries, one for the user on the primary and one for its profile on the
+    user's shard. Unknown names are not cached, so a consumer registered a
+    moment ago is found straight away.
+    """
+    consumer = cache.get(_name_key(username))
+    if consumer is not None:
+        return consumer
+    user = _consumer_users().get(username=username)
+    profile_id = ConsumerProfile.objects.for_user(user.id).values_list('id', flat=True).first()
+    consumer, entries = _lookup(username, user, profile_id)
+    cache.set_many(entries, settings.CONSUMER_CACHE_TTL)
+    return consumer
+
+
+async def aresolve_consumer(username):
+    # resolve_consumer for async views, with the miss served by the async ORM
+    consumer = await cache.aget(_name_key(username))
+    if consumer is not None:
+        return consumer
+    user = await _consumer_users().aget(username=username)
+    profile_id = await ConsumerProfile.objects.for_user(user.id).values_list('id', flat=True).afirst()
+    consumer, entries = _lookup(username, user, profile_id)
+    await cache.aset_many(entries, settings.CONSUMER_CACHE_TTL)
+    return consumer
+
+
+def _forget(user_id, username=None):
+    # Matching on the id also catches renames, whose old username is only known from the id's entry
+    keys = [_id_key(user_id)]
+    cached_name = cache.get(_id_key(user_id))
+    for name in {cached_name, username} - {None}:
+        keys.append(_name_key(name))
+    cache.delete_many(keys)
+
+
+def forget_consumer(user_id, username=None):
+    # Now, and again after commit, so a request running meanwhile cannot cache the row from before the change
+    _forget(user_id, username)
+    transaction.on_commit(lambda: _forget(user_id, username))
+
+
+@receiver(post_save, sender=User)
+def invalidate_saved_user(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not _USER_FIELDS.intersection(update_fields):
+        return
+    forget_consumer(instance.pk, instance.username)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    forget_consumer(instance.pk, instance.username)
+
+
+@receiver(post_save, sender=ConsumerProfile)
+@receiver(post_delete, sender=ConsumerProfile)
+def invalidate_consumer_profile(sender, instance, **kwargs):
+    forget_consumer(instance.user_id)
@@ -0,0 +1,6 @@
+import uuid
+
+
+def idempotency_key(request):
+    # A fresh key for every rendered form, so resubmitting the same form replays its result
+    return {'idempotency_key': uuid.uuid4().hex}
@@ -0,0 +1,87 @@
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db import models
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.permissions import SAFE_METHODS
+
+
+def requested_fields(request):
+    """The field names a read asked for with ?fields=a,b, or None for all of them."""
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(',') if name.strip()}
+
+
+class ParamsFilter(BaseFilterBackend):
+    """
+    Filters from the query string. A view lists the parameters it accepts in
+    filter_params, each mapped to the lookup it filters on, e.g.
+    {'min_price': 'price__gte'}; empty parameters are ignored.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for param, lookup in getattr(view, 'filter_params', {}).items():
+            value = request.query_params.get(param)
+            if value in (None, ''):
+                continue
+            # Django only parses True/False and 1/0; clients send JSON's true/false
+            if isinstance(queryset.model._meta.get_field(lookup.split('__')[0]), models.BooleanField):
+                value = {'true': True, 'false': False}.get(value.lower(), value)
+            try:
+                queryset = queryset.filter(**{lookup: value})
+            except (ArithmeticError, TypeError, ValueError, DjangoValidationError):
+                raise ValidationError({param: f'Not a valid value: {value}'})
+        return queryset
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {'name': param, 'required': False, 'in': 'query', 'schema': {'type': 'string'}}
+            for param in getattr(view, 'filter_params', {})
+        ]
+
+
+def _columns(serializer, model, joined):
+    # The columns behind the serializer's fields, as only() arguments, or None when a field is not a plain
+    # column or a relation's (a method or a property), so which columns it reads cannot be known
+    columns = {model._meta.pk.name}
+    for field in serializer.fields.values():
+        path = field.source.split('.')
+        try:
+            model_field = model._meta.get_field(path[0])
+        except FieldDoesNotExist:
+            return None
+        if not model_field.concrete:
+            return None
+        # A joined relation's column is loaded with it; a prefetched one needs only the foreign key
+        columns.add('__'.join(path) if '__'.join(path[:-1]) in joined else path[0])
+    return columns
+
+
+class SparseFieldsetFilter(BaseFilterBackend):
+    """
+    Load only what the serializer outputs. A view maps serializer fields to
+    the relation each one reads, in select_related (joined) and
+    prefetch_related (fetched apart, for relations that may live on another
+    database); a relation is only loaded when one of its fields is wanted.
+    With ?fields= on a read, only those fields' columns are selected.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        fields = requested_fields(request)
+        joined = {path for name, path in getattr(view, 'select_related', {}).items() if fields is None or name in fields}
+        prefetched = {path for name, path in getattr(view, 'prefetch_related', {}).items() if fields is None or name in fields}
+        if joined:
+            queryset = queryset.select_related(*joined)
+        if prefetched:
+            queryset = queryset.prefetch_related(*prefetched)
+        if fields is not None:
+            columns = _columns(view.get_serializer(), queryset.model, joined)
+            if columns is not None:
+                # The pagination reads the columns it orders by to make its cursors
+                ordering = getattr(view.paginator, 'ordering', None) or ()
+                columns.update(field.lstrip('-') for field in ([ordering] if isinstance(ordering, str) else ordering))
+                queryset = queryset.only(*columns)
+        return queryset
@@ -0,0 +1,147 @@
+import hashlib
+import json
+from collections import namedtuple
+from functools import wraps
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .caching import BoundedCache
+from .models import IdempotencyKey
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 100
+# Sent with form posts but not part of what the request asks for, so left out of its fingerprint
+UNFINGERPRINTED_FIELDS = {FIELD, 'csrfmiddlewaretoken'}
+
+StoredResponse = namedtuple('StoredResponse', ['request_fingerprint', 'status_code', 'content_type', 'location', 'content'])
+
+# Process-local copy of recently completed responses; the IdempotencyKey table is the source of truth
+_replays = BoundedCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_CACHE_TTL)
+
+
+def _request_key(request):
+    return request.META.get(HEADER) or request.POST.get(FIELD) or request.GET.get(FIELD)
+
+
+def _canonical(value):
+    # Uploads are fingerprinted by name and content
+    if isinstance(value, UploadedFile):
+        digest = hashlib.sha256()
+        for chunk in value.chunks():
+            digest.update(chunk)
+        value.seek(0)
+        return [value.name, digest.hexdigest()]
+    return str(value)
+
+
+def _body(request):
+    # The request body in a canonical form, fields sorted by name, so the same request sent again digests the same
+    # whatever order its client wrote it in. DRF parses its requests' bodies itself and its views reuse the result.
+    if isinstance(request, Request):
+        data = request.data
+    elif request.content_type in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        data = {**dict(request.POST.lists()), **dict(request.FILES.lists())}
+    elif request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return request.body
+    else:
+        return request.body
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    if isinstance(data, dict):
+        data = {name: value for name, value in data.items() if name not in UNFINGERPRINTED_FIELDS}
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), default=_canonical).encode()
+
+
+def _fingerprint(request):
+    # The body's digest goes before the path so a long path cannot truncate it away
+    return f'{request.method} {hashlib.sha256(_body(request)).hexdigest()} {request.path}'[:255]
+
+
+def _store(response):
+    # DRF handlers return unrendered Responses; store their data as JSON
+    if getattr(response, 'data', None) is not None and not getattr(response, 'accepted_renderer', None):
+        return 'application/json', JSONRenderer().render(response.data)
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    return response.get('Content-Type', ''), response.content
+
+
+def _replay(stored, request):
+    if stored.request_fingerprint != _fingerprint(request):
+        return HttpResponse("This idempotency key was already used for a different request.", status=422)
+    response = HttpResponse(bytes(stored.content), status=stored.status_code, content_type=stored.content_type or None)
+    if stored.location:
+        response['Location'] = stored.location
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def run_idempotent(request, handler):
+    """
+    Run handler() at most once per (user, idempotency key). The key comes from
+    the Idempotency-Key header or an idempotency_key form or query field;
+    requests without one, or from anonymous users, run normally. A retry gets
+    the stored response of the first attempt without running the handler
+    again, from memory if this process saw it recently and from the
+    IdempotencyKey table otherwise. The key is claimed in the same DB
+    transaction as the handler's writes, so a concurrent retry waits on the
+    unique constraint and then replays. A key reused for a request with a
+    different method, path or body gets a 422 instead.
+    """
+    key = _request_key(request)
+    if not key or not request.user.is_authenticated:
+        return handler()
+    if len(key) > MAX_KEY_LENGTH:
+        return HttpResponse(f"Idempotency keys are limited to {MAX_KEY_LENGTH} characters.", status=400)
+
+    cache_key = (request.user.pk, key)
+    stored = _replays.get(cache_key)
+    if stored is not None:
+        return _replay(stored, request)
+
+    response = None
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user_id=request.user.pk, key=key, request_fingerprint=_fingerprint(request)
+                )
+        except IntegrityError:
+            record = None
+        if record is not None:
+            response = handler()
+            record.status_code = response.status_code
+            record.content_type, record.content = _store(response)
+            record.location = response.get('Location', '')[:255]
+            record.save(update_fields=['status_code', 'content_type', 'content', 'location'])
+
+    if record is None:
+        record = IdempotencyKey.objects.get(user_id=request.user.pk, key=key)
+    stored = StoredResponse(
+        record.request_fingerprint, record.status_code, record.content_type, record.location, bytes(record.content)
+    )
+    transaction.on_commit(lambda: _replays.set(cache_key, stored))
+    return response if response is not None else _replay(stored, request)
+
+
+def idempotent(view):
+    # For function views; put it below login_required so the user is known
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return run_idempotent(request, lambda: view(request, *args, **kwargs))
+    return wrapper
+
+
+class IdempotentCreateMixin:
+    # For DRF viewsets: make create() honour idempotency keys
+    def create(self, request, *args, **kwargs):
+        return run_idempotent(request, lambda: super(IdempotentCreateMixin, self).create(request, *args, **kwargs))
@@ -0,0 +1,169 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.db.models import Case, F, When
+
+from . import balances, sharding
+from .models import ConsumerProfile, Transaction, User
+from .money import MoneyField, money, parse_amount
+from .references import new_reference
+
+# One line of an agent batch; amount and direction are still unvalidated strings
+BatchRow = namedtuple('BatchRow', ['consumer_username', 'amount', 'direction'])
+
+BATCH_DIRECTIONS = ('cash_in', 'cash_out')
+
+# Consumers per balance UPDATE, keeping the CASE parameters under SQLite's 999 limit
+UPDATE_CHUNK_SIZE = 300
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientBalance(LedgerError):
+    pass
+
+
+class AccountNotFound(LedgerError):
+    pass
+
+
+def entry(transaction_type, user_id, amount, status='completed'):
+    # Unsaved Transaction row; post() inserts all entries of a posting at once
+    return Transaction(
+        transaction_type=transaction_type,
+        user_id=user_id,
+        amount=amount,
+        status=status,
+        reference_id=new_reference(),
+    )
+
+
+def _account(profile_model, user_id):
+    # Consumer profiles live on their user's shard, the other profiles on the primary
+    if sharding.is_sharded(profile_model):
+        return profile_model.objects.for_user(user_id)
+    return profile_model.objects.filter(user_id=user_id)
+
+
+def _database(profile_model, user_id):
+    return sharding.shard_for(user_id) if sharding.is_sharded(profile_model) else 'default'
+
+
+def debit(profile_model, user_id, amount):
+    # The balance check and the deduction are a single conditional UPDATE, so
+    # two concurrent debits can never both pass the check.
+    updated = _account(profile_model, user_id).filter(balance__gte=amount).update(
+        balance=F('balance') - money(amount)
+    )
+    if not updated:
+        # Only a failed debit pays for telling a missing account from a short one
+        if not _account(profile_model, user_id).exists():
+            raise AccountNotFound(f'No {profile_model.__name__} for user {user_id}.')
+        raise InsufficientBalance(f'{profile_model.__name__} for user {user_id} cannot cover {amount}.')
+
+
+def credit(profile_model, user_id, amount):
+    updated = _account(profile_model, user_id).update(balance=F('balance') + money(amount))
+    if not updated:
+        raise AccountNotFound(f'No {profile_model.__name__} for user {user_id}.')
+
+
+def post(entries, debit_from=None, credit_to=None):
+    """
+    Apply a posting as one atomic unit: an optional debit and credit, given as
+    (profile_model, user_id, amount) tuples, plus a single bulk insert of the
+    Transaction rows recording it and the matching balance snapshot update.
+    Raises InsufficientBalance or AccountNotFound and rolls everything back if
+    either side cannot be applied. When the rows involved are on several
+    shards, the posting runs in one transaction on each of them.
+    """
+    databases = {sharding.shard_for(entry.user_id) for entry in entries}
+    databases.update(_database(model, user_id) for model, user_id, _ in filter(None, [debit_from, credit_to]))
+    with sharding.atomic(databases):
+        if debit_from:
+            debit(*debit_from)
+        if credit_to:
+            credit(*credit_to)
+        Transaction.objects.bulk_create(entries)
+        balances.apply_entries(entries)
+    return entries
+
+
+def _batch_result(number, row, error=None, reference_id=None):
+    return {
+        'row': number,
+        'consumer_username': row.consumer_username,
+        'amount': str(row.amount),
+        'direction': row.direction,
+        'status': 'error' if error else 'ok',
+        'error': error,
+        'reference_id': reference_id,
+    }
+
+
+def post_batch(agent_id, rows):
+    """
+    Apply an agent's batch of consumer cash-ins and cash-outs in one DB
+    transaction: one query resolves every consumer, one locks and reads their
+    balances, then the balance changes, Transaction inserts and snapshot
+    updates are each issued in bulk. Rows are checked in order against the
+    running balance, so a cash-out can spend a cash-in earlier in the batch.
+    Invalid rows are skipped and reported; the rest are applied. Returns one
+    result dict per row. The consumers' balances are read and updated on each
+    of their shards, all in one transaction per shard.
+    """
+    results = []
+    usernames = {row.consumer_username for row in rows}
+    consumers = dict(
+        User.objects.filter(username__in=usernames, user_type='consumer').values_list('username', 'id')
+    )
+    shards = sharding.group_by_shard(consumers.values())
+    with sharding.atomic([*shards, sharding.shard_for(agent_id)]):
+        running = {}
+        for alias, user_ids in shards.items():
+            running.update(
+                ConsumerProfile.objects.on_shard(alias).select_for_update()
+                .filter(user_id__in=user_ids)
+                .values_list('user_id', 'balance')
+            )
+
+        deltas = defaultdict(Decimal)
+        entries = []
+        for number, row in enumerate(rows, start=1):
+            user_id = consumers.get(row.consumer_username)
+            try:
+                amount = parse_amount(row.amount)
+                valid_amount = amount > 0
+            except ValueError:
+                valid_amount = False
+
+            if user_id is None or user_id not in running:
+                results.append(_batch_result(number, row, 'Unknown consumer.'))
+            elif not valid_amount:
+                results.append(_batch_result(number, row, 'Amount must be a positive number with at most two decimal places.'))
+            elif row.direction not in BATCH_DIRECTIONS:
+                results.append(_batch_result(number, row, 'Direction must be cash_in or cash_out.'))
+            elif row.direction == 'cash_out' and running[user_id] < amount:
+                results.append(_batch_result(number, row, 'Insufficient balance.'))
+            else:
+                signed = amount if row.direction == 'cash_in' else -amount
+                running[user_id] += signed
+                deltas[user_id] += signed
+                consumer_entry = entry(row.direction, user_id, amount)
+                entries += [consumer_entry, entry(row.direction, agent_id, amount)]
+                results.append(_batch_result(number, row, reference_id=consumer_entry.reference_id))
+
+        changed = sharding.group_by_shard(sorted(user_id for user_id, delta in deltas.items() if delta))
+        for alias, user_ids in changed.items():
+            for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+                chunk = user_ids[start:start + UPDATE_CHUNK_SIZE]
+                ConsumerProfile.objects.on_shard(alias).filter(user_id__in=chunk).update(balance=F('balance') + Case(
+                    *[When(user_id=user_id, then=money(deltas[user_id])) for user_id in chunk],
+                    default=money(0),
+                    output_field=MoneyField(),
+                ))
+        Transaction.objects.bulk_create(entries)
+        balances.apply_entries(entries)
+    return results
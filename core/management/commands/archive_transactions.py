@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.archive import archive_batch, archive_cutoff
+
+class Command(BaseCommand):
+    help = 'Move completed transactions older than the archive horizon into the archive table, in batches, shard by shard.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive horizon in days (default: TRANSACTION_ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches; run again to resume.')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['days'])
+        self.stdout.write(f'Archiving completed transactions older than {cutoff:%Y-%m-%d %H:%M}...')
+
+        started = time.monotonic()
+        total = batches = 0
+        for shard in settings.DATABASE_SHARDS:
+            while options['max_batches'] is None or batches < options['max_batches']:
+                batch_started = time.monotonic()
+                moved = archive_batch(cutoff, options['batch_size'], shard)
+                if not moved:
+                    break
+                batches += 1
+                total += moved
+                elapsed = time.monotonic() - batch_started
+                self.stdout.write(
+                    f'Batch {batches} ({shard}): moved {moved} rows in {elapsed:.2f}s ({moved / elapsed:.0f} rows/s)'
+                )
+                if options['pause']:
+                    time.sleep(options['pause'])
+
+        elapsed = time.monotonic() - started
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total} transactions in {batches} batches, {elapsed:.1f}s ({rate:.0f} rows/s).'
+        ))
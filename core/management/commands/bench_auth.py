@@ -0,0 +1,86 @@
+import json
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core.models import User
+
+# The view itself runs no queries: whatever a request to it runs is the cost of authenticating
+PATH = '/api/profile/'
+
+DB_SESSIONS = 'django.contrib.sessions.backends.db'
+
+# Each way of authenticating: the settings it runs under and whether the client sends a JWT rather than a session
+# cookie. The first is how every request was authenticated before the user cache, signed cookies and JWTs.
+SCHEMES = {
+    'database session': ({'SESSION_ENGINE': DB_SESSIONS, 'AUTHENTICATION_BACKENDS': ['django.contrib.auth.backends.ModelBackend'], 'AUTH_USER_CACHE_TTL': 0}, False),
+    'database session, cached user': ({'SESSION_ENGINE': DB_SESSIONS}, False),
+    'cache session, cached user': ({'SESSION_ENGINE': 'django.contrib.sessions.backends.cache'}, False),
+    'signed cookie session, cached user': ({'SESSION_ENGINE': 'django.contrib.sessions.backends.signed_cookies'}, False),
+    'jwt': ({'AUTH_USER_CACHE_TTL': 0}, True),
+    'jwt, cached user': ({}, True),
+}
+
+class Command(BaseCommand):
+    help = (
+        f'Measure the database queries and time authentication costs per request, for database, cache and '
+        f'signed cookie sessions and for JWTs, with and without the user cache. Makes --requests requests to '
+        f'{PATH} in process as a temporary merchant, after one to warm the caches, and prints the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be at least 1.')
+        user = User.objects.create_user(username=f'bench-auth-{uuid.uuid4().hex[:12]}', password=None, user_type='merchant')
+        try:
+            results = {
+                name: self.measure(user, overrides, token, options['requests'])
+                for name, (overrides, token) in SCHEMES.items()
+            }
+        finally:
+            user.delete()
+        self.stdout.write(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(
+            f"Authentication runs {results['database session']['queries_per_request']:g} queries per request with "
+            f"database sessions and {results['signed cookie session, cached user']['queries_per_request']:g} with "
+            f"signed cookie sessions; {results['jwt, cached user']['queries_per_request']:g} with JWTs."
+        ))
+
+    def measure(self, user, overrides, token, requests):
+        with override_settings(**overrides):
+            cache.clear()
+            if token:
+                client = Client(headers={'Authorization': f'Bearer {RefreshToken.for_user(user).access_token}'})
+            else:
+                client = Client()
+                client.force_login(user)
+            if client.get(PATH).status_code != 200:
+                raise CommandError(f'{PATH} refused the benchmark user.')
+
+            started = time.perf_counter()
+            for _ in range(requests):
+                client.get(PATH)
+            seconds = time.perf_counter() - started
+
+            # Counted apart from the timing, which capturing the queries would slow down
+            contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+            with ExitStack() as stack:
+                for context in contexts:
+                    stack.enter_context(context)
+                for _ in range(requests):
+                    client.get(PATH)
+            queries = sum(len(context.captured_queries) for context in contexts)
+        return {
+            'queries_per_request': round(queries / requests, 2),
+            'ms_per_request': round(seconds / requests * 1000, 3),
+        }
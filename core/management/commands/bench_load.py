@@ -0,0 +1,315 @@
+import http.client
+import json
+import random
+import subprocess
+import threading
+import time
+import uuid
+from collections import defaultdict, namedtuple
+from importlib import import_module
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand, CommandError
+from django.middleware.csrf import CSRF_ALLOWED_CHARS
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from core.models import Product, Transaction, User
+
+# A request a simulated user makes, picked in proportion to its weight among its role's endpoints. path and data
+# are functions of the user and the shared targets, data being the form body of a POST.
+Endpoint = namedtuple('Endpoint', ['name', 'weight', 'method', 'path', 'data'])
+
+# Seeded rows the simulated users act on: products to buy, consumers to serve, words to search for
+Targets = namedtuple('Targets', ['product_ids', 'consumer_usernames', 'words'])
+
+ROLES = {
+    'consumer': [
+        Endpoint('consumer history', 30, 'GET', lambda user, targets: '/consumer/transaction-history/', None),
+        Endpoint('consumer balance', 20, 'GET', lambda user, targets: '/consumer/balance-view/', None),
+        Endpoint('browse products', 5, 'GET', lambda user, targets: '/browse-products/', None),
+        Endpoint('catalog search', 10, 'GET', lambda user, targets: '/api/search/?' + urlencode({'q': user.random.choice(targets.words)}), None),
+        Endpoint('profile api', 10, 'GET', lambda user, targets: '/api/profile/', None),
+        Endpoint('consumer export', 2, 'GET', lambda user, targets: '/consumer/export-transactions/', None),
+        Endpoint('recharge', 5, 'POST', lambda user, targets: '/consumer/recharge-balance/', lambda user, targets: {'amount': '20.00'}),
+        Endpoint(
+            'purchase', 5, 'POST', lambda user, targets: f'/purchase-product/{user.random.choice(targets.product_ids)}/',
+            lambda user, targets: {},
+        ),
+    ],
+    'agent': [
+        Endpoint(
+            'agent consumer history', 30, 'POST', lambda user, targets: '/agent/transaction-history/',
+            lambda user, targets: {'consumer_username': user.random.choice(targets.consumer_usernames)},
+        ),
+        Endpoint(
+            'agent consumer balance', 20, 'POST', lambda user, targets: '/agent/consumer-balance-view/',
+            lambda user, targets: {'consumer_username': user.random.choice(targets.consumer_usernames)},
+        ),
+        Endpoint(
+            'agent consumer export', 2, 'GET',
+            lambda user, targets: '/agent/export-consumer-transactions/?' + urlencode({'consumer_username': user.random.choice(targets.consumer_usernames)}),
+            None,
+        ),
+        Endpoint(
+            'agent cash-in', 10, 'POST', lambda user, targets: '/agent/accept-cash-payment/',
+            lambda user, targets: {'consumer_username': user.random.choice(targets.consumer_usernames), 'amount': '50.00'},
+        ),
+        Endpoint(
+            'agent cash-out', 5, 'POST', lambda user, targets: '/agent/cash-out-consumer/',
+            lambda user, targets: {'consumer_username': user.random.choice(targets.consumer_usernames), 'amount': '5.00'},
+        ),
+    ],
+    'merchant': [
+        Endpoint('merchant history', 40, 'GET', lambda user, targets: '/merchant/transaction-history/', None),
+        Endpoint('merchant balance', 30, 'GET', lambda user, targets: '/merchant/balance-view/', None),
+        Endpoint('merchant products', 20, 'GET', lambda user, targets: '/merchant/product-list/', None),
+        Endpoint('merchant export', 2, 'GET', lambda user, targets: '/merchant/export-transactions/', None),
+    ],
+}
+
+# Endpoints that change data, left out with --read-only
+WRITES = {'recharge', 'purchase', 'agent cash-in', 'agent cash-out'}
+
+
+class SimulatedUser:
+    def __init__(self, role, username, cookie, csrf_token, seed):
+        self.role = role
+        self.username = username
+        self.cookie = cookie
+        self.csrf_token = csrf_token
+        self.random = random.Random(seed)
+
+
+def _percentile(ordered, p):
+    # Nearest rank, in milliseconds
+    return round(ordered[max(0, -(-len(ordered) * p // 100) - 1)] * 1000, 1) if ordered else None
+
+
+def _summary(latencies, rejected, errors, duration):
+    # Latencies are of every answered request; rejected ones got a 4xx (e.g. a purchase the balance cannot
+    # cover), errors a 5xx or no answer at all
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'rejected': rejected,
+        'errors': errors,
+        'requests_per_second': round(len(ordered) / duration, 1),
+        'p50_ms': _percentile(ordered, 50),
+        'p95_ms': _percentile(ordered, 95),
+        'p99_ms': _percentile(ordered, 99),
+        'max_ms': round(ordered[-1] * 1000, 1) if ordered else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive a running server with concurrent simulated consumers, agents and merchants, each making a weighted '
+        'mix of requests to the real pages and API as a seeded user (see seed_data), and report throughput and '
+        'p50/p95/p99 latency per endpoint as JSON. Run it with the same settings as the server: it logs the '
+        'simulated users in by creating their sessions. With --compare, flags endpoints that got slower than '
+        'an earlier report.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the server under test.')
+        parser.add_argument('--users', type=int, default=50, help='Simulated users making requests at once.')
+        parser.add_argument('--mix', default='consumer=70,agent=20,merchant=10', help='Share of users per role.')
+        parser.add_argument('--duration', type=float, default=60, help='Seconds to measure for.')
+        parser.add_argument('--warmup', type=float, default=10, help='Seconds of load before measuring.')
+        parser.add_argument('--think', type=float, default=0, help='Seconds each user waits between requests.')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request counts as failed.')
+        parser.add_argument('--read-only', action='store_true', help='Leave out the endpoints that change data.')
+        parser.add_argument('--prefix', default='seed', help='Username prefix given to seed_data.')
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file as well as to stdout.')
+        parser.add_argument('--compare', help='An earlier JSON report to compare against.')
+        parser.add_argument('--tolerance', type=float, default=20, help='Percent slowdown (p95) or throughput loss counted as a regression.')
+        parser.add_argument('--min-requests', type=int, default=50, help='Endpoints with fewer requests in either report are not compared.')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise CommandError(f"Not an http(s) URL: {options['url']}")
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.address = (url.hostname, url.port)
+
+        rng = random.Random(options['random_seed'])
+        mix = self.parse_mix(options['mix'])
+        targets = self.load_targets(options['prefix'], rng)
+        users, sessions = self.log_in(options['prefix'], mix, options['users'], rng)
+        endpoints = {
+            role: [endpoint for endpoint in role_endpoints if not (options['read_only'] and endpoint.name in WRITES)]
+            for role, role_endpoints in ROLES.items()
+        }
+
+        started_at = timezone.now()
+        try:
+            measured, duration = self.run(users, endpoints, targets, options)
+        finally:
+            for session in sessions:
+                session.delete()
+
+        report = {
+            'started_at': started_at.isoformat(),
+            'git_commit': _git_commit(),
+            'url': options['url'],
+            'users': {role: sum(user.role == role for user in users) for role in mix},
+            'duration_s': round(duration, 1),
+            'think_s': options['think'],
+            'read_only': options['read_only'],
+            'data': {'users': User.objects.count(), 'transactions': sum(q.count() for q in Transaction.objects.across_shards())},
+            'endpoints': {
+                name: _summary(result['latencies'], result['rejected'], result['errors'], duration)
+                for name, result in sorted(measured.items())
+            },
+            'total': _summary(
+                [latency for result in measured.values() for latency in result['latencies']],
+                sum(result['rejected'] for result in measured.values()),
+                sum(result['errors'] for result in measured.values()),
+                duration,
+            ),
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            self.compare(report, options['compare'], options['tolerance'], options['min_requests'])
+
+    def parse_mix(self, mix):
+        shares = {}
+        for part in mix.split(','):
+            role, _, share = part.partition('=')
+            if role.strip() not in ROLES:
+                raise CommandError(f"Unknown role in --mix: {role.strip()}. Roles are {', '.join(ROLES)}.")
+            try:
+                shares[role.strip()] = float(share)
+            except ValueError:
+                raise CommandError(f'Not a number in --mix: {part}')
+        return shares
+
+    def load_targets(self, prefix, rng):
+        consumers = list(User.objects.filter(username__startswith=f'{prefix}-consumer-').values_list('username', flat=True)[:10000])
+        product_ids = list(Product.objects.filter(merchant__username__startswith=f'{prefix}-').values_list('id', flat=True)[:10000])
+        if not consumers or not product_ids:
+            raise CommandError(f'No seeded data named {prefix}-...; run seed_data first.')
+        words = [name.split()[0].lower() for name in Product.objects.filter(id__in=rng.sample(product_ids, min(200, len(product_ids)))).values_list('name', flat=True)]
+        return Targets(product_ids, consumers, words)
+
+    def log_in(self, prefix, mix, count, rng):
+        # Sessions made here rather than through the login page: password hashing would dominate the load
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        total_share = sum(mix.values())
+        users, sessions = [], []
+        for role, share in mix.items():
+            wanted = round(count * share / total_share)
+            candidates = list(User.objects.filter(username__startswith=f'{prefix}-{role}-').values_list('id', flat=True)[:100000])
+            if wanted and not candidates:
+                raise CommandError(f'No seeded {role}s named {prefix}-{role}-...; run seed_data first.')
+            for user in User.objects.filter(id__in=rng.sample(candidates, min(wanted, len(candidates)))):
+                session = store()
+                session[SESSION_KEY] = str(user.pk)
+                session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.save()
+                sessions.append(session)
+                csrf_token = get_random_string(32, CSRF_ALLOWED_CHARS)
+                cookie = f'{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={csrf_token}'
+                users.append(SimulatedUser(role, user.username, cookie, csrf_token, rng.random()))
+        return users, sessions
+
+    def run(self, users, endpoints, targets, options):
+        results = defaultdict(lambda: {'latencies': [], 'rejected': 0, 'errors': 0})
+        lock = threading.Lock()
+        started = time.monotonic()
+        measure_from = started + options['warmup']
+        stop_at = measure_from + options['duration']
+
+        # Checked by the CSRF protection of HTTPS sites
+        referer = f"{options['url'].rstrip('/')}/"
+
+        def simulate(user):
+            role_endpoints = endpoints[user.role]
+            weights = [endpoint.weight for endpoint in role_endpoints]
+            connection = None
+            mine = defaultdict(lambda: {'latencies': [], 'rejected': 0, 'errors': 0})
+            while time.monotonic() < stop_at:
+                endpoint = user.random.choices(role_endpoints, weights)[0]
+                if connection is None:
+                    connection = self.connection_class(*self.address, timeout=options['timeout'])
+                headers = {'Cookie': user.cookie, 'X-CSRFToken': user.csrf_token, 'Referer': referer}
+                body = None
+                if endpoint.method == 'POST':
+                    body = urlencode(endpoint.data(user, targets))
+                    headers.update({'Content-Type': 'application/x-www-form-urlencoded', 'Idempotency-Key': uuid.uuid4().hex})
+                sent = time.monotonic()
+                try:
+                    connection.request(endpoint.method, endpoint.path(user, targets), body=body, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    connection = None
+                    status = None
+                finished = time.monotonic()
+                if sent >= measure_from and finished <= stop_at:
+                    result = mine[endpoint.name]
+                    if status is None or status >= 500:
+                        result['errors'] += 1
+                    else:
+                        result['latencies'].append(finished - sent)
+                        result['rejected'] += status >= 400
+                if options['think']:
+                    time.sleep(options['think'])
+            if connection is not None:
+                connection.close()
+            with lock:
+                for name, result in mine.items():
+                    results[name]['latencies'] += result['latencies']
+                    results[name]['rejected'] += result['rejected']
+                    results[name]['errors'] += result['errors']
+
+        threads = [threading.Thread(target=simulate, args=(user,), daemon=True) for user in users]
+        self.stderr.write(f"{len(users)} users: warming up for {options['warmup']:.0f} s, then measuring for {options['duration']:.0f} s.")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, options['duration']
+
+    def compare(self, report, path, tolerance, min_requests):
+        with open(path) as f:
+            before = json.load(f)
+        regressions = []
+        for name, now in report['endpoints'].items():
+            then = before.get('endpoints', {}).get(name)
+            # A handful of requests says nothing about a percentile
+            if not then or min(then['requests'], now['requests']) < min_requests:
+                continue
+            p95_change = (now['p95_ms'] - then['p95_ms']) / then['p95_ms'] * 100
+            rps_change = (now['requests_per_second'] - then['requests_per_second']) / (then['requests_per_second'] or 1) * 100
+            line = (
+                f"{name}: p95 {then['p95_ms']} -> {now['p95_ms']} ms ({p95_change:+.0f}%), "
+                f"{then['requests_per_second']} -> {now['requests_per_second']} req/s ({rps_change:+.0f}%)"
+            )
+            if p95_change > tolerance or rps_change < -tolerance:
+                regressions.append(line)
+                self.stderr.write(self.style.ERROR(line))
+            else:
+                self.stderr.write(line)
+        if regressions:
+            raise CommandError(f"{len(regressions)} endpoints regressed by more than {tolerance:.0f}% against {path}.")
+        self.stderr.write(self.style.SUCCESS(f'No regressions against {path}.'))
@@ -0,0 +1,166 @@
+import decimal
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from core.balances import TOTAL_FIELDS, UPDATE_CHUNK_SIZE
+from core.money import from_minor_units, to_minor_units
+
+# SQLite hands decimal sums back as floats; Django's backend rounds them to 15 significant digits
+_from_float = decimal.Context(prec=15).create_decimal_from_float
+
+# How each storage sends an amount to SQLite and reads a sum back, mirroring DecimalField and MoneyField
+STORAGES = {
+    'decimal': ('decimal', str, lambda value: _from_float(float(value))),
+    'minor_units': ('bigint', to_minor_units, from_minor_units),
+}
+
+QUERIES = {
+    'totals per user and type': (
+        'SELECT user_id, transaction_type, SUM(amount) FROM entries GROUP BY user_id, transaction_type'
+    ),
+    'totals for one user': (
+        'SELECT user_id, transaction_type, SUM(amount) FROM entries WHERE user_id = 1 GROUP BY transaction_type'
+    ),
+    'grand total': 'SELECT NULL, NULL, SUM(amount) FROM entries',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Post the same transactions into scratch SQLite tables storing amounts as decimals and as integer '
+        'minor units, then compare bulk posting throughput, aggregate query times and the exactness of the sums.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Transactions per posting.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each aggregate query; the median is reported.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        generator = random.Random(options['seed'])
+        postings = []
+        for start in range(0, options['rows'], options['batch_size']):
+            postings.append([
+                (
+                    generator.randint(1, options['users']),
+                    generator.choice(TOTAL_FIELDS),
+                    decimal.Decimal(generator.randint(1, 5_000_000)).scaleb(-2),
+                )
+                for _ in range(min(options['batch_size'], options['rows'] - start))
+            ])
+
+        expected = defaultdict(decimal.Decimal)
+        for posting in postings:
+            for user_id, transaction_type, amount in posting:
+                expected[(user_id, transaction_type)] += amount
+
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for label, storage in STORAGES.items():
+                path = os.path.join(directory, f'{label}.sqlite3')
+                results[label] = self.run(label, path, storage, postings, expected, options)
+
+        before, after = results['decimal'], results['minor_units']
+        self.stdout.write(self.style.SUCCESS(
+            f"Minor units: posting {after['posting_rows_per_second'] / before['posting_rows_per_second']:.2f}x "
+            f"the throughput, aggregates "
+            + ', '.join(
+                f"{name} {before['queries_ms'][name] / after['queries_ms'][name]:.2f}x faster" for name in QUERIES
+            )
+            + f"; inexact totals/snapshots: {before['inexact_totals']}/{before['inexact_snapshots']} as decimals, "
+            f"{after['inexact_totals']}/{after['inexact_snapshots']} in minor units."
+        ))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def run(self, label, path, storage, postings, expected, options):
+        column_type, adapt, convert = storage
+        connection = sqlite3.connect(path)
+        connection.execute(
+            f'CREATE TABLE entries (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, '
+            f'transaction_type VARCHAR(20) NOT NULL, amount {column_type} NOT NULL)'
+        )
+        connection.execute('CREATE INDEX entries_user_type_idx ON entries (user_id, transaction_type, amount)')
+        totals = ', '.join(f'{field} {column_type} NOT NULL DEFAULT 0' for field in TOTAL_FIELDS)
+        connection.execute(f'CREATE TABLE snapshots (user_id INTEGER PRIMARY KEY, {totals})')
+        connection.executemany(
+            'INSERT INTO snapshots (user_id) VALUES (?)', [(user_id,) for user_id in range(1, options['users'] + 1)]
+        )
+        connection.commit()
+
+        # Bulk posting as core.ledger does it: one insert of the rows plus one CASE update of the snapshots
+        started = time.perf_counter()
+        for posting in postings:
+            deltas = defaultdict(lambda: defaultdict(decimal.Decimal))
+            for user_id, transaction_type, amount in posting:
+                deltas[transaction_type][user_id] += amount
+            with connection:
+                connection.executemany(
+                    'INSERT INTO entries (user_id, transaction_type, amount) VALUES (?, ?, ?)',
+                    [(user_id, transaction_type, adapt(amount)) for user_id, transaction_type, amount in posting],
+                )
+                user_ids = sorted({user_id for per_user in deltas.values() for user_id in per_user})
+                for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+                    chunk = user_ids[start:start + UPDATE_CHUNK_SIZE]
+                    assignments, params = [], []
+                    for field, per_user in deltas.items():
+                        whens = [user_id for user_id in chunk if user_id in per_user]
+                        if not whens:
+                            continue
+                        assignments.append(
+                            f"{field} = {field} + CASE {' '.join('WHEN user_id = ? THEN ?' for _ in whens)} ELSE 0 END"
+                        )
+                        for user_id in whens:
+                            params += [user_id, adapt(per_user[user_id])]
+                    placeholders = ', '.join('?' for _ in chunk)
+                    connection.execute(
+                        f"UPDATE snapshots SET {', '.join(assignments)} WHERE user_id IN ({placeholders})",
+                        params + chunk,
+                    )
+        posting_seconds = time.perf_counter() - started
+        rows = sum(len(posting) for posting in postings)
+
+        queries_ms = {}
+        for name, sql in QUERIES.items():
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                fetched = [(user_id, kind, convert(total)) for user_id, kind, total in connection.execute(sql)]
+                timings.append(time.perf_counter() - started)
+            queries_ms[name] = round(statistics.median(timings) * 1000, 3)
+            if name == 'totals per user and type':
+                inexact = sum(1 for user_id, kind, total in fetched if total != expected[(user_id, kind)])
+
+        # Snapshots accumulate one addition per posting, so any rounding in the column type compounds there
+        inexact_snapshots = 0
+        for user_id, *fields in connection.execute(f"SELECT user_id, {', '.join(TOTAL_FIELDS)} FROM snapshots"):
+            inexact_snapshots += sum(
+                1 for field, total in zip(TOTAL_FIELDS, fields) if convert(total) != expected[(user_id, field)]
+            )
+
+        table_bytes = connection.execute(
+            "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN ('entries', 'entries_user_type_idx')"
+        ).fetchone()[0]
+        connection.close()
+        result = {
+            'rows': rows,
+            'posting_seconds': round(posting_seconds, 3),
+            'posting_rows_per_second': round(rows / posting_seconds),
+            'queries_ms': queries_ms,
+            'inexact_totals': inexact,
+            'inexact_snapshots': inexact_snapshots,
+            'table_and_index_bytes': table_bytes,
+        }
+        self.stdout.write(f'{label}: {result}')
+        return result
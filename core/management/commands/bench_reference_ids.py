@@ -0,0 +1,90 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from core.references import new_reference
+
+
+def legacy_reference(i):
+    # The shape views used before ULIDs: a prefix, two ids and a random uuid4
+    return f'PUR-{i % 5000}-{i % 100000}-{uuid.uuid4()}'
+
+
+def ulid_reference(i):
+    return new_reference()
+
+
+GENERATORS = {'legacy': legacy_reference, 'ulid': ulid_reference}
+
+
+class Command(BaseCommand):
+    help = (
+        'Insert the same number of rows keyed by legacy random references and by ULIDs into scratch SQLite '
+        'tables with a unique index, and compare insert throughput and index size.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2_000_000)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--cache-mb', type=int, default=16, help='SQLite page cache per table; keep it below the index size.')
+        parser.add_argument('--report-every', type=int, default=500_000)
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for label, generate in GENERATORS.items():
+                results[label] = self.run(os.path.join(directory, f'{label}.sqlite3'), generate, options)
+
+        legacy, ulid = results['legacy'], results['ulid']
+        self.stdout.write(self.style.SUCCESS(
+            f"ULID inserts: {ulid['rows_per_second'] / legacy['rows_per_second']:.2f}x the throughput, "
+            f"index {ulid['index_bytes'] / legacy['index_bytes']:.2f}x the size of legacy references."
+        ))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def run(self, path, generate, options):
+        connection = sqlite3.connect(path)
+        connection.execute(f"PRAGMA cache_size = -{options['cache_mb'] * 1024}")
+        connection.execute('CREATE TABLE bench (id INTEGER PRIMARY KEY, reference_id VARCHAR(100) NOT NULL UNIQUE)')
+
+        label = os.path.splitext(os.path.basename(path))[0]
+        rows, batch_size, report_every = options['rows'], options['batch_size'], options['report_every']
+        inserted = 0
+        elapsed = segment_elapsed = 0.0
+        segment_rows = 0
+        while inserted < rows:
+            count = min(batch_size, rows - inserted)
+            references = [(generate(inserted + offset),) for offset in range(count)]
+            started = time.perf_counter()
+            with connection:
+                connection.executemany('INSERT INTO bench (reference_id) VALUES (?)', references)
+            batch_elapsed = time.perf_counter() - started
+            elapsed += batch_elapsed
+            segment_elapsed += batch_elapsed
+            inserted += count
+            segment_rows += count
+            if segment_rows >= report_every or inserted == rows:
+                self.stdout.write(f'{label}: {inserted} rows, last {segment_rows} at {segment_rows / segment_elapsed:.0f} rows/s')
+                segment_elapsed, segment_rows = 0.0, 0
+
+        index_bytes, table_bytes = (
+            connection.execute(f"SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = '{name}'").fetchone()[0]
+            for name in ('sqlite_autoindex_bench_1', 'bench')
+        )
+        connection.close()
+        result = {
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed),
+            'index_bytes': index_bytes,
+            'table_bytes': table_bytes,
+        }
+        self.stdout.write(f'{label}: {result}')
+        return result
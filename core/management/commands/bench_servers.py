@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from importlib import import_module
+from importlib.util import find_spec
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand, CommandError
+from core.models import User
+
+# Both servers get the same number of worker processes, i.e. roughly the same memory budget
+SERVERS = {
+    'wsgi': lambda port, workers, threads: [
+        sys.executable, '-m', 'gunicorn', 'kft_agent_network.wsgi:application', '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers), '--threads', str(threads), '--worker-class', 'gthread', '--log-level', 'warning',
+    ],
+    'asgi': lambda port, workers, threads: [
+        sys.executable, '-m', 'uvicorn', 'kft_agent_network.asgi:application', '--host', '127.0.0.1',
+        '--port', str(port), '--workers', str(workers), '--log-level', 'warning',
+    ],
+}
+
+# The module each server runs from; gunicorn is only in requirements-bench.txt
+SERVER_MODULES = {'wsgi': 'gunicorn', 'asgi': 'uvicorn'}
+
+BENCH_USERNAME = 'bench-server-consumer'
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _tree_rss_bytes(root_pid):
+    # Resident memory of the server and all of its worker processes, from /proc (Linux only)
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, pending = 0, [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending += children.get(pid, [])
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                total += next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+async def _slow_client(port, path, cookie, hold, stop):
+    # A slow mobile client: sends its request headers a line at a time, keeping a connection busy for `hold` seconds
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'.encode())
+        deadline = time.monotonic() + hold
+        number = 0
+        while time.monotonic() < deadline and not stop.is_set():
+            await asyncio.sleep(0.5)
+            writer.write(f'X-Slow-{number}: 1\r\n'.encode())
+            await writer.drain()
+            number += 1
+        writer.write(f'Cookie: {cookie}\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        await asyncio.wait_for(reader.read(), timeout=hold)
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _probe(port, path, cookie, timeout):
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if not response.startswith(b'HTTP/1.1 200'):
+        return None
+    return time.perf_counter() - started
+
+
+async def _load(port, options, cookie):
+    stop = asyncio.Event()
+    slow = [
+        asyncio.create_task(_slow_client(port, options['path'], cookie, options['hold'], stop))
+        for _ in range(options['slow_clients'])
+    ]
+    # Let the slow clients occupy their connections before measuring
+    await asyncio.sleep(1)
+    semaphore = asyncio.Semaphore(options['concurrency'])
+
+    async def probe():
+        async with semaphore:
+            return await _probe(port, options['path'], cookie, options['timeout'])
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[probe() for _ in range(options['probes'])])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*slow)
+    return latencies, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the app under gunicorn (WSGI, gthread workers) and uvicorn (ASGI) with the same number of worker '
+        'processes, hold many slow client connections open against each, and measure how fast requests from '
+        'other clients are still served. Needs requirements-bench.txt installed; Linux only.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', default=list(SERVERS))
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes per server.')
+        parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker.')
+        parser.add_argument('--slow-clients', type=int, default=200)
+        parser.add_argument('--hold', type=float, default=10, help='Seconds each slow client takes to send its request.')
+        parser.add_argument('--probes', type=int, default=200, help='Requests measured while the slow clients are connected.')
+        parser.add_argument('--concurrency', type=int, default=10, help='Probe requests in flight at once.')
+        parser.add_argument('--timeout', type=float, default=15, help='Seconds before a probe counts as failed.')
+        parser.add_argument('--path', default='/api/profile/')
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        unknown = set(options['servers']) - set(SERVERS)
+        if unknown:
+            raise CommandError(f"Unknown servers: {', '.join(sorted(unknown))}.")
+        missing = sorted({SERVER_MODULES[name] for name in options['servers'] if find_spec(SERVER_MODULES[name]) is None})
+        if missing:
+            raise CommandError(f"{', '.join(missing)} not installed; run pip install -r requirements-bench.txt.")
+
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME, defaults={'user_type': 'consumer'})
+        # Whatever engine the servers read sessions from; with signed cookies the key is the session itself
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        cookie = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+        results = {}
+        try:
+            for name in options['servers']:
+                results[name] = self.run(name, cookie, options)
+        finally:
+            session.delete()
+            user.delete()
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def run(self, name, cookie, options):
+        port = _free_port()
+        server = subprocess.Popen(
+            SERVERS[name](port, options['workers'], options['threads']),
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'kft_agent_network.settings')},
+            start_new_session=True,
+        )
+        try:
+            deadline = time.monotonic() + 30
+            while asyncio.run(_probe(port, options['path'], cookie, 1)) is None:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise CommandError(f'{name} server did not come up on port {port}.')
+                time.sleep(0.2)
+            idle_rss = _tree_rss_bytes(server.pid)
+            latencies, elapsed = asyncio.run(_load(port, options, cookie))
+            peak_rss = _tree_rss_bytes(server.pid)
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+
+        served = sorted(latency for latency in latencies if latency is not None)
+        result = {
+            'workers': options['workers'],
+            'slow_clients': options['slow_clients'],
+            'probes': len(latencies),
+            'served': len(served),
+            'failed': len(latencies) - len(served),
+            'requests_per_second': round(len(served) / elapsed, 1),
+            'p50_ms': round(statistics.median(served) * 1000, 1) if served else None,
+            'p95_ms': round(served[int(len(served) * 0.95) - 1] * 1000, 1) if served else None,
+            'rss_idle_mb': round(idle_rss / 2**20, 1),
+            'rss_loaded_mb': round(peak_rss / 2**20, 1),
+        }
+        self.stdout.write(self.style.SUCCESS(f'{name}: {result}'))
+        return result
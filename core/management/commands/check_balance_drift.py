@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.balances import drift
+
+class Command(BaseCommand):
+    help = 'Report consumers and merchants whose stored balance disagrees with their transaction history.'
+
+    def handle(self, *args, **kwargs):
+        drifted = 0
+        for profile, snapshot_balance in drift():
+            drifted += 1
+            self.stdout.write(
+                f'{profile.user.username}: profile balance {profile.balance}, '
+                f'history balance {snapshot_balance} (off by {profile.balance - snapshot_balance})'
+            )
+        if drifted:
+            raise CommandError(f'{drifted} balances have drifted from their transaction history.')
+        self.stdout.write(self.style.SUCCESS('All balances match their transaction history.'))
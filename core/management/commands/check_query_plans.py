@@ -0,0 +1,81 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from core.archive import oldest_archivable
+from core.balances import totals_query
+from core.models import ArchivedTransaction, Transaction
+from core.pagination import PAGE_SIZE, encode_cursor, filter_transactions, keyset_queryset
+
+# Plan lines that mean a table is read from start to end instead of through an index
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (?!CONSTANT ROW)(\w+)'),
+    'postgresql': re.compile(r'\bSeq Scan on (\w+)'),
+}
+
+
+def hot_queries(using):
+    """The Transaction queries issued by the history, balance, export and archive paths."""
+    transactions = Transaction.objects.using(using)
+    now = timezone.now()
+    user_id = 1
+    cursor = encode_cursor(Transaction(id=1, timestamp=now))
+    filtered, _ = filter_transactions(
+        transactions.filter(user_id=user_id),
+        {'date_from': (now - timedelta(days=30)).date().isoformat(), 'transaction_type': 'cash_in'},
+    )
+    history = transactions.filter(user_id=user_id)
+    return {
+        'history first page': keyset_queryset(history)[:PAGE_SIZE + 1],
+        'history later page': keyset_queryset(history, cursor)[:PAGE_SIZE + 1],
+        'history filtered by date and type': keyset_queryset(filtered)[:PAGE_SIZE + 1],
+        'balance totals for one user': transactions.filter(user_id=user_id).values('user_id').annotate(
+            **totals_query()
+        ).order_by(),
+        'snapshot rebuild totals': transactions.filter(
+            user_id__in=[1, 2, 3], transaction_type__in=['cash_in', 'cash_out', 'bill_payment']
+        ).values('user_id', 'transaction_type').annotate(total=Sum('amount')).order_by(),
+        'archivable transactions': oldest_archivable(now - timedelta(days=365), 1000, using),
+        'transaction by reference': transactions.filter(reference_id='REF'),
+        'archived history page': keyset_queryset(
+            ArchivedTransaction.objects.using(using).filter(user_id=user_id), cursor
+        )[:PAGE_SIZE + 1],
+    }
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot Transaction queries and fail if any of them falls back to a full table scan.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every plan, not just failures.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        connection = connections[using]
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f'Query plan checks are not supported on {connection.vendor}.')
+
+        failures = []
+        with transaction.atomic(using=using):
+            if connection.vendor == 'postgresql':
+                # Tiny tables make sequential scans look cheapest; only take one if no index applies
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, queryset in hot_queries(using).items():
+                plan = queryset.explain()
+                scanned = pattern.findall(plan)
+                if scanned:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f'{name}: full scan of {", ".join(sorted(set(scanned)))}'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'{name}: ok'))
+                if scanned or options['verbose_plans']:
+                    self.stdout.write('    ' + plan.replace('\n', '\n    '))
+
+        if failures:
+            raise CommandError(f'{len(failures)} hot queries fall back to a full scan.')
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.rebalance import RebalanceConflict, misplaced_users, move_user
+from core.sharding import shard_for
+
+class Command(BaseCommand):
+    help = (
+        'Move the rows of users whose shard changed, after a shard was appended to DB_SHARDS and migrated. '
+        'Each user is moved in its own transaction on the old and the new shard, so the command can be stopped '
+        'and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report which users would move where.')
+
+    def handle(self, *args, **options):
+        conflicts = 0
+        for alias in settings.DATABASE_SHARDS:
+            user_ids = misplaced_users(alias)
+            if not user_ids:
+                continue
+            if options['dry_run']:
+                for user_id in user_ids:
+                    self.stdout.write(f'User {user_id}: {alias} -> {shard_for(user_id)}')
+                continue
+
+            users = rows = 0
+            for user_id in user_ids:
+                try:
+                    rows += move_user(user_id, alias)
+                    users += 1
+                except RebalanceConflict as e:
+                    conflicts += 1
+                    self.stderr.write(str(e))
+            self.stdout.write(self.style.SUCCESS(f'Moved {rows} rows of {users} users off {alias}.'))
+
+        if conflicts:
+            raise CommandError(f'{conflicts} users were left in place; see above.')
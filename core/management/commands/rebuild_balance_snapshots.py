@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from core.balances import rebuild
+from core.models import User
+
+class Command(BaseCommand):
+    help = 'Rebuild balance snapshots from transaction history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only rebuild these users (default: everyone).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        user_ids = list(users.values_list('id', flat=True))
+
+        rebuilt = 0
+        batch_size = options['batch_size']
+        for start in range(0, len(user_ids), batch_size):
+            rebuilt += rebuild(user_ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} balance snapshots.'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.search import TARGETS, rebuild_index
+
+class Command(BaseCommand):
+    help = (
+        'Refill the SQLite full-text search tables from the product and service tables, e.g. after bulk '
+        'changes made without model saves. PostgreSQL indexes maintain themselves.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', help=f"Only rebuild these of {', '.join(TARGETS)} (default: all).")
+
+    def handle(self, *args, **options):
+        unknown = set(options['kinds']) - set(TARGETS)
+        if unknown:
+            raise CommandError(f"Unknown search targets: {', '.join(sorted(unknown))}.")
+        for kind in options['kinds'] or TARGETS:
+            indexed = rebuild_index(kind)
+            if connection.vendor == 'sqlite':
+                self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} {kind}.'))
+            else:
+                self.stdout.write(f'{kind}: {indexed} rows, indexed by the database itself.')
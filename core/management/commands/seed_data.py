@@ -0,0 +1,223 @@
+import random
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from core import catalog, search, sharding
+from core.models import (
+    AgentProfile, BalanceSnapshot, Bill, ConsumerProfile, MerchantProfile, Product, Service, Subscription, Transaction,
+    User,
+)
+
+# Share of each kind of posting, as the views make them:
+#   purchase: consumer cash_out, merchant cash_in          recharge: consumer cash_in
+#   agent_cash_in: consumer and agent cash_in              agent_cash_out: consumer and agent cash_out
+#   bill_payment: consumer and agent bill_payment
+POSTINGS = {'purchase': 0.5, 'agent_cash_in': 0.25, 'agent_cash_out': 0.1, 'bill_payment': 0.05, 'recharge': 0.1}
+
+# Postings per timestamp UPDATE, keeping its parameters under SQLite's 999 limit
+TIMESTAMP_CHUNK_SIZE = 150
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ba', 'de', 'fi', 'go', 'hu', 'ja', 'ze', 'po']
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the database with synthetic merchants, agents and consumers, their catalog and a transaction '
+        'history, using bulk inserts. Balances, snapshots and the search index are left consistent with the '
+        'history. Every seeded user can log in with --password. Used with bench_load.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--merchants', type=int, default=2000)
+        parser.add_argument('--agents', type=int, default=500)
+        parser.add_argument('--consumers', type=int, default=200000)
+        parser.add_argument('--transactions', type=int, default=2000000, help='Transaction rows to create, about.')
+        parser.add_argument('--products-per-merchant', type=int, default=5)
+        parser.add_argument('--bills', type=int, default=1000)
+        parser.add_argument('--days', type=int, default=365, help='Spread the history over this many past days.')
+        parser.add_argument('--prefix', default='seed', help='Usernames are <prefix>-<type>-<n>.')
+        parser.add_argument('--password', default='seed-password')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--random-seed', type=int, default=0, help='The same seed gives the same data.')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.random = random.Random(options['random_seed'])
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}-').exists():
+            raise CommandError(f'Users named {prefix}-... already exist; seed with another --prefix.')
+        if not (options['merchants'] and options['agents'] and options['consumers']):
+            raise CommandError('Seeding needs at least one merchant, agent and consumer.')
+        started = time.perf_counter()
+
+        # One hash for everyone: hashing each password would take longer than the rest of the seeding
+        password = make_password(options['password'])
+        merchants = self.create_users(prefix, 'merchant', options['merchants'], password)
+        agents = self.create_users(prefix, 'agent', options['agents'], password)
+        consumers = self.create_users(prefix, 'consumer', options['consumers'], password)
+        self.stdout.write(f'Created {len(merchants) + len(agents) + len(consumers)} users.')
+
+        products, services = self.create_catalog(merchants, options['products_per_merchant'])
+        self.create_bills(options['bills'])
+        totals = self.create_history(merchants, agents, consumers, products, options['transactions'], options['days'])
+        self.create_profiles(merchants, agents, consumers, totals)
+        self.create_subscriptions(consumers, services)
+
+        for kind in search.TARGETS:
+            search.rebuild_index(kind)
+        # The bulk inserts sent no signals, so cached catalog listings must be told about the new merchants
+        catalog.bump('products', catalog.INDEX)
+        catalog.bump('services', catalog.INDEX)
+        self.stdout.write(self.style.SUCCESS(f'Seeded the database in {time.perf_counter() - started:.0f} s.'))
+
+    def bulk_create(self, manager, rows):
+        for start in range(0, len(rows), self.batch_size):
+            manager.bulk_create(rows[start:start + self.batch_size])
+
+    def create_users(self, prefix, user_type, count, password):
+        users = [User(username=f'{prefix}-{user_type}-{n}', user_type=user_type, password=password) for n in range(count)]
+        self.bulk_create(User.objects, users)
+        return [user.id for user in users]
+
+    def word(self):
+        return ''.join(self.random.choices(SYLLABLES, k=self.random.randint(2, 4)))
+
+    def price(self, low=100, high=20000):
+        return Decimal(self.random.randint(low, high)) / 100
+
+    def create_catalog(self, merchants, per_merchant):
+        products = [
+            Product(
+                merchant_id=merchant_id,
+                name=f'{self.word()} {self.word()}'.title(),
+                description=' '.join(self.word() for _ in range(12)),
+                price=self.price(),
+            )
+            for merchant_id in merchants
+            for _ in range(per_merchant)
+        ]
+        self.bulk_create(Product.objects, products)
+        services = [
+            Service(merchant_id=merchant_id, name=f'{self.word()} plan'.title(), description=self.word(), subscription_fee=self.price())
+            for merchant_id in merchants
+        ]
+        self.bulk_create(Service.objects, services)
+        self.stdout.write(f'Created {len(products)} products and {len(services)} services.')
+        return [(product.merchant_id, product.price) for product in products], [service.id for service in services]
+
+    def create_bills(self, count):
+        today = timezone.now().date()
+        bills = [
+            Bill(
+                bill_type=self.random.choice(['electricity', 'water', 'internet', 'phone']),
+                account_number=str(self.random.randint(10 ** 9, 10 ** 10 - 1)),
+                amount_due=self.price(),
+                due_date=today + timedelta(days=self.random.randint(-30, 60)),
+            )
+            for _ in range(count)
+        ]
+        self.bulk_create(Bill.objects, bills)
+
+    def create_history(self, merchants, agents, consumers, products, count, days):
+        """
+        Create about count Transaction rows, as postings made in time order over
+        the past days. Returns {user_id: {transaction_type: total}} to set the
+        balances and snapshots from.
+        """
+        totals = defaultdict(lambda: defaultdict(Decimal))
+        balances = defaultdict(Decimal)
+        kinds, weights = list(POSTINGS), list(POSTINGS.values())
+        now = timezone.now()
+        step = timedelta(days=days) / max(count, 1)
+        rows, times, created = [], [], 0
+
+        def row(transaction_type, user_id, amount, at):
+            totals[user_id][transaction_type] += amount
+            rows.append(Transaction(transaction_type=transaction_type, user_id=user_id, amount=amount, status='completed'))
+            times.append(at)
+
+        while created + len(rows) < count:
+            at = now - step * (count - created - len(rows))
+            consumer = self.random.choice(consumers)
+            kind = self.random.choices(kinds, weights)[0]
+            merchant, amount = self.random.choice(products) if kind == 'purchase' else (None, self.price(500, 50000))
+            if kind in ('purchase', 'agent_cash_out', 'bill_payment') and balances[consumer] < amount:
+                # Consumers cannot overdraw; they top up at an agent instead
+                kind = 'agent_cash_in'
+            if kind == 'purchase':
+                row('cash_out', consumer, amount, at)
+                row('cash_in', merchant, amount, at)
+                balances[consumer] -= amount
+            elif kind == 'recharge':
+                row('cash_in', consumer, amount, at)
+                balances[consumer] += amount
+            else:
+                transaction_type = {'agent_cash_in': 'cash_in', 'agent_cash_out': 'cash_out', 'bill_payment': 'bill_payment'}[kind]
+                row(transaction_type, consumer, amount, at)
+                row(transaction_type, self.random.choice(agents), amount, at)
+                balances[consumer] += amount if kind == 'agent_cash_in' else -amount
+
+            if len(rows) >= self.batch_size:
+                self.insert_history(rows, times)
+                created += len(rows)
+                rows, times = [], []
+        self.insert_history(rows, times)
+        created += len(rows)
+        self.stdout.write(f'Created {created} transactions.')
+        return totals
+
+    def insert_history(self, rows, times):
+        with sharding.atomic(settings.DATABASE_SHARDS):
+            Transaction.objects.bulk_create(rows, batch_size=self.batch_size)
+            # bulk_create stamps the auto_now_add timestamp with the current time; the history is spread over the past
+            ids_at = defaultdict(lambda: defaultdict(list))
+            for row, at in zip(rows, times):
+                ids_at[sharding.shard_for(row.user_id)][at].append(row.id)
+            for alias, postings in ids_at.items():
+                postings = list(postings.items())
+                for start in range(0, len(postings), TIMESTAMP_CHUNK_SIZE):
+                    chunk = postings[start:start + TIMESTAMP_CHUNK_SIZE]
+                    Transaction.objects.on_shard(alias).filter(id__in=[id for _, ids in chunk for id in ids]).update(
+                        timestamp=Case(*[When(id__in=ids, then=Value(at)) for at, ids in chunk]),
+                    )
+
+    def create_profiles(self, merchants, agents, consumers, totals):
+        def balance(user_id):
+            return totals[user_id]['cash_in'] - totals[user_id]['cash_out'] - totals[user_id]['bill_payment']
+
+        self.bulk_create(MerchantProfile.objects, [
+            MerchantProfile(user_id=user_id, store_name=f'{self.word()} store'.title(), balance=balance(user_id))
+            for user_id in merchants
+        ])
+        self.bulk_create(AgentProfile.objects, [
+            AgentProfile(user_id=user_id, agency_name=f'{self.word()} agency'.title()) for user_id in agents
+        ])
+        self.bulk_create(ConsumerProfile.objects, [
+            ConsumerProfile(user_id=user_id, address=f'{self.random.randint(1, 999)} {self.word()} street'.title(), balance=balance(user_id))
+            for user_id in consumers
+        ])
+        self.bulk_create(BalanceSnapshot.objects, [
+            BalanceSnapshot(
+                user_id=user_id,
+                cash_in=totals[user_id]['cash_in'],
+                cash_out=totals[user_id]['cash_out'],
+                bill_payment=totals[user_id]['bill_payment'],
+            )
+            for user_id in [*merchants, *agents, *consumers]
+        ])
+
+    def create_subscriptions(self, consumers, services):
+        # One consumer in ten subscribes to a service
+        subscriptions = [
+            Subscription(consumer_id=consumer_id, service_id=self.random.choice(services))
+            for consumer_id in self.random.sample(consumers, len(consumers) // 10)
+        ]
+        self.bulk_create(Subscription.objects, subscriptions)
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+
+from core.models import SlowQuery
+
+SORT_KEYS = {
+    'total': lambda entry: entry.total_ms,
+    'count': lambda entry: entry.count,
+    'max': lambda entry: entry.max_ms,
+    'p95': lambda entry: entry.percentile(95) or 0,
+}
+
+class Command(BaseCommand):
+    help = (
+        'List the statement shapes in the slow query log, the worst first, with their counts, percentiles, '
+        'originating view and call site. With --plans, also show the latest example and its EXPLAIN plan.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total', help='Order by total time (default), count, max or p95.')
+        parser.add_argument('--limit', type=int, default=20, help='Number of shapes to list (default 20).')
+        parser.add_argument('--view', help='Only shapes last seen in this view.')
+        parser.add_argument('--plans', action='store_true', help='Show each shape\'s latest example and plan.')
+        parser.add_argument('--reset', action='store_true', help='Empty the log instead of listing it.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            deleted, _ = SlowQuery.objects.all().delete()
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} slow query shapes.'))
+            return
+
+        entries = SlowQuery.objects.all()
+        if options['view']:
+            entries = entries.filter(view_name=options['view'])
+        entries = sorted(entries, key=SORT_KEYS[options['sort']], reverse=True)[:options['limit']]
+        if not entries:
+            self.stdout.write('No slow queries logged.')
+            return
+
+        for entry in entries:
+            self.stdout.write(self.style.WARNING(
+                f'{entry.count} x, total {entry.total_ms:.0f} ms, p50 {entry.percentile(50):.1f} / '
+                f'p95 {entry.percentile(95):.1f} / p99 {entry.percentile(99):.1f} / max {entry.max_ms:.1f} ms '
+                f'on {entry.database}'
+            ))
+            self.stdout.write(f'  view: {entry.view_name or "-"}, call site: {entry.call_site or "-"}, last seen {entry.last_seen:%Y-%m-%d %H:%M:%S}')
+            self.stdout.write(f'  {entry.shape}')
+            if options['plans']:
+                self.stdout.write(f'  example: {entry.example_sql}')
+                if entry.example_params:
+                    self.stdout.write(f'  params: {entry.example_params}')
+                self.stdout.write('  plan:')
+                for line in (entry.plan or 'not captured').splitlines():
+                    self.stdout.write(f'    {line}')
+            self.stdout.write('')
@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import User
+from core.stress import DEFAULT_MIX, stress
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent cash-ins, cash-outs, bill payments, recharges and purchases at the views from threads or '
+        'processes, as freshly created <prefix>-... users, then check that no money was lost or made up and that '
+        'every balance is backed by its transactions. Prints the throughput as JSON. Run it against a scratch '
+        'database: the users and their postings are left in place.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--postings', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=16, help='Postings in flight at once.')
+        parser.add_argument('--processes', action='store_true', help='Use worker processes rather than threads.')
+        parser.add_argument('--consumers', type=int, default=100)
+        parser.add_argument('--merchants', type=int, default=5)
+        parser.add_argument('--agents', type=int, default=10)
+        parser.add_argument(
+            '--mix', default=','.join(f'{kind}={weight}' for kind, weight in DEFAULT_MIX.items()),
+            help='Weight of each kind of posting.',
+        )
+        parser.add_argument('--prefix', default='stress', help='Usernames are <prefix>-<role>-<n>.')
+        parser.add_argument('--random-seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}-').exists():
+            raise CommandError(f'Users named {prefix}-... already exist; run with another --prefix.')
+        mix = {}
+        for part in options['mix'].split(','):
+            kind, _, weight = part.partition('=')
+            if kind.strip() not in DEFAULT_MIX:
+                raise CommandError(f"Unknown posting in --mix: {kind.strip()}. Postings are {', '.join(DEFAULT_MIX)}.")
+            try:
+                mix[kind.strip()] = float(weight)
+            except ValueError:
+                raise CommandError(f'Not a number in --mix: {part}')
+
+        _, _, summary, problems = stress(
+            prefix,
+            postings=options['postings'],
+            workers=options['workers'],
+            processes=options['processes'],
+            consumers=options['consumers'],
+            merchants=options['merchants'],
+            agents=options['agents'],
+            mix=mix,
+            seed=options['random_seed'],
+        )
+        self.stdout.write(json.dumps(summary, indent=2))
+        for problem in problems:
+            self.stderr.write(problem)
+        if problems or summary['errors']:
+            raise CommandError(f"{len(problems)} ledger problems and {summary['errors']} server errors; see above.")
+        self.stdout.write(self.style.SUCCESS('The ledger is sound.'))
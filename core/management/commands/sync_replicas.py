@@ -0,0 +1,42 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+class Command(BaseCommand):
+    help = (
+        'Copy the primary SQLite database onto each replica file in DB_REPLICAS, standing in for replication '
+        'when trying replica routing locally. With --every, keeps copying, so the replicas lag the primary by '
+        'up to that many seconds. Real replicas (PostgreSQL) are kept up to date by the database itself.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='Repeat the copy every this many seconds until interrupted.')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas are configured; list their files in DB_REPLICAS.')
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('Only SQLite replicas are synced by this command.')
+
+        while True:
+            self.sync()
+            if not options['every']:
+                return
+            time.sleep(options['every'])
+
+    def sync(self):
+        source = sqlite3.connect(connections['default'].settings_dict['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+                try:
+                    # The backup API copies a consistent snapshot even while the primary is being written
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(self.style.SUCCESS(f'Synced {alias} from the primary.'))
+        finally:
+            source.close()
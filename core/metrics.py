@@ -0,0 +1,419 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name: (type, help, buckets); every metric is labelled by view, the request counter also by method and status
+METRICS = {
+    'http_requests_total': ('counter', 'Requests served.', None),
+    'http_request_duration_seconds': ('histogram', 'Time to produce the response.', LATENCY_BUCKETS),
+    'db_queries_per_request': ('histogram', 'Database queries run by a request.', QUERY_BUCKETS),
+    'db_query_duration_seconds': ('histogram', 'Time a request spent in database queries.', LATENCY_BUCKETS),
+    'template_render_duration_seconds': ('histogram', 'Time a request spent rendering templates.', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Size of the response body.', SIZE_BUCKETS),
+    'query_budget_exceeded_total': ('counter', 'Requests that ran more than QUERY_BUDGET queries.', None),
+}
+
+# Processes write their metrics to METRICS_DIR this often, for the /metrics of any of them to report. A thread
+# of their own does it, so no request waits on the file
+DUMP_INTERVAL = 1
+
+# The file in METRICS_DIR that the metrics of exited processes are added to, so their counts stay in the totals
+# without a file for every process ever started; the lock serialises the processes adding to it
+EXITED_FILE = 'exited.json'
+EXITED_LOCK = 'exited.lock'
+_PROCESS_FILE = re.compile(r'^(\d+)\.json$')
+
+# Statements differing only in their literals or in the length of a placeholder list, as in IN (%s, %s, ...),
+# have the same shape
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+
+
+def query_shape(sql):
+    return _PLACEHOLDER_LIST.sub('%s, ...', _LITERAL.sub('%s', sql))
+
+
+class _Registry:
+    # The metrics of this process: counters as {(name, labels): value}, histograms as {(name, labels): [counts, sum]}
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        # Whether anything was recorded since the last dump
+        self.changed = False
+        # The process this registry last wrote a file for; a forked worker starts with its parent's
+        self.pid = None
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+            self.changed = True
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self.lock:
+            counts, total = self.histograms.get((name, labels)) or ([0] * (len(buckets) + 1), 0)
+            counts[next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            self.histograms[name, labels] = [counts, total + value]
+            self.changed = True
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, counts[:], total] for (name, labels), (counts, total) in self.histograms.items()],
+            }
+
+    def dump(self, force=False):
+        # Replaces this process's file in METRICS_DIR
+        if not settings.METRICS_DIR:
+            return
+        if self.pid != os.getpid():
+            # The first dump of this process: fold in what processes that have exited left behind, and this
+            # process's own counts when it exits
+            self.pid = os.getpid()
+            prune()
+            atexit.register(self.retire)
+        if not force and not self.changed:
+            return
+        self.changed = False
+        path = os.path.join(settings.METRICS_DIR, f'{self.pid}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def retire(self):
+        # At exit, this process's final counts move to EXITED_FILE. A worker killed before it gets here is
+        # folded in by the next process to start instead.
+        if self.pid != os.getpid():
+            return
+        self.dump(force=True)
+        _retire([f'{self.pid}.json'])
+        self.pid = None
+
+
+registry = _Registry()
+_dumper = None
+_dumper_lock = threading.Lock()
+
+
+def _start_dumper():
+    global _dumper
+    if _dumper is not None and _dumper.is_alive():
+        return
+    with _dumper_lock:
+        if _dumper is None or not _dumper.is_alive():
+            _dumper = threading.Thread(target=_dump_forever, name='metrics-dumper', daemon=True)
+            _dumper.start()
+
+
+def _dump_forever():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        try:
+            registry.dump()
+        except OSError:
+            logger.exception('Could not write metrics to %s', settings.METRICS_DIR)
+
+
+class RequestStats:
+    # What one request spent; shared with the worker threads running its queries and templates
+    def __init__(self, request):
+        self.request = request
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.shapes = Counter()
+        self.template_seconds = 0.0
+        self.rendering = 0
+
+
+_stats = ContextVar('request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - start
+        stats.shapes[query_shape(sql)] += 1
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    # Every connection, in every thread, reports its queries to the request it runs them for
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        stats = _stats.get()
+        if stats is None:
+            return self.template.render(context, request)
+        # Templates rendered while rendering another one are already timed with it
+        stats.rendering += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            stats.rendering -= 1
+            if not stats.rendering:
+                stats.template_seconds += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, adding the time spent rendering to the request's metrics."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+def _view_name(request):
+    # Labels stay few: unresolved paths (404s, scanners) are counted together
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else '<unresolved>'
+
+
+def current_view():
+    # The view of the request whose code is running, for anything recorded on its behalf
+    stats = _stats.get()
+    return _view_name(stats.request) if stats is not None else ''
+
+
+def _observe_size(view, response):
+    if not response.streaming:
+        registry.observe('http_response_size_bytes', view, len(response.content))
+    elif response.is_async:
+        response.streaming_content = _acounted(view, response.streaming_content)
+    else:
+        response.streaming_content = _counted(view, response.streaming_content)
+
+
+def _counted(view, chunks):
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        registry.observe('http_response_size_bytes', view, size)
+
+
+async def _acounted(view, chunks):
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        registry.observe('http_response_size_bytes', view, size)
+
+
+def _record(request, response, stats, seconds):
+    view = (('view', _view_name(request)),)
+    status = str(response.status_code) if response is not None else '500'
+    registry.inc('http_requests_total', view + (('method', request.method), ('status', status)))
+    registry.observe('http_request_duration_seconds', view, seconds)
+    registry.observe('db_queries_per_request', view, stats.queries)
+    registry.observe('db_query_duration_seconds', view, stats.query_seconds)
+    registry.observe('template_render_duration_seconds', view, stats.template_seconds)
+    if response is not None:
+        _observe_size(view, response)
+
+    if stats.queries > settings.QUERY_BUDGET:
+        registry.inc('query_budget_exceeded_total', view)
+        # The same statement run over and over is the usual N+1 pattern: one query per row of an earlier one
+        repeated = [(count, sql) for sql, count in stats.shapes.most_common(5) if count > 1]
+        logger.warning(
+            '%s %s ran %d queries (budget %d) in %.1f ms. Repeated:%s',
+            request.method, request.path, stats.queries, settings.QUERY_BUDGET, stats.query_seconds * 1000,
+            ''.join(f'\n  {count} x {sql}' for count, sql in repeated) or ' none',
+        )
+    if settings.METRICS_DIR:
+        _start_dumper()
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Time each request and count its database queries, query time, template
+    render time and response size, per view, for the /metrics endpoint. A
+    request running more than QUERY_BUDGET queries is logged with the
+    statements it repeated.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            stats = RequestStats(request)
+            token = _stats.set(stats)
+            start = time.perf_counter()
+            response = None
+            try:
+                response = await get_response(request)
+            finally:
+                _stats.reset(token)
+                _record(request, response, stats, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            stats = RequestStats(request)
+            token = _stats.set(stats)
+            start = time.perf_counter()
+            response = None
+            try:
+                response = get_response(request)
+            finally:
+                _stats.reset(token)
+                _record(request, response, stats, time.perf_counter() - start)
+            return response
+    return middleware
+
+
+def _read(name):
+    try:
+        with open(os.path.join(settings.METRICS_DIR, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _running(pid):
+    # Signal 0 only checks that the process exists; one of another user's is refused but running
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(snapshots):
+    counters = defaultdict(float)
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            counters[name, tuple(map(tuple, labels))] += value
+        for name, labels, counts, total in snapshot['histograms']:
+            key = name, tuple(map(tuple, labels))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+    return counters, histograms
+
+
+def _retire(names):
+    # Add the snapshots in the named files of METRICS_DIR to EXITED_FILE and remove them
+    with open(os.path.join(settings.METRICS_DIR, EXITED_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another process may have retired some of them while this one waited for the lock
+        snapshots = [snapshot for snapshot in map(_read, names) if snapshot is not None]
+        if not snapshots:
+            return
+        exited = _read(EXITED_FILE)
+        counters, histograms = _merge(snapshots + ([exited] if exited else []))
+        path = os.path.join(settings.METRICS_DIR, EXITED_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in histograms.items()],
+            }, f)
+        os.replace(f'{path}.tmp', path)
+        for name in names:
+            try:
+                os.remove(os.path.join(settings.METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def prune():
+    """
+    Fold the metrics files of processes that are no longer running into
+    EXITED_FILE. Runs when a process first writes its metrics, which also
+    folds in a file an earlier process with the same PID left behind.
+    """
+    stale = []
+    for name in os.listdir(settings.METRICS_DIR):
+        match = _PROCESS_FILE.match(name)
+        if match and (int(match[1]) == os.getpid() or not _running(int(match[1]))):
+            stale.append(name)
+    if stale:
+        _retire(stale)
+
+
+def _collect():
+    # This process's metrics plus those the other processes last wrote to METRICS_DIR, and the exited ones'
+    snapshots = [registry.snapshot()]
+    if settings.METRICS_DIR:
+        own = f'{os.getpid()}.json'
+        for name in os.listdir(settings.METRICS_DIR):
+            if name.endswith('.json') and name != own:
+                snapshot = _read(name)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+    return _merge(snapshots)
+
+
+def _labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def exposition():
+    """All metrics in the Prometheus text format."""
+    counters, histograms = _collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+            continue
+        for (metric, labels), (counts, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines += [f'{name}_sum{_labels(labels)} {_number(total)}', f'{name}_count{_labels(labels)} {cumulative}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def build_snapshots(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    Transaction = apps.get_model('core', 'Transaction')
+    BalanceSnapshot = apps.get_model('core', 'BalanceSnapshot')
+
+    snapshots = {user_id: BalanceSnapshot(user_id=user_id) for user_id in User.objects.values_list('id', flat=True)}
+    grouped = Transaction.objects.values('user_id', 'transaction_type').annotate(total=Sum('amount')).order_by()
+    for row in grouped:
+        if row['transaction_type'] in ('cash_in', 'cash_out', 'bill_payment'):
+            setattr(snapshots[row['user_id']], row['transaction_type'], row['total'])
+    BalanceSnapshot.objects.bulk_create(snapshots.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_merchantprofile_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cash_in', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cash_out', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('bill_payment', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshot', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(build_snapshots, migrations.RunPython.noop),
+    ]
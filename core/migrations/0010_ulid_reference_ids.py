@@ -0,0 +1,60 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:23
+
+import core.references
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def rewrite_references(apps, schema_editor):
+    # Give existing rows a ULID derived from their own timestamp and keep the old reference alongside it
+    for model_name in ('Transaction', 'ArchivedTransaction'):
+        model = apps.get_model('core', model_name)
+        last_id = 0
+        while True:
+            batch = list(model.objects.filter(id__gt=last_id).order_by('id').only('id', 'timestamp', 'reference_id')[:BATCH_SIZE])
+            if not batch:
+                break
+            for row in batch:
+                row.legacy_reference_id = row.reference_id
+                row.reference_id = core.references.reference_at(int(row.timestamp.timestamp() * 1000))
+            model.objects.bulk_update(batch, ['reference_id', 'legacy_reference_id'])
+            last_id = batch[-1].id
+
+
+def restore_references(apps, schema_editor):
+    for model_name in ('Transaction', 'ArchivedTransaction'):
+        model = apps.get_model('core', model_name)
+        for row in model.objects.exclude(legacy_reference_id='').only('id', 'legacy_reference_id').iterator():
+            model.objects.filter(id=row.id).update(reference_id=row.legacy_reference_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedtransaction',
+            name='legacy_reference_id',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='legacy_reference_id',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.RunPython(rewrite_references, restore_references),
+        migrations.AlterField(
+            model_name='archivedtransaction',
+            name='reference_id',
+            field=models.CharField(max_length=26, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='reference_id',
+            field=models.CharField(default=core.references.new_reference, max_length=26, unique=True),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.1 on 2026-10-18 18:05
+
+import core.money
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Round
+
+# (model, field, has default): every money column moved to integer cents
+MONEY_FIELDS = [
+    ('consumerprofile', 'balance', True),
+    ('merchantprofile', 'balance', True),
+    ('transaction', 'amount', False),
+    ('archivedtransaction', 'amount', False),
+    ('balancesnapshot', 'cash_in', True),
+    ('balancesnapshot', 'cash_out', True),
+    ('balancesnapshot', 'bill_payment', True),
+    ('bill', 'amount_due', False),
+    ('product', 'price', False),
+    ('service', 'subscription_fee', False),
+]
+
+# Wide enough to hold every amount times 100 while the column is still a decimal
+WIDE_DIGITS = 20
+
+
+def decimal_field(has_default):
+    if has_default:
+        return models.DecimalField(decimal_places=2, default=0, max_digits=WIDE_DIGITS)
+    return models.DecimalField(decimal_places=2, max_digits=WIDE_DIGITS)
+
+
+def money_field(has_default):
+    return core.money.MoneyField(default=0) if has_default else core.money.MoneyField()
+
+
+def to_minor_units(apps, schema_editor):
+    # One UPDATE per column, done by the database: values are exact two-place decimals, so this loses nothing
+    for model_name, field, _ in MONEY_FIELDS:
+        model = apps.get_model('core', model_name)
+        model.objects.update(**{field: Round(F(field) * 100)})
+
+
+def from_minor_units(apps, schema_editor):
+    for model_name, field, _ in MONEY_FIELDS:
+        model = apps.get_model('core', model_name)
+        model.objects.update(**{field: Round(F(field) * Value(Decimal('0.01')), 2)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_ulid_reference_ids'),
+    ]
+
+    operations = [
+        *[
+            migrations.AlterField(model_name=model_name, name=field, field=decimal_field(has_default))
+            for model_name, field, has_default in MONEY_FIELDS
+        ],
+        migrations.RunPython(to_minor_units, from_minor_units),
+        *[
+            migrations.AlterField(model_name=model_name, name=field, field=money_field(has_default))
+            for model_name, field, has_default in MONEY_FIELDS
+        ],
+    ]
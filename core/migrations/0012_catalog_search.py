@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-18 19:10
+
+from django.db import migrations
+
+# (model table, SQLite FTS5 table, PostgreSQL GIN index)
+SEARCHABLE = [
+    ('core_product', 'core_product_search', 'core_product_search_idx'),
+    ('core_service', 'core_service_search', 'core_service_search_idx'),
+]
+
+# Must match core.search.PG_DOCUMENT, or queries cannot use the index
+PG_DOCUMENT = "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))"
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table, fts_table, index in SEARCHABLE:
+        if vendor == 'sqlite':
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {fts_table} USING fts5(name, description, tokenize='porter unicode61')"
+            )
+            schema_editor.execute(
+                f"INSERT INTO {fts_table} (rowid, name, description) "
+                f"SELECT id, name, coalesce(description, '') FROM {table}"
+            )
+        elif vendor == 'postgresql':
+            schema_editor.execute(f'CREATE INDEX {index} ON {table} USING GIN ({PG_DOCUMENT})')
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table, fts_table, index in SEARCHABLE:
+        if vendor == 'sqlite':
+            schema_editor.execute(f'DROP TABLE IF EXISTS {fts_table}')
+        elif vendor == 'postgresql':
+            schema_editor.execute(f'DROP INDEX IF EXISTS {index}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_money_minor_units'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_request_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shape_hash', models.CharField(max_length=40, unique=True)),
+                ('shape', models.TextField()),
+                ('database', models.CharField(max_length=100)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('total_ms', models.FloatField(default=0)),
+                ('max_ms', models.FloatField(default=0)),
+                ('recent_ms', models.JSONField(default=list)),
+                ('example_sql', models.TextField()),
+                ('example_params', models.TextField(blank=True)),
+                ('plan', models.TextField(blank=True)),
+                ('view_name', models.CharField(blank=True, max_length=255)),
+                ('call_site', models.CharField(blank=True, max_length=255)),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+                ('last_seen', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['-total_ms'],
+            },
+        ),
+    ]
@@ -1,8 +1,14 @@
+import math
+
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .money import MoneyField
+from .references import new_reference
+from .sharding import ShardedManager
+
 # User model with user_type to differentiate roles
 class User(AbstractUser):
     USER_TYPE_CHOICES = [
@@ -33,17 +39,22 @@ class AgentProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='agent_profile')
     agency_name = models.CharField(max_length=255)
 
-# ConsumerProfile model
+# ConsumerProfile model; sharded by user, like the other models with a SHARD_KEY (see core.sharding).
+# Their foreign keys to rows on the primary have no DB constraint, as those rows may be on another database
 class ConsumerProfile(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='consumer_profile')
+    SHARD_KEY = 'user_id'
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='consumer_profile', db_constraint=False)
     address = models.TextField()
-    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)  # Add balance field
+    balance = MoneyField(default=0)  # Stored in cents
+
+    objects = ShardedManager()
 
 # MerchantProfile model
 class MerchantProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='merchant_profile')
     store_name = models.CharField(max_length=255)
-    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)  # Add balance field
+    balance = MoneyField(default=0)  # Stored in cents
 
 # Transaction model
 class Transaction(models.Model):
@@ -52,32 +63,153 @@ class Transaction(models.Model):
         ('cash_out', 'Cash Out'),
         ('bill_payment', 'Bill Payment'),
     ]
+    SHARD_KEY = 'user_id'
+
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE_CHOICES)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transactions')
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transactions', db_constraint=False)
+    amount = MoneyField()
     timestamp = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, default='pending')
-    reference_id = models.CharField(max_length=100, unique=True)
+    reference_id = models.CharField(max_length=26, unique=True, default=new_reference)  # Time-ordered ULID
+    legacy_reference_id = models.CharField(max_length=100, blank=True, default='')  # Pre-ULID reference of migrated rows
+
+    objects = ShardedManager()
+
+    class Meta:
+        indexes = [
+            # History pages: a user's transactions in time order
+            models.Index(fields=['user', 'timestamp'], name='transaction_user_time_idx'),
+            # Per-type totals; amount is included so the sums are answered from the index alone
+            models.Index(fields=['user', 'transaction_type', 'amount'], name='transaction_user_type_idx'),
+            # Status sweeps over a time range, e.g. archiving completed transactions
+            models.Index(fields=['status', 'timestamp'], name='transaction_status_time_idx'),
+        ]
+
+# ArchivedTransaction model: completed transactions moved out of the hot table by core.archive
+class ArchivedTransaction(models.Model):
+    SHARD_KEY = 'user_id'
+
+    id = models.BigIntegerField(primary_key=True)  # Keeps the original Transaction id
+    transaction_type = models.CharField(max_length=20, choices=Transaction.TRANSACTION_TYPE_CHOICES)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_transactions', db_constraint=False)
+    amount = MoneyField()
+    timestamp = models.DateTimeField()
+    status = models.CharField(max_length=20)
+    reference_id = models.CharField(max_length=26, unique=True)
+    legacy_reference_id = models.CharField(max_length=100, blank=True, default='')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'timestamp'], name='archived_user_time_idx'),
+            models.Index(fields=['user', 'transaction_type', 'amount'], name='archived_user_type_idx'),
+        ]
+
+# BalanceSnapshot model: running totals per transaction type, kept up to date as transactions are posted
+class BalanceSnapshot(models.Model):
+    SHARD_KEY = 'user_id'
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='balance_snapshot', db_constraint=False)
+    cash_in = MoneyField(default=0)
+    cash_out = MoneyField(default=0)
+    bill_payment = MoneyField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShardedManager()
+
+    @property
+    def balance(self):
+        return self.cash_in - self.cash_out - self.bill_payment
+
+# IdempotencyKey model: the stored outcome of a money-moving request, replayed when the client retries it
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=100)
+    request_fingerprint = models.CharField(max_length=255)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    location = models.CharField(max_length=255, blank=True)
+    content = models.BinaryField(default=b'')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key_per_user'),
+        ]
+
+# A request run under the profiler on a staff member's request; the profile itself is a file in PROFILE_DIR
+class RequestProfile(models.Model):
+    PROFILERS = [
+        ('sample', 'Sampling'),
+        ('cprofile', 'cProfile'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='request_profiles')
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    view_name = models.CharField(max_length=255, blank=True)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    profiler = models.CharField(max_length=10, choices=PROFILERS)
+    duration_ms = models.FloatField()
+    file_name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+# One shape of statement (see core.slow_queries) that ran slower than SLOW_QUERY_MS, with the
+# latest example of it, its plan and where it came from
+class SlowQuery(models.Model):
+    shape_hash = models.CharField(max_length=40, unique=True)
+    shape = models.TextField()
+    database = models.CharField(max_length=100)
+    count = models.PositiveBigIntegerField(default=0)
+    total_ms = models.FloatField(default=0)
+    max_ms = models.FloatField(default=0)
+    recent_ms = models.JSONField(default=list)  # Durations of the latest SLOW_QUERY_SAMPLES occurrences
+    example_sql = models.TextField()
+    example_params = models.TextField(blank=True)
+    plan = models.TextField(blank=True)
+    view_name = models.CharField(max_length=255, blank=True)
+    call_site = models.CharField(max_length=255, blank=True)
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-total_ms']
+
+    def percentile(self, p):
+        # Nearest-rank percentile of the recent durations
+        durations = sorted(self.recent_ms)
+        if not durations:
+            return None
+        return durations[min(len(durations) - 1, max(0, math.ceil(p / 100 * len(durations)) - 1))]
 
 # Bill model
 class Bill(models.Model):
     bill_type = models.CharField(max_length=50)
     account_number = models.CharField(max_length=50)
-    amount_due = models.DecimalField(max_digits=10, decimal_places=2)
+    amount_due = MoneyField()
     due_date = models.DateField()
 
-# BillPayment model
+# BillPayment model; stored next to its transaction, which must be one of the payer's
 class BillPayment(models.Model):
+    SHARD_KEY = 'paid_by_id'
+
     transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='bill_payment')
-    bill = models.ForeignKey(Bill, on_delete=models.CASCADE, related_name='bill_payments')
-    paid_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bill_payments')
+    bill = models.ForeignKey(Bill, on_delete=models.CASCADE, related_name='bill_payments', db_constraint=False)
+    paid_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bill_payments', db_constraint=False)
+
+    objects = ShardedManager()
 
 # Product model
 class Product(models.Model):
     merchant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='products')
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
-    price = models.DecimalField(max_digits=10, decimal_places=2)
+    price = MoneyField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -86,18 +218,22 @@ class Service(models.Model):
     merchant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='services')
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
-    subscription_fee = models.DecimalField(max_digits=10, decimal_places=2)
+    subscription_fee = MoneyField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
 # Subscription model
 class Subscription(models.Model):
-    consumer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='subscriptions')
-    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='subscriptions')
+    SHARD_KEY = 'consumer_id'
+
+    consumer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='subscriptions', db_constraint=False)
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='subscriptions', db_constraint=False)
     start_date = models.DateField(auto_now_add=True)
     end_date = models.DateField(blank=True, null=True)
     is_active = models.BooleanField(default=True)
 
+    objects = ShardedManager()
+
 @receiver(post_save, sender=User)
 def create_user_profiles(sender, instance, created, **kwargs):
     if created:
@@ -107,3 +243,11 @@ def create_user_profiles(sender, instance, created, **kwargs):
             MerchantProfile.objects.create(user=instance)
         elif instance.user_type == 'agent':
             AgentProfile.objects.create(user=instance)
+        BalanceSnapshot.objects.create(user=instance)
+
+@receiver(post_save, sender=Transaction)
+def add_transaction_to_snapshot(sender, instance, created, **kwargs):
+    # Bulk postings from core.ledger update snapshots themselves; this covers rows saved one at a time
+    if created:
+        from .balances import apply_entries
+        apply_entries([instance])
@@ -0,0 +1,122 @@
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django import forms
+from django.core import validators
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.utils.functional import cached_property
+
+DECIMAL_PLACES = 2
+# A BigIntegerField holds up to 9,223,372,036,854,775,807 minor units, so 18 digits always fit
+MAX_DIGITS = 18
+
+
+# The range of the BigIntegerField column, in cents
+MAX_MINOR_UNITS = 2 ** 63 - 1
+
+_amount_validator = validators.DecimalValidator(MAX_DIGITS, DECIMAL_PLACES)
+
+
+def to_minor_units(value):
+    """
+    Convert an amount (Decimal, int, float or numeric string) to whole cents,
+    rounding half to even. Raises ValueError for NaN, infinities and amounts
+    beyond the range of the column.
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if not value.is_finite():
+        raise ValueError(f'Not a finite amount: {value}')
+    cents = int(value.scaleb(DECIMAL_PLACES).to_integral_value(ROUND_HALF_EVEN))
+    if abs(cents) > MAX_MINOR_UNITS:
+        raise ValueError(f'Amount out of range: {value}')
+    return cents
+
+
+def parse_amount(value):
+    """
+    Parse an amount a user entered: a finite number with at most two decimal
+    places and MAX_DIGITS digits, so it is stored exactly rather than rounded
+    to a whole cent (or to zero). Raises ValueError otherwise; the sign is left
+    to the caller.
+    """
+    try:
+        amount = Decimal(str(value).strip())
+        _amount_validator(amount)
+    except (ArithmeticError, ValidationError) as exc:
+        raise ValueError(f'Not a valid amount: {value}') from exc
+    return amount
+
+
+def from_minor_units(value):
+    # scaleb keeps the exponent at -2, so 0 and 100 come back as 0.00 and 1.00
+    return Decimal(value).scaleb(-DECIMAL_PLACES)
+
+
+class MoneyField(models.BigIntegerField):
+    """
+    An amount of money stored as an integer number of cents. The database only
+    ever sees integers, so sums and comparisons run on plain integer columns,
+    while model instances, forms, serializers and templates keep working with
+    Decimals with two decimal places.
+
+    Values used inside query expressions must carry the field as their output
+    field (see money()), otherwise they are sent to the database as Decimals
+    rather than cents.
+    """
+
+    description = 'Amount of money stored in minor units'
+    decimal_places = DECIMAL_PLACES
+
+    def __init__(self, *args, max_digits=MAX_DIGITS, **kwargs):
+        self.max_digits = max_digits
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.max_digits != MAX_DIGITS:
+            kwargs['max_digits'] = self.max_digits
+        return name, path, args, kwargs
+
+    @cached_property
+    def validators(self):
+        # Validate the Decimal amount, not the integer range of the column
+        return [
+            *self.default_validators,
+            *self._validators,
+            validators.DecimalValidator(self.max_digits, self.decimal_places),
+        ]
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return from_minor_units(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal):
+            return value
+        try:
+            return Decimal(str(value))
+        except ArithmeticError:
+            raise ValidationError(
+                self.error_messages['invalid'], code='invalid', params={'value': value}
+            )
+
+    def get_prep_value(self, value):
+        if value is None or hasattr(value, 'resolve_expression'):
+            return value
+        return to_minor_units(value)
+
+    def formfield(self, **kwargs):
+        # Skip IntegerField.formfield, which would offer an integer input
+        return models.Field.formfield(self, **{
+            'form_class': forms.DecimalField,
+            'max_digits': self.max_digits,
+            'decimal_places': self.decimal_places,
+            **kwargs,
+        })
+
+
+def money(amount):
+    """A literal amount for use in F() arithmetic, Case/When and Coalesce against MoneyFields."""
+    return models.Value(amount, output_field=MoneyField())
@@ -0,0 +1,208 @@
+import base64
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import urlencode
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .archive import reaches_archive
+from .models import Transaction
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+Page = namedtuple('Page', ['transactions', 'next_cursor', 'filters', 'filter_query', 'next_query'])
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_transactions(queryset, params):
+    """
+    Apply the date_from / date_to (inclusive, YYYY-MM-DD) and transaction_type
+    filters found in params. Returns the filtered queryset and the filters that
+    were actually applied, so they can be carried over into page links.
+    """
+    applied = {}
+    date_from = parse_date(params.get('date_from') or '')
+    if date_from:
+        queryset = queryset.filter(timestamp__gte=_start_of_day(date_from))
+        applied['date_from'] = date_from.isoformat()
+    date_to = parse_date(params.get('date_to') or '')
+    if date_to:
+        queryset = queryset.filter(timestamp__lt=_start_of_day(date_to + timedelta(days=1)))
+        applied['date_to'] = date_to.isoformat()
+    transaction_type = params.get('transaction_type')
+    if transaction_type in dict(Transaction.TRANSACTION_TYPE_CHOICES):
+        queryset = queryset.filter(transaction_type=transaction_type)
+        applied['transaction_type'] = transaction_type
+    return queryset, applied
+
+
+def filter_archived(archived, params, filters):
+    """
+    Apply the same filters to an archived queryset, or return None when the
+    date range starts after the archive horizon and the archive can be skipped.
+    """
+    if archived is None or not reaches_archive(parse_date(filters.get('date_from', ''))):
+        return None
+    archived, _ = filter_transactions(archived, params)
+    return archived
+
+
+def encode_cursor(transaction):
+    position = f'{transaction.timestamp.isoformat()}|{transaction.id}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError(cursor)
+        return timestamp, int(pk)
+    except (TypeError, ValueError, UnicodeError) as exc:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from exc
+
+
+def keyset_queryset(queryset, cursor=None):
+    """
+    Order transactions newest first and skip everything up to and including
+    cursor. The position is a (timestamp, id) range condition rather than an
+    OFFSET, so every page costs the same however deep into the history it is.
+    """
+    queryset = queryset.order_by('-timestamp', '-id')
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+    return queryset
+
+
+def _page_of(rows, page_size, merged):
+    if merged:
+        rows.sort(key=lambda row: (row.timestamp, row.id), reverse=True)
+        rows = rows[:page_size + 1]
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+
+def keyset_page(queryset, cursor=None, page_size=PAGE_SIZE, archived=None):
+    """
+    Return one page of transactions after cursor and the cursor of the next
+    page, if any. When an archived queryset is given, the page is merged from
+    both tables; archived rows keep their original ids, so positions stay unique.
+    """
+    rows = list(keyset_queryset(queryset, cursor)[:page_size + 1])
+    if archived is not None:
+        rows += keyset_queryset(archived, cursor)[:page_size + 1]
+    return _page_of(rows, page_size, archived is not None)
+
+
+def keyset_page_across(querysets, cursor=None, page_size=PAGE_SIZE):
+    # keyset_page over several querysets, one per shard, merged into a single newest-first page
+    rows = [row for queryset in querysets for row in keyset_queryset(queryset, cursor)[:page_size + 1]]
+    return _page_of(rows, page_size, len(querysets) > 1)
+
+
+async def akeyset_page(queryset, cursor=None, page_size=PAGE_SIZE, archived=None):
+    # keyset_page for async views, fetching through the async ORM
+    rows = [row async for row in keyset_queryset(queryset, cursor)[:page_size + 1]]
+    if archived is not None:
+        rows += [row async for row in keyset_queryset(archived, cursor)[:page_size + 1]]
+    return _page_of(rows, page_size, archived is not None)
+
+
+def _page_size(params):
+    try:
+        return max(1, min(int(params.get('page_size', PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+
+
+def _history_page(transactions, next_cursor, filters, page_size, extra_params):
+    carried = {**(extra_params or {}), **filters}
+    filter_query = urlencode(carried)
+    next_query = None
+    if next_cursor:
+        if page_size != PAGE_SIZE:
+            carried['page_size'] = page_size
+        next_query = urlencode({**carried, 'cursor': next_cursor})
+    return Page(transactions, next_cursor, filters, filter_query, next_query)
+
+
+def paginate_transactions(queryset, params, extra_params=None, archived=None):
+    """
+    Filter and paginate a transaction history for an HTML view. The archived
+    counterpart of queryset is only consulted when the requested date range
+    reaches back past the archive horizon.
+    """
+    queryset, filters = filter_transactions(queryset, params)
+    archived = filter_archived(archived, params, filters)
+    page_size = _page_size(params)
+    try:
+        transactions, next_cursor = keyset_page(queryset, params.get('cursor'), page_size, archived)
+    except ValueError:
+        transactions, next_cursor = keyset_page(queryset, None, page_size, archived)
+    return _history_page(transactions, next_cursor, filters, page_size, extra_params)
+
+
+async def apaginate_transactions(queryset, params, extra_params=None, archived=None):
+    # paginate_transactions for async views
+    queryset, filters = filter_transactions(queryset, params)
+    archived = filter_archived(archived, params, filters)
+    page_size = _page_size(params)
+    try:
+        transactions, next_cursor = await akeyset_page(queryset, params.get('cursor'), page_size, archived)
+    except ValueError:
+        transactions, next_cursor = await akeyset_page(queryset, None, page_size, archived)
+    return _history_page(transactions, next_cursor, filters, page_size, extra_params)
+
+
+class TransactionCursorPagination(BasePagination):
+    page_size = PAGE_SIZE
+    # The order of keyset_queryset, whose columns the cursors are made of
+    ordering = ('-timestamp', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            rows, self.next_cursor = keyset_page_across(
+                queryset.per_shard(), request.query_params.get('cursor'), _page_size(request.query_params)
+            )
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), 'cursor', self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ApiCursorPagination(CursorPagination):
+    # The API's default: newest first, with the position in the cursor rather than an OFFSET, like the histories
+    page_size = PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    ordering = '-id'
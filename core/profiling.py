@@ -0,0 +1,185 @@
+import cProfile
+import os
+import selectors
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+
+import django
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.decorators import sync_and_async_middleware
+
+from .models import RequestProfile
+
+# A staff request is profiled when it carries ?_profile=<profiler> or an X-Profile: <profiler> header
+PARAMETER = '_profile'
+HEADER = 'X-Profile'
+
+# Profiles are written in these formats: collapsed stacks for flamegraph.pl or speedscope, pstats for snakeviz
+EXTENSIONS = {'sample': 'folded', 'cprofile': 'prof'}
+
+# Threads whose stacks go through these directories are doing request work; the rest are idle pool threads
+_WORK_DIRS = (str(Path(django.__file__).parent), str(settings.BASE_DIR))
+
+# Samples caught blocked in one of these modules, e.g. a thread waiting for an async view to finish, are idle time
+_IDLE_FILES = {threading.__file__, selectors.__file__}
+
+
+def _requested_profiler(request):
+    profiler = request.GET.get(PARAMETER) or request.headers.get(HEADER)
+    if profiler is None:
+        return None
+    return profiler if profiler in EXTENSIONS else 'sample'
+
+
+@lru_cache(maxsize=None)
+def _frame_name(code):
+    # Paths relative to the project or to the sys.path entry holding them: core/views.py, django/db/...
+    path = code.co_filename
+    for prefix in sorted({str(settings.BASE_DIR), *filter(None, sys.path)}, key=len, reverse=True):
+        if path.startswith(prefix + os.sep):
+            path = os.path.relpath(path, prefix)
+            break
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+
+class Sampler(threading.Thread):
+    """
+    A statistical profiler: every PROFILE_SAMPLE_INTERVAL seconds, record the
+    stack of each thread doing Django or project work, unless it is only
+    waiting for another thread or for I/O events. Sampling the whole
+    process also catches the worker threads an async view hands its queries
+    to, along with any other request running at the same time.
+    """
+
+    def __init__(self):
+        super().__init__(name='request-profiler', daemon=True)
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.done.wait(settings.PROFILE_SAMPLE_INTERVAL):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if not stack or stack[0].co_filename in _IDLE_FILES:
+                    continue
+                if not any(code.co_filename.startswith(_WORK_DIRS) for code in stack):
+                    continue
+                if ident not in names:
+                    names[ident] = next((t.name for t in threading.enumerate() if t.ident == ident), str(ident))
+                self.stacks[(names[ident], *reversed(stack))] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for (thread, *stack), count in self.stacks.items():
+                f.write(';'.join([thread, *map(_frame_name, stack)]) + f' {count}\n')
+
+
+class _Run:
+    # One profiled request: starts the profiler, then writes its file and the RequestProfile row
+    def __init__(self, profiler, user):
+        self.profiler = profiler
+        self.user = user
+        self.started = time.perf_counter()
+        if profiler == 'cprofile':
+            # cProfile follows the current thread only: sync views, or the event loop of an async one
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = Sampler()
+            self.profile.start()
+
+    def stop(self):
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+        if self.profiler == 'cprofile':
+            self.profile.disable()
+        else:
+            self.profile.stop()
+
+    def save(self, request, response):
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        file_name = f'{uuid.uuid4().hex}.{EXTENSIONS[self.profiler]}'
+        if self.profiler == 'cprofile':
+            self.profile.dump_stats(os.path.join(settings.PROFILE_DIR, file_name))
+        else:
+            self.profile.write(os.path.join(settings.PROFILE_DIR, file_name))
+        match = getattr(request, 'resolver_match', None)
+        profile = RequestProfile.objects.create(
+            user=self.user,
+            method=request.method,
+            path=request.get_full_path()[:255],
+            view_name=match.view_name if match is not None else '',
+            status_code=response.status_code if response is not None else None,
+            profiler=self.profiler,
+            duration_ms=self.duration_ms,
+            file_name=file_name,
+        )
+        # Keep the newest PROFILE_RETENTION profiles; deleting the rows deletes their files
+        expired = RequestProfile.objects.values_list('id', flat=True)[settings.PROFILE_RETENTION:]
+        RequestProfile.objects.filter(id__in=list(expired)).delete()
+        if response is not None:
+            response['X-Profile-Id'] = str(profile.id)
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """
+    Run a staff member's request under a profiler when they ask for one with
+    ?_profile=sample|cprofile or the X-Profile header, and keep the result
+    for the admin. Every other request only pays for the two lookups. The
+    body of a streaming response is produced after the profile ends.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            profiler = _requested_profiler(request)
+            user = await request.auser() if profiler is not None else None
+            if user is None or not user.is_staff:
+                return await get_response(request)
+            run = _Run(profiler, user)
+            response = None
+            try:
+                response = await get_response(request)
+            finally:
+                run.stop()
+                await sync_to_async(run.save)(request, response)
+            return response
+    else:
+        def middleware(request):
+            profiler = _requested_profiler(request)
+            if profiler is None or not request.user.is_staff:
+                return get_response(request)
+            run = _Run(profiler, request.user)
+            response = None
+            try:
+                response = get_response(request)
+            finally:
+                run.stop()
+                run.save(request, response)
+            return response
+    return middleware
+
+
+@receiver(post_delete, sender=RequestProfile)
+def delete_profile_file(sender, instance, **kwargs):
+    try:
+        os.remove(os.path.join(settings.PROFILE_DIR, instance.file_name))
+    except FileNotFoundError:
+        pass
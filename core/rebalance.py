@@ -0,0 +1,79 @@
+from .consumers import forget_consumer
+from .models import ArchivedTransaction, BalanceSnapshot, BillPayment, ConsumerProfile, Subscription, Transaction
+from .sharding import atomic, shard_for
+
+# Every sharded model, in the order a user's rows are copied: bill payments point at their transactions
+MOVED_MODELS = [ConsumerProfile, BalanceSnapshot, Subscription, Transaction, ArchivedTransaction, BillPayment]
+
+# Transaction ids are unique across shards (see sharding.ID_RANGE) and moved rows keep them; the other models'
+# rows are given new ids by the shard they move to
+KEPT_IDS = (Transaction, ArchivedTransaction)
+
+
+class RebalanceConflict(Exception):
+    pass
+
+
+def _rows(model, alias, user_id):
+    return model._base_manager.using(alias).filter(**{model.SHARD_KEY: user_id})
+
+
+def misplaced_users(alias):
+    """The ids of the users with rows on shard alias that now belong on another shard, e.g. one just added."""
+    user_ids = set()
+    for model in MOVED_MODELS:
+        user_ids.update(model._base_manager.using(alias).values_list(model.SHARD_KEY, flat=True).distinct())
+    return sorted(user_id for user_id in user_ids if shard_for(user_id) != alias)
+
+
+def _copied_before(user_id, source, target):
+    # The target may already hold this user's rows if an earlier run stopped between its two commits; any other
+    # rows of theirs there were written after the shard was added, and merging them is left to a person
+    if not any(_rows(model, target, user_id).exists() for model in MOVED_MODELS):
+        return False
+    for model in MOVED_MODELS:
+        if model in KEPT_IDS:
+            ids = set(_rows(model, source, user_id).values_list('id', flat=True))
+            copied = ids <= set(_rows(model, target, user_id).filter(id__in=ids).values_list('id', flat=True))
+        else:
+            copied = _rows(model, target, user_id).count() >= _rows(model, source, user_id).count()
+        if not copied:
+            raise RebalanceConflict(f'User {user_id} has rows on both {source} and {target}.')
+    return True
+
+
+def _copy(model, rows, target):
+    # bulk_create stamps auto_now_add fields with the current time; moved rows keep the times they had
+    stamped = [field for field in model._meta.concrete_fields if getattr(field, 'auto_now_add', False)]
+    original = [[getattr(row, field.attname) for field in stamped] for row in rows]
+    if model not in KEPT_IDS:
+        for row in rows:
+            row.pk = None
+    model._base_manager.using(target).bulk_create(rows)
+    if stamped and rows:
+        for row, values in zip(rows, original):
+            for field, value in zip(stamped, values):
+                setattr(row, field.attname, value)
+        model._base_manager.using(target).bulk_update(rows, [field.name for field in stamped])
+
+
+def move_user(user_id, source):
+    """
+    Move all sharded rows of a user from shard source to the shard they now
+    belong on, in one transaction on each of the two. Returns the number of
+    rows moved. Raises RebalanceConflict, moving nothing, when the target
+    already has rows of the user that are not a copy of the ones on source.
+    """
+    target = shard_for(user_id)
+    moved = 0
+    with atomic([source, target]):
+        copied = _copied_before(user_id, source, target)
+        for model in MOVED_MODELS:
+            rows = list(_rows(model, source, user_id).order_by('pk'))
+            if not copied:
+                _copy(model, rows, target)
+            moved += len(rows)
+        for model in reversed(MOVED_MODELS):
+            _rows(model, source, user_id).delete()
+    forget_consumer(user_id)
+    return moved
@@ -0,0 +1,46 @@
+import os
+import threading
+import time
+
+# Crockford's base32 alphabet: sorts in the same order as the numbers it encodes
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+LENGTH = 26
+
+_RANDOM_BITS = 80
+_lock = threading.Lock()
+_last = (0, 0)
+
+
+def _encode(value):
+    chars = []
+    for _ in range(LENGTH):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def reference_at(milliseconds):
+    """A ULID for the given Unix time in milliseconds, with a random tail."""
+    return _encode((milliseconds << _RANDOM_BITS) | int.from_bytes(os.urandom(10), 'big'))
+
+
+def new_reference():
+    """
+    Return a 26-character ULID: a 48-bit millisecond timestamp followed by 80
+    random bits. References sort by creation time, so new rows land at the
+    right-hand edge of the reference_id index instead of at random positions.
+    Within one millisecond the random part is incremented, keeping references
+    from one process strictly increasing.
+    """
+    global _last
+    with _lock:
+        milliseconds = time.time_ns() // 1_000_000
+        last_milliseconds, last_random = _last
+        if milliseconds <= last_milliseconds:
+            milliseconds, random = last_milliseconds, last_random + 1
+            if random >> _RANDOM_BITS:
+                milliseconds, random = milliseconds + 1, int.from_bytes(os.urandom(10), 'big')
+        else:
+            random = int.from_bytes(os.urandom(10), 'big')
+        _last = (milliseconds, random)
+    return _encode((milliseconds << _RANDOM_BITS) | random)
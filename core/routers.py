@@ -0,0 +1,144 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.utils.decorators import sync_and_async_middleware
+
+# Set on the responses of requests that wrote to the primary; while present, the client reads from the primary too
+PIN_COOKIE = 'db_pin_primary'
+
+
+class _Routing:
+    # Per-request routing state, shared with the worker threads that run the request's queries
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.replica = None
+        self.wrote = False
+
+
+_routing = ContextVar('db_routing', default=None)
+
+
+class PrimaryReplicaRouter:
+    """
+    Send writes, and by default reads, to the primary ('default'). Reads made
+    inside a view decorated with read_from_replica go to one replica from
+    settings.DATABASE_REPLICAS instead, the same one for the whole request,
+    unless the client wrote something in the last READ_YOUR_WRITES_SECONDS:
+    then they read from the primary and see their own transactions straight
+    away, however far the replicas lag behind.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is not None and state.replica is not None:
+            return state.replica
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary along with the data
+        return db not in settings.DATABASE_REPLICAS
+
+
+def _replicas():
+    # A replica alias for the primary's own database, as a test mirror is, is read through the primary's
+    # connection: a connection of its own would not see what the primary's open transaction wrote
+    primary = connections['default'].settings_dict
+    return [
+        alias for alias in settings.DATABASE_REPLICAS
+        if (connections[alias].settings_dict['NAME'], connections[alias].settings_dict['HOST']) != (primary['NAME'], primary['HOST'])
+    ]
+
+
+def _use_replica():
+    state = _routing.get()
+    if state is not None and not state.pinned:
+        replicas = _replicas()
+        if replicas:
+            state.replica = random.choice(replicas)
+    return state
+
+
+def read_from_replica(view):
+    # For read-only function views, sync or async; needs routing_middleware
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            state = _use_replica()
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                if state is not None:
+                    state.replica = None
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            state = _use_replica()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                if state is not None:
+                    state.replica = None
+    return wrapper
+
+
+@contextmanager
+def use_primary():
+    # Reads in this block go to the primary even in a replica view, e.g. to fill a cache that outlives replica lag
+    state = _routing.get()
+    replica = state.replica if state is not None else None
+    if state is not None:
+        state.replica = None
+    try:
+        yield
+    finally:
+        if state is not None:
+            state.replica = replica
+
+
+def _pin(response, state):
+    if state.wrote:
+        response.set_cookie(PIN_COOKIE, '1', max_age=settings.READ_YOUR_WRITES_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+
+@sync_and_async_middleware
+def routing_middleware(get_response):
+    """
+    Give each request its routing state: pinned to the primary if the client
+    holds the pin cookie, and pinning the client for READ_YOUR_WRITES_SECONDS
+    if the request itself wrote to the database.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = _Routing(pinned=PIN_COOKIE in request.COOKIES)
+            token = _routing.set(state)
+            try:
+                response = await get_response(request)
+            finally:
+                _routing.reset(token)
+            return _pin(response, state)
+    else:
+        def middleware(request):
+            state = _Routing(pinned=PIN_COOKIE in request.COOKIES)
+            token = _routing.set(state)
+            try:
+                response = get_response(request)
+            finally:
+                _routing.reset(token)
+            return _pin(response, state)
+    return middleware
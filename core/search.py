@@ -0,0 +1,167 @@
+import heapq
+import re
+from collections import namedtuple
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import CATALOGS
+from .models import Product, Service
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+# Ranked offset pagination gets slower with depth; nobody reads past this page of search results
+MAX_PAGE = 50
+
+# Each searchable kind: its model and the full-text table (SQLite) or index (PostgreSQL) over it
+SearchTarget = namedtuple('SearchTarget', ['model', 'table'])
+
+TARGETS = {
+    'products': SearchTarget(Product, 'core_product_search'),
+    'services': SearchTarget(Service, 'core_service_search'),
+}
+
+# The indexed document on PostgreSQL; the GIN index in migration 0012 is built on exactly this expression
+PG_DOCUMENT = "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))"
+
+SearchResult = namedtuple('SearchResult', ['kind', 'item', 'rank'])
+SearchPage = namedtuple('SearchPage', ['results', 'page', 'page_size', 'has_next'])
+
+_TERM = re.compile(r'\w+')
+
+
+def terms(query):
+    # Words only: the rest of the input never reaches the FTS5 or tsquery syntax
+    return _TERM.findall(query or '')[:16]
+
+
+def _sqlite_ids(table, words, limit):
+    # Prefix match on every word; bm25 is lower for better matches
+    match = ' '.join(f'"{word}"*' for word in words)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, -bm25({table}) FROM {table} WHERE {table} MATCH %s ORDER BY bm25({table}), rowid LIMIT %s',
+            [match, limit],
+        )
+        return cursor.fetchall()
+
+
+def _postgresql_ids(model, words, limit):
+    tsquery = ' & '.join(f'{word}:*' for word in words)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, ts_rank({PG_DOCUMENT}, to_tsquery('english', %s)) AS rank FROM {model._meta.db_table} "
+            f"WHERE {PG_DOCUMENT} @@ to_tsquery('english', %s) ORDER BY rank DESC, id LIMIT %s",
+            [tsquery, tsquery, limit],
+        )
+        return cursor.fetchall()
+
+
+def _fallback_ids(model, words, limit):
+    # Other databases: unindexed substring match, ranked by how many words hit the name
+    condition = Q()
+    for word in words:
+        condition &= Q(name__icontains=word) | Q(description__icontains=word)
+    rows = model.objects.filter(condition).values_list('id', 'name')[:limit]
+    ranked = [(id, sum(word.lower() in name.lower() for word in words)) for id, name in rows]
+    return sorted(ranked, key=lambda row: (-row[1], row[0]))
+
+
+def _ranked_ids(kind, words, limit):
+    target = TARGETS[kind]
+    if connection.vendor == 'sqlite':
+        return _sqlite_ids(target.table, words, limit)
+    if connection.vendor == 'postgresql':
+        return _postgresql_ids(target.model, words, limit)
+    return _fallback_ids(target.model, words, limit)
+
+
+def search_catalog(query, kinds=tuple(TARGETS), page=1, page_size=PAGE_SIZE):
+    """
+    Return one SearchPage of the products and/or services whose name or
+    description contains every word of query (as a prefix), best match
+    first. Matching and ranking run on the full-text index of the database,
+    so only the rows on the requested page are ever loaded.
+    """
+    page = min(max(page, 1), MAX_PAGE)
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    words = terms(query)
+    if not words:
+        return SearchPage([], page, page_size, False)
+
+    # Enough of each kind's top matches to fill this page once merged, plus one to tell if there is a next page
+    limit = page * page_size + 1
+    ranked = heapq.merge(
+        *[[(-rank, kind, id) for id, rank in _ranked_ids(kind, words, limit)] for kind in kinds]
+    )
+    hits = list(ranked)[(page - 1) * page_size:limit]
+    has_next = len(hits) > page_size
+    hits = hits[:page_size]
+
+    items = {
+        kind: CATALOGS[kind].rows().in_bulk([id for _, hit_kind, id in hits if hit_kind == kind])
+        for kind in kinds
+    }
+    results = [
+        SearchResult(kind, items[kind][id], -negative_rank)
+        for negative_rank, kind, id in hits
+        if id in items[kind]
+    ]
+    return SearchPage(results, page, page_size, has_next)
+
+
+def index_item(kind, item):
+    # PostgreSQL keeps its expression index current by itself; SQLite's FTS5 tables are written here
+    if connection.vendor != 'sqlite':
+        return
+    table = TARGETS[kind].table
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [item.pk])
+        cursor.execute(
+            f'INSERT INTO {table} (rowid, name, description) VALUES (%s, %s, %s)',
+            [item.pk, item.name, item.description or ''],
+        )
+
+
+def unindex_item(kind, item):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TARGETS[kind].table} WHERE rowid = %s', [item.pk])
+
+
+def rebuild_index(kind):
+    """Refill a kind's SQLite full-text table from its model table; returns the number of rows indexed."""
+    target = TARGETS[kind]
+    if connection.vendor != 'sqlite':
+        return target.model.objects.count()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {target.table}')
+        cursor.execute(
+            f"INSERT INTO {target.table} (rowid, name, description) "
+            f"SELECT id, name, coalesce(description, '') FROM {target.model._meta.db_table}"
+        )
+        return cursor.rowcount
+
+
+# Saves and deletes update the index in the same DB transaction as the row itself
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    index_item('products', instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    unindex_item('products', instance)
+
+
+@receiver(post_save, sender=Service)
+def index_service(sender, instance, **kwargs):
+    index_item('services', instance)
+
+
+@receiver(post_delete, sender=Service)
+def unindex_service(sender, instance, **kwargs):
+    unindex_item('services', instance)
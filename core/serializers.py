@@ -1,52 +1,112 @@
 from rest_framework import serializers
+from .filters import requested_fields
+from .money import MoneyField
 from .models import Product, User, AgentProfile, ConsumerProfile, MerchantProfile, Transaction, Bill, BillPayment, Service, Subscription
 
-class ProductSerializer(serializers.ModelSerializer):
+class MoneyModelSerializer(serializers.ModelSerializer):
+    # Money is exposed as a decimal string, whatever the column stores
+    serializer_field_mapping = {**serializers.ModelSerializer.serializer_field_mapping, MoneyField: serializers.DecimalField}
+
+class SparseFieldsetMixin:
+    # On a read, ?fields=a,b returns only those fields of each result (see core.filters)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields is not None:
+            unknown = fields - set(self.fields)
+            if unknown:
+                raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(sorted(unknown))}"})
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+class ProductSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    store_name = serializers.CharField(source='merchant.merchant_profile.store_name', read_only=True)
+
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price', 'created_at', 'updated_at']
+        fields = ['id', 'merchant', 'store_name', 'name', 'description', 'price', 'created_at', 'updated_at']
+        read_only_fields = ['merchant']
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsetMixin, MoneyModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'user_type']
 
-class AgentProfileSerializer(serializers.ModelSerializer):
+# Balances only ever change through the ledger, and profiles belong to their user
+class AgentProfileSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+
     class Meta:
         model = AgentProfile
-        fields = ['id', 'user', 'agency_name']
+        fields = ['id', 'user', 'username', 'agency_name']
+        read_only_fields = ['user']
+
+class ConsumerProfileSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
 
-class ConsumerProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = ConsumerProfile
-        fields = ['id', 'user', 'address', 'balance']
+        fields = ['id', 'user', 'username', 'address', 'balance']
+        read_only_fields = ['user', 'balance']
+
+class MerchantProfileSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
 
-class MerchantProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = MerchantProfile
-        fields = ['id', 'user', 'store_name', 'balance']
+        fields = ['id', 'user', 'username', 'store_name', 'balance']
+        read_only_fields = ['user', 'balance']
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(SparseFieldsetMixin, MoneyModelSerializer):
     class Meta:
         model = Transaction
         fields = ['id', 'transaction_type', 'user', 'amount', 'timestamp', 'status', 'reference_id']
 
-class BillSerializer(serializers.ModelSerializer):
+class BillSerializer(SparseFieldsetMixin, MoneyModelSerializer):
     class Meta:
         model = Bill
         fields = ['id', 'bill_type', 'account_number', 'amount_due', 'due_date']
 
-class BillPaymentSerializer(serializers.ModelSerializer):
+class AnyShardPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    # For models whose ids are unique across shards: the row is looked up on each shard in turn
+    def to_internal_value(self, data):
+        for queryset in self.get_queryset().per_shard():
+            try:
+                return queryset.get(pk=data)
+            except queryset.model.DoesNotExist:
+                pass
+            except (TypeError, ValueError):
+                self.fail('incorrect_type', data_type=type(data).__name__)
+        self.fail('does_not_exist', pk_value=data)
+
+class BillPaymentSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    transaction = AnyShardPrimaryKeyRelatedField(queryset=Transaction.objects.all())
+    bill_type = serializers.CharField(source='bill.bill_type', read_only=True)
+
     class Meta:
         model = BillPayment
-        fields = ['id', 'transaction', 'bill', 'paid_by']
+        fields = ['id', 'transaction', 'bill', 'bill_type', 'paid_by']
+
+    def validate(self, attrs):
+        # A bill payment is stored on its payer's shard, next to its transaction
+        transaction = attrs.get('transaction', getattr(self.instance, 'transaction', None))
+        paid_by = attrs.get('paid_by', getattr(self.instance, 'paid_by', None))
+        if transaction is not None and paid_by is not None and transaction.user_id != paid_by.id:
+            raise serializers.ValidationError('The transaction of a bill payment must be one of the payer\'s.')
+        return attrs
+
+class ServiceSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    store_name = serializers.CharField(source='merchant.merchant_profile.store_name', read_only=True)
 
-class ServiceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Service
-        fields = ['id', 'merchant', 'name', 'description', 'subscription_fee', 'created_at', 'updated_at']
+        fields = ['id', 'merchant', 'store_name', 'name', 'description', 'subscription_fee', 'created_at', 'updated_at']
+        read_only_fields = ['merchant']
+
+class SubscriptionSerializer(SparseFieldsetMixin, MoneyModelSerializer):
+    service_name = serializers.CharField(source='service.name', read_only=True)
 
-class SubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subscription
-        fields = ['id', 'consumer', 'service', 'start_date', 'end_date', 'is_active']
\ No newline at end of file
+        fields = ['id', 'consumer', 'service', 'service_name', 'start_date', 'end_date', 'is_active']
+        read_only_fields = ['consumer']
\ No newline at end of file
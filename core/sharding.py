@@ -0,0 +1,176 @@
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models.signals import post_migrate, pre_delete
+from django.dispatch import receiver
+
+# Transaction ids come from a separate range on each shard, shard k's starting at
+# k * ID_RANGE, so they are unique across shards and survive a move between them
+ID_RANGE = 2 ** 40
+
+
+def jump_hash(key, buckets):
+    # Lamping and Veach's jump consistent hash: going from N to N + 1 buckets only moves 1/(N + 1) of the keys,
+    # all of them into the new bucket
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(user_id):
+    """The alias of the database holding the sharded rows of user_id."""
+    shards = settings.DATABASE_SHARDS
+    return shards[jump_hash(user_id, len(shards))] if len(shards) > 1 else shards[0]
+
+
+def is_sharded(model):
+    return getattr(model, 'SHARD_KEY', None) is not None
+
+
+def group_by_shard(items, user_id=lambda item: item):
+    # {alias: items}, in shard order; user_id picks the user an item belongs to
+    groups = defaultdict(list)
+    for item in items:
+        groups[shard_for(user_id(item))].append(item)
+    return {alias: groups[alias] for alias in settings.DATABASE_SHARDS if alias in groups}
+
+
+@contextmanager
+def atomic(aliases):
+    """
+    A transaction.atomic block on each of the given shards, entered in shard
+    order so concurrent postings lock them in the same order. An exception
+    rolls all of them back. On success they commit one after the other: there
+    is no two-phase commit, so a crash between two commits can still leave a
+    cross-shard posting half applied.
+    """
+    shards = settings.DATABASE_SHARDS
+    with ExitStack() as stack:
+        for alias in sorted(set(aliases), key=shards.index):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet of a model sharded by user: its SHARD_KEY names the user id
+    column. A query runs on the primary ('default') unless for_user() or
+    on_shard() says which shard it is about; saved and bulk-created rows go
+    to the shard of their own user.
+    """
+
+    def on_shard(self, alias):
+        # A router hint rather than using(), so queries on the primary can still be sent to its replicas
+        queryset = self._chain()
+        queryset._hints = {**self._hints, 'shard': alias}
+        return queryset
+
+    def for_user(self, user_id):
+        return self.on_shard(shard_for(user_id)).filter(**{self.model.SHARD_KEY: user_id})
+
+    def across_shards(self):
+        # One queryset per shard, for agent and admin queries that are not about a single user
+        return [self.on_shard(alias) for alias in settings.DATABASE_SHARDS]
+
+    def per_shard(self):
+        # The querysets covering this one's rows: itself if it is routed to a shard, else one per shard
+        if self._db is not None or 'shard' in self._hints:
+            return [self]
+        return self.across_shards()
+
+    def create(self, **kwargs):
+        obj = self.model(**kwargs)
+        self._for_write = True
+        # Without an explicit database, save() routes the row by its own shard key
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None or 'shard' in self._hints:
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        for alias, group in group_by_shard(objs, lambda obj: getattr(obj, self.model.SHARD_KEY)).items():
+            self.on_shard(alias).bulk_create(group, *args, **kwargs)
+        return objs
+
+
+ShardedManager = models.Manager.from_queryset(ShardedQuerySet)
+
+
+class ShardRouter:
+    """
+    Send the rows of sharded models to their user's shard: queries by their
+    shard hint, saves by the instance's shard key, and related lookups from a
+    user (user.consumer_profile) or a sharded row (transaction.bill_payment)
+    to that user's or row's shard. Anything on the primary, and every
+    unsharded model, is left to the next router.
+    """
+
+    def _shard(self, model, hints):
+        if not is_sharded(model):
+            return None
+        alias = hints.get('shard')
+        instance = hints.get('instance')
+        if alias is None and instance is not None:
+            if isinstance(instance, model):
+                user_id = getattr(instance, model.SHARD_KEY)
+                alias = shard_for(user_id) if user_id is not None else None
+            elif instance._meta.label == settings.AUTH_USER_MODEL:
+                alias = shard_for(instance.pk)
+            elif is_sharded(type(instance)):
+                alias = instance._state.db
+        return None if alias == 'default' else alias
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+
+def sharded_models():
+    return [model for model in apps.get_app_config('core').get_models() if is_sharded(model)]
+
+
+@receiver(pre_delete)
+def delete_from_other_shards(sender, instance, using, **kwargs):
+    # Deletes cascade on the deleting database only; rows on the other shards that point at an unsharded row
+    # (a user's transactions, a service's subscriptions) are deleted here
+    if len(settings.DATABASE_SHARDS) < 2 or is_sharded(sender):
+        return
+    for model in sharded_models():
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.related_model is sender and field.remote_field.on_delete is models.CASCADE:
+                for alias in settings.DATABASE_SHARDS:
+                    if alias != using:
+                        model._base_manager.using(alias).filter(**{field.attname: instance.pk}).delete()
+
+
+@receiver(post_migrate)
+def start_transaction_ids(sender, using, **kwargs):
+    """Move the Transaction id sequence of a freshly migrated shard to the start of its range."""
+    shards = settings.DATABASE_SHARDS
+    if sender.label != 'core' or using not in shards or not shards.index(using):
+        return
+    start = shards.index(using) * ID_RANGE
+    table = apps.get_model('core', 'Transaction')._meta.db_table
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                [table, start, table],
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, (SELECT coalesce(max(id), 0) FROM {table})))",
+                [table, start],
+            )
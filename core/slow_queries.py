@@ -0,0 +1,187 @@
+import atexit
+import hashlib
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import metrics
+from .models import SlowQuery
+
+# One slow statement, waiting in the queue for the flusher thread to add it to its SlowQuery row. log_name is
+# the name of the database holding that table at the time, which a test run swaps for a throwaway one.
+Occurrence = namedtuple('Occurrence', [
+    'database', 'shape', 'sql', 'params', 'ms', 'view_name', 'call_site', 'plan', 'at', 'log_name',
+])
+
+# Slow statements are written to the database this often, by a thread of their own, so that logging
+# them never joins (or rolls back with) the transaction of the code that ran them
+FLUSH_INTERVAL = 5
+
+# Parameters are kept up to this many characters; a bulk insert can have thousands
+PARAMS_LENGTH = 1000
+
+# A shape's plan is captured again at most this often per process, as data and indexes change
+EXPLAIN_INTERVAL = 3600
+
+# Statements EXPLAIN accepts; DDL and transaction control are timed but not explained
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+_queue = queue.SimpleQueue()
+_explained = {}
+_flusher = None
+_flusher_lock = threading.Lock()
+
+# Set in the flusher and at exit, whose own queries are not logged
+_local = threading.local()
+
+# Frames in these files wrap every request or query, or are the logging itself, not the code that ran the query
+_WRAPPER_FILES = {
+    os.path.join(os.path.dirname(__file__), name)
+    for name in ('metrics.py', 'profiling.py', 'routers.py', 'sharding.py', 'slow_queries.py')
+}
+
+
+def _call_site():
+    # The innermost project frame calling the ORM: in a view, a helper or a command. The queries of async
+    # views run in another thread than the view's own frames, so they have none
+    base = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(base) and path not in _WRAPPER_FILES and f'{os.sep}site-packages{os.sep}' not in path:
+            return f'{os.path.relpath(path, base)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return ''
+
+
+def _explain(connection, sql, params):
+    # On a cursor of its own, straight from the backend: the statement's cursor still holds its results,
+    # and the EXPLAIN must not run through the execute wrappers again
+    cursor = connection.create_cursor()
+    try:
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+        return '\n'.join(' '.join(str(column) for column in row[-1:]) for row in cursor.fetchall())
+    except DatabaseError as e:
+        return f'EXPLAIN failed: {e}'
+    finally:
+        cursor.close()
+
+
+def _needs_plan(shape, sql, many):
+    if many or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return False
+    now = time.monotonic()
+    if now - _explained.get(shape, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+        return False
+    _explained[shape] = now
+    return True
+
+
+def _log_slow_query(execute, sql, params, many, context):
+    if settings.SLOW_QUERY_MS is None or getattr(_local, 'ignore', False):
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    result = execute(sql, params, many, context)
+    ms = (time.perf_counter() - start) * 1000
+    if ms >= settings.SLOW_QUERY_MS:
+        connection = context['connection']
+        shape = metrics.query_shape(sql)
+        _queue.put(Occurrence(
+            database=connection.alias,
+            shape=shape,
+            sql=sql,
+            params='' if many else repr(params)[:PARAMS_LENGTH],
+            ms=ms,
+            view_name=metrics.current_view(),
+            call_site=_call_site(),
+            plan=_explain(connection, sql, params) if _needs_plan(shape, sql, many) else None,
+            at=timezone.now(),
+            log_name=connections['default'].settings_dict['NAME'],
+        ))
+        _start_flusher()
+    return result
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    if _log_slow_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_log_slow_query)
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_forever, name='slow-query-flusher', daemon=True)
+            _flusher.start()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def _drain():
+    occurrences = []
+    while True:
+        try:
+            occurrences.append(_queue.get_nowait())
+        except queue.Empty:
+            return occurrences
+
+
+@atexit.register
+def flush():
+    """Add the queued slow statements to their SlowQuery rows, one row per shape."""
+    by_shape = defaultdict(list)
+    log_name = connections['default'].settings_dict['NAME']
+    for occurrence in _drain():
+        # Statements timed during a test run are dropped once its database is gone, not logged to the real one
+        if occurrence.log_name == log_name:
+            by_shape[occurrence.shape].append(occurrence)
+    if not by_shape:
+        return
+
+    _local.ignore = True
+    try:
+        with transaction.atomic():
+            for shape, occurrences in by_shape.items():
+                shape_hash = hashlib.sha1(shape.encode()).hexdigest()
+                entry = SlowQuery.objects.select_for_update().filter(shape_hash=shape_hash).first()
+                if entry is None:
+                    entry = SlowQuery(shape_hash=shape_hash, shape=shape)
+                latest = occurrences[-1]
+                entry.count += len(occurrences)
+                entry.total_ms += sum(occurrence.ms for occurrence in occurrences)
+                entry.max_ms = max(entry.max_ms, *(occurrence.ms for occurrence in occurrences))
+                recent = entry.recent_ms + [round(occurrence.ms, 3) for occurrence in occurrences]
+                entry.recent_ms = recent[-settings.SLOW_QUERY_SAMPLES:]
+                entry.database = latest.database
+                entry.example_sql = latest.sql
+                entry.example_params = latest.params
+                entry.view_name = latest.view_name
+                entry.call_site = latest.call_site
+                entry.last_seen = latest.at
+                plans = [occurrence.plan for occurrence in occurrences if occurrence.plan is not None]
+                if plans:
+                    entry.plan = plans[-1]
+                entry.save()
+    except DatabaseError:
+        # Typically a locked SQLite file; the occurrences are tried again on the next flush
+        for occurrences in by_shape.values():
+            for occurrence in occurrences:
+                _queue.put(occurrence)
+    finally:
+        _local.ignore = False
@@ -0,0 +1,33 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.utils.decorators import sync_and_async_middleware
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+def _find(whitenoise, request):
+    # A lookup in the files WhiteNoise indexed at startup; only with autorefresh (DEBUG) does it search the disk
+    if whitenoise.autorefresh:
+        return whitenoise.find_file(request.path_info)
+    return whitenoise.files.get(request.path_info)
+
+
+@sync_and_async_middleware
+def static_files_middleware(get_response):
+    """
+    Serve STATIC_ROOT through WhiteNoise, as uvicorn serves no static files.
+    WhiteNoise's own middleware is sync only, which would make Django run
+    every async view below it in a thread; this one keeps them async.
+    """
+    whitenoise = WhiteNoiseMiddleware(get_response)
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            static_file = _find(whitenoise, request)
+            if static_file is not None:
+                return await sync_to_async(whitenoise.serve)(static_file, request)
+            return await get_response(request)
+    else:
+        def middleware(request):
+            static_file = _find(whitenoise, request)
+            if static_file is not None:
+                return whitenoise.serve(static_file, request)
+            return get_response(request)
+    return middleware
@@ -0,0 +1,257 @@
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from . import balances
+from .models import BalanceSnapshot, Bill, ConsumerProfile, MerchantProfile, Product, Transaction, User
+from .sharding import group_by_shard
+
+# A money-moving request made through the real views: who makes it, the URL name and form data, and
+# the change in money held by consumers and merchants, together, that it makes if it is applied
+Posting = namedtuple('Posting', ['kind', 'username', 'url', 'data', 'external'])
+
+# What the view made of one posting; applied is read off the response, as a client would. error is the
+# exception behind a server error
+Outcome = namedtuple('Outcome', ['kind', 'status_code', 'applied', 'seconds', 'error'])
+
+# Transaction rows an applied posting adds: one per side, and recharges have no agent side
+ROWS = {'recharge': 1, 'purchase': 2, 'agent_cash_in': 2, 'agent_cash_out': 2, 'bill_payment': 2}
+
+DEFAULT_MIX = {'purchase': 40, 'agent_cash_in': 20, 'agent_cash_out': 15, 'recharge': 15, 'bill_payment': 10}
+
+
+class Accounts:
+    """The users a stress run acts as and on, all named <prefix>-<role>-<n>, with a logged-in session each."""
+
+    def __init__(self, prefix, consumers, merchants, agents, price=Decimal('7.00')):
+        self.prefix = prefix
+        self.users = {
+            role: [
+                User.objects.create_user(username=f'{prefix}-{role}-{n}', password=None, user_type=role)
+                for n in range(count)
+            ]
+            for role, count in (('consumer', consumers), ('merchant', merchants), ('agent', agents))
+        }
+        self.products = [
+            Product.objects.create(merchant=merchant, name=f'{prefix} product', price=price).id
+            for merchant in self.users['merchant']
+        ]
+        self.bill = Bill.objects.create(bill_type='electricity', account_number='0', amount_due=0, due_date='2000-01-01')
+        self.sessions = {user.username: self._log_in(user) for users in self.users.values() for user in users}
+
+    def _log_in(self, user):
+        # Sessions made here rather than through the login page: password hashing would dominate the run
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    def user_ids(self, *roles):
+        return [user.id for role in roles for user in self.users[role]]
+
+
+def _amount(rng):
+    return Decimal(rng.randint(100, 5000)) / 100
+
+
+def posting(kind, accounts, rng, amount=None):
+    """A random posting of the given kind between the accounts."""
+    consumer = rng.choice(accounts.users['consumer']).username
+    amount = amount or _amount(rng)
+    if kind == 'purchase':
+        product_id = rng.choice(accounts.products)
+        return Posting(kind, consumer, reverse('purchase_product', args=[product_id]), {}, Decimal(0))
+    if kind == 'recharge':
+        return Posting(kind, consumer, reverse('recharge_balance'), {'amount': amount}, amount)
+    agent = rng.choice(accounts.users['agent']).username
+    data = {'consumer_username': consumer, 'amount': amount}
+    if kind == 'agent_cash_in':
+        return Posting(kind, agent, reverse('accept_cash_payment'), data, amount)
+    if kind == 'agent_cash_out':
+        return Posting(kind, agent, reverse('cash_out_consumer'), data, -amount)
+    if kind == 'bill_payment':
+        data.update(bill_type=accounts.bill.bill_type, account_number=accounts.bill.account_number)
+        return Posting(kind, agent, reverse('pay_bill_on_behalf'), data, -amount)
+    raise ValueError(f'Unknown posting kind: {kind}')
+
+
+def _applied(kind, response):
+    # Purchases answer 200 or 403, recharges redirect; the agent pages show a success or error message
+    if kind == 'purchase':
+        return response.status_code == 200
+    if kind == 'recharge':
+        return response.status_code == 302
+    return response.status_code == 200 and b'Successfully' in response.content
+
+
+def _send(sessions, postings, start=None):
+    clients = {}
+    outcomes = []
+    if start is not None:
+        start.wait()
+    try:
+        for item in postings:
+            client = clients.get(item.username)
+            if client is None:
+                client = clients[item.username] = Client(raise_request_exception=False)
+                client.cookies[settings.SESSION_COOKIE_NAME] = sessions[item.username]
+            sent = time.perf_counter()
+            response = client.post(item.url, item.data, headers={'Idempotency-Key': uuid.uuid4().hex})
+            seconds = time.perf_counter() - sent
+            error = repr(response.exc_info[1]) if response.exc_info else None
+            outcomes.append(Outcome(item.kind, response.status_code, _applied(item.kind, response), seconds, error))
+    finally:
+        connections.close_all()
+    return outcomes
+
+
+def _send_in_process(args):
+    return _send(*args)
+
+
+def run(accounts, postings, workers, processes=False):
+    """
+    Send the postings through the views from workers threads, or forked
+    processes, at once, each taking every workers-th posting in turn. Returns
+    the outcomes, in the order of the postings, and the wall-clock seconds
+    taken.
+    """
+    shares = [postings[n::workers] for n in range(workers)]
+    if processes:
+        # Children must open connections of their own rather than share the parent's
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            started = time.perf_counter()
+            results = pool.map(_send_in_process, [(accounts.sessions, share) for share in shares])
+            seconds = time.perf_counter() - started
+    else:
+        results = [None] * workers
+        start = threading.Barrier(workers + 1)
+
+        def work(n):
+            results[n] = _send(accounts.sessions, shares[n], start)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(workers)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+    outcomes = [None] * len(postings)
+    for n, result in enumerate(results):
+        outcomes[n::workers] = result
+    return outcomes, seconds
+
+
+def fund(accounts, amount):
+    """Give every consumer amount through an agent cash-in, one at a time; returns the postings and outcomes."""
+    agent = accounts.users['agent'][0].username
+    postings = [
+        Posting('agent_cash_in', agent, reverse('accept_cash_payment'), {'consumer_username': consumer.username, 'amount': amount}, amount)
+        for consumer in accounts.users['consumer']
+    ]
+    outcomes = _send(accounts.sessions, postings)
+    if not all(outcome.applied for outcome in outcomes):
+        raise RuntimeError('Funding the stress accounts failed.')
+    return postings, outcomes
+
+
+def summary(outcomes, seconds):
+    latencies = sorted(outcome.seconds for outcome in outcomes)
+    return {
+        'postings': len(outcomes),
+        'applied': sum(outcome.applied for outcome in outcomes),
+        'rejected': sum(not outcome.applied and outcome.status_code < 500 for outcome in outcomes),
+        'errors': sum(outcome.status_code >= 500 for outcome in outcomes),
+        'seconds': round(seconds, 2),
+        'postings_per_second': round(len(outcomes) / seconds, 1) if seconds else None,
+        'p95_ms': round(latencies[max(0, -(-len(latencies) * 95 // 100) - 1)] * 1000, 1) if latencies else None,
+    }
+
+
+def check_ledger(accounts, postings, outcomes):
+    """
+    Check the ledger of the stress accounts against what the views answered,
+    returning a list of the problems found (empty when it is sound):
+
+    - money is conserved: the consumers' and merchants' balances add up to
+      the net cash that came in through applied recharges, agent cash-ins,
+      cash-outs and bill payments; purchases only move it between them
+    - every balance is backed by its Transaction rows, and so is every
+      balance snapshot, with no rows beyond those of the applied postings
+    - no balance is negative
+    """
+    problems = []
+    applied = [item for item, outcome in zip(postings, outcomes) if outcome.applied]
+    expected_total = sum((item.external for item in applied), Decimal(0))
+    expected_rows = sum(ROWS[item.kind] for item in applied)
+
+    user_ids = accounts.user_ids('consumer', 'merchant', 'agent')
+    history = defaultdict(lambda: dict.fromkeys(balances.TOTAL_FIELDS, Decimal(0)))
+    rows = 0
+    for alias, ids in group_by_shard(user_ids).items():
+        for totals in Transaction.objects.on_shard(alias).filter(user_id__in=ids).values('user_id').annotate(**balances.totals_query()):
+            history[totals['user_id']] = {field: totals[field] for field in balances.TOTAL_FIELDS}
+        rows += Transaction.objects.on_shard(alias).filter(user_id__in=ids).count()
+    if rows != expected_rows:
+        problems.append(f'{rows} Transaction rows for {len(applied)} applied postings; expected {expected_rows}.')
+
+    held = {}
+    for alias, ids in group_by_shard(accounts.user_ids('consumer')).items():
+        held.update(ConsumerProfile.objects.on_shard(alias).filter(user_id__in=ids).values_list('user_id', 'balance'))
+    held.update(MerchantProfile.objects.filter(user_id__in=accounts.user_ids('merchant')).values_list('user_id', 'balance'))
+    total = sum(held.values(), Decimal(0))
+    if total != expected_total:
+        problems.append(f'Consumers and merchants hold {total}; the applied postings brought in {expected_total}.')
+
+    for user_id, balance in sorted(held.items()):
+        totals = history[user_id]
+        from_history = totals['cash_in'] - totals['cash_out'] - totals['bill_payment']
+        if balance != from_history:
+            problems.append(f'User {user_id} has a balance of {balance} but transactions adding up to {from_history}.')
+        if balance < 0:
+            problems.append(f'User {user_id} has a negative balance of {balance}.')
+
+    for alias, ids in group_by_shard(user_ids).items():
+        for snapshot in BalanceSnapshot.objects.on_shard(alias).filter(user_id__in=ids):
+            stored = {field: getattr(snapshot, field) for field in balances.TOTAL_FIELDS}
+            if stored != history[snapshot.user_id]:
+                problems.append(f'The snapshot of user {snapshot.user_id} says {stored}; its transactions say {history[snapshot.user_id]}.')
+    return problems
+
+
+def stress(
+    prefix, postings=2000, workers=8, processes=False, consumers=50, merchants=5, agents=5, mix=None,
+    amount=None, opening=Decimal('100.00'), seed=0,
+):
+    """
+    Create the stress accounts, fund each consumer with opening, fire the
+    given number of random postings drawn from mix (of amount, or random
+    amounts) at the views with workers concurrent threads or processes, then
+    check the ledger. Returns the accounts, the outcomes, a summary with the
+    throughput, and the problems check_ledger found.
+    """
+    rng = random.Random(seed)
+    accounts = Accounts(prefix, consumers, merchants, agents)
+    funding, funded = fund(accounts, opening) if opening else ([], [])
+    mix = mix or DEFAULT_MIX
+    kinds, weights = list(mix), list(mix.values())
+    planned = [posting(kind, accounts, rng, amount) for kind in rng.choices(kinds, weights, k=postings)]
+    outcomes, seconds = run(accounts, planned, workers, processes)
+    problems = check_ledger(accounts, funding + planned, funded + outcomes)
+    return accounts, outcomes, summary(outcomes, seconds), problems
@@ -1,3 +1,1338 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.http import HttpResponse
+from django.test import AsyncClient, Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import get_resolver, resolve
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.serializers import DecimalField, ModelSerializer
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import archive, balances, catalog, consumers, exports, ledger, metrics, pagination, references, routers, search, sharding, slow_queries, stress
+from .money import MoneyField, from_minor_units, parse_amount, to_minor_units
+from .sharding import shard_for
+from .auth import ProfileBackend
+from .serializers import ProductSerializer
+from .models import (
+    ArchivedTransaction, BalanceSnapshot, Bill, BillPayment, ConsumerProfile, MerchantProfile, Product, RequestProfile, Service, SlowQuery, Subscription, Transaction, User,
+)
+
+# Postings per stress test; raise it to soak the ledger for longer
+STRESS_POSTINGS = int(os.getenv('STRESS_POSTINGS', 1000))
+
+
+class MoneyTests(TestCase):
+    databases = '__all__'
+
+    # Amounts a form may send that cannot be stored as whole cents
+    INVALID = ['1e30', '0.001', '1e-5', 'NaN', 'Infinity', '-Infinity', 'sNaN', 'ten']
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='money-consumer', password='pw', user_type='consumer')
+        self.agent = User.objects.create_user(username='money-agent', password='pw', user_type='agent')
+
+    def test_conversion_to_minor_units(self):
+        self.assertEqual(to_minor_units('12.34'), 1234)
+        self.assertEqual(to_minor_units(Decimal('0.125')), 12)
+        self.assertEqual(from_minor_units(1234), Decimal('12.34'))
+        for value in ['NaN', 'Infinity', '1e30']:
+            with self.subTest(value), self.assertRaises(ValueError):
+                to_minor_units(value)
+
+    def test_parse_amount(self):
+        self.assertEqual(parse_amount(' 12.50 '), Decimal('12.50'))
+        for value in self.INVALID + [None]:
+            with self.subTest(value), self.assertRaises(ValueError):
+                parse_amount(value)
+
+    def test_views_reject_amounts_they_cannot_store(self):
+        consumer, agent = Client(), Client()
+        consumer.force_login(self.consumer)
+        agent.force_login(self.agent)
+        for value in self.INVALID:
+            with self.subTest(value):
+                self.assertEqual(consumer.post('/consumer/recharge-balance/', {'amount': value}).status_code, 403)
+                for path in ['/agent/accept-cash-payment/', '/agent/cash-out-consumer/', '/agent/pay-bill-on-behalf/']:
+                    response = agent.post(path, {'consumer_username': self.consumer.username, 'amount': value})
+                    self.assertContains(response, 'Invalid consumer username or amount.')
+        self.assertFalse(Transaction.objects.for_user(self.consumer.id).exists())
+        self.assertEqual(ConsumerProfile.objects.for_user(self.consumer.id).get().balance, Decimal('0.00'))
+
+
+class BatchCashTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='batch-consumer', password='pw', user_type='consumer')
+        self.agent = User.objects.create_user(username='batch-agent', password='pw', user_type='agent')
+        self.client.force_login(self.agent)
+
+    def post_rows(self, *rows):
+        response = self.client.post('/agent/batch-cash/', {'rows': rows}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_each_row_is_checked_on_its_own(self):
+        name = self.consumer.username
+        result = self.post_rows(
+            {'consumer_username': name, 'amount': '10.00', 'direction': 'cash_in'},
+            {'consumer_username': name, 'amount': '1e30', 'direction': 'cash_in'},
+            {'consumer_username': name, 'amount': '0.004', 'direction': 'cash_in'},
+            {'consumer_username': name, 'amount': 'NaN', 'direction': 'cash_in'},
+            {'consumer_username': name, 'amount': '4.00', 'direction': 'cash_out'},
+            {'consumer_username': name, 'amount': '7.00', 'direction': 'cash_out'},
+            {'consumer_username': 'nobody', 'amount': '1.00', 'direction': 'cash_in'},
+        )
+        self.assertEqual([row['status'] for row in result['results']], ['ok', 'error', 'error', 'error', 'ok', 'error', 'error'])
+        self.assertEqual(result['results'][5]['error'], 'Insufficient balance.')
+        self.assertEqual(ConsumerProfile.objects.for_user(self.consumer.id).get().balance, Decimal('6.00'))
+        self.assertEqual(
+            sorted(Transaction.objects.for_user(self.consumer.id).values_list('amount', flat=True)), [Decimal('4.00'), Decimal('10.00')],
+        )
+
+
+class LedgerTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='ledger-consumer', password='pw', user_type='consumer')
+        self.merchant = User.objects.create_user(username='ledger-merchant', password='pw', user_type='merchant')
+        ConsumerProfile.objects.for_user(self.consumer.id).update(balance=Decimal('10.00'))
+
+    def balances(self):
+        return (
+            ConsumerProfile.objects.for_user(self.consumer.id).get().balance,
+            MerchantProfile.objects.get(user=self.merchant).balance,
+        )
+
+    def purchase(self, amount):
+        return ledger.post(
+            [ledger.entry('cash_out', self.consumer.id, amount), ledger.entry('cash_in', self.merchant.id, amount)],
+            debit_from=(ConsumerProfile, self.consumer.id, amount),
+            credit_to=(MerchantProfile, self.merchant.id, amount),
+        )
+
+    def test_posting_moves_the_amount_and_records_it(self):
+        entries = self.purchase(Decimal('10.00'))
+        self.assertEqual(self.balances(), (Decimal('0.00'), Decimal('10.00')))
+        self.assertEqual(
+            set(Transaction.objects.for_user(self.consumer.id).values_list('reference_id', flat=True)), {entries[0].reference_id},
+        )
+
+    def test_debit_that_would_overdraw_rolls_the_posting_back(self):
+        with self.assertRaises(ledger.InsufficientBalance):
+            self.purchase(Decimal('10.01'))
+        self.assertEqual(self.balances(), (Decimal('10.00'), Decimal('0.00')))
+        self.assertFalse(Transaction.objects.for_user(self.consumer.id).exists())
+        self.assertFalse(Transaction.objects.for_user(self.merchant.id).exists())
+
+    def test_credit_to_a_missing_account_rolls_the_debit_back(self):
+        MerchantProfile.objects.filter(user=self.merchant).delete()
+        with self.assertRaises(ledger.AccountNotFound):
+            self.purchase(Decimal('4.00'))
+        self.assertEqual(ConsumerProfile.objects.for_user(self.consumer.id).get().balance, Decimal('10.00'))
+        self.assertFalse(Transaction.objects.for_user(self.consumer.id).exists())
+
+    def test_debit_from_a_missing_account(self):
+        ConsumerProfile.objects.for_user(self.consumer.id).delete()
+        with self.assertRaises(ledger.AccountNotFound):
+            self.purchase(Decimal('4.00'))
+        self.assertEqual(MerchantProfile.objects.get(user=self.merchant).balance, Decimal('0.00'))
+
+
+class LedgerViewTests(TestCase):
+    # Money posted through the views, then read back from the balance and history pages
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='pages-consumer', password='pw', user_type='consumer')
+        self.merchant = User.objects.create_user(username='pages-merchant', password='pw', user_type='merchant')
+        self.agent = User.objects.create_user(username='pages-agent', password='pw', user_type='agent')
+        self.product = Product.objects.create(merchant=self.merchant, name='Kettle', description='A kettle', price=Decimal('4.00'))
+        consumer, agent = self.client_for(self.consumer), self.client_for(self.agent)
+        consumer.post('/consumer/recharge-balance/', {'amount': '10.00'})
+        consumer.post(f'/purchase-product/{self.product.id}/')
+        agent.post('/agent/cash-out-consumer/', {'consumer_username': self.consumer.username, 'amount': '1.00'})
+
+    def client_for(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def test_balance_pages(self):
+        self.assertContains(self.client_for(self.consumer).get('/consumer/balance-view/'), 'Your current balance is: $5.00')
+        self.assertContains(self.client_for(self.merchant).get('/merchant/balance-view/'), 'Your current balance is: $4.00')
+        agent = self.client_for(self.agent)
+        self.assertContains(agent.post('/agent/consumer-balance-view/', {'consumer_username': self.consumer.username}), '5.00')
+
+    def test_history_pages(self):
+        consumer = self.client_for(self.consumer).get('/consumer/transaction-history/')
+        self.assertEqual(len(consumer.context['transactions']), 3)
+        merchant = self.client_for(self.merchant).get('/merchant/transaction-history/')
+        self.assertEqual([t.amount for t in merchant.context['transactions']], [Decimal('4.00')])
+        agent = self.client_for(self.agent)
+        self.assertEqual(len(agent.get('/agent/transaction-history/').context['transactions']), 1)
+        response = agent.post('/agent/transaction-history/', {'consumer_username': self.consumer.username})
+        self.assertEqual(len(response.context['transactions']), 3)
+
+    def test_pages_belong_to_their_role(self):
+        client = self.client_for(self.merchant)
+        for path in ['/consumer/balance-view/', '/consumer/transaction-history/', '/agent/transaction-history/']:
+            with self.subTest(path):
+                self.assertEqual(client.get(path).status_code, 403)
+        self.assertEqual(self.client_for(self.consumer).get('/merchant/balance-view/').status_code, 403)
+
+    def post_for_vanished_consumer(self, path, data):
+        # The profile goes as if another process removed it: this one's cached lookup still names it
+        consumers.resolve_consumer(self.consumer.username)
+        with mock.patch.object(consumers, 'forget_consumer'):
+            ConsumerProfile.objects.for_user(self.consumer.id).delete()
+        return self.client_for(self.agent).post(path, {'consumer_username': self.consumer.username, **data})
+
+    def test_cash_out_for_a_vanished_consumer(self):
+        response = self.post_for_vanished_consumer('/agent/cash-out-consumer/', {'amount': '1.00'})
+        self.assertContains(response, 'Invalid consumer username or amount.')
+
+    def test_bill_payment_for_a_vanished_consumer(self):
+        response = self.post_for_vanished_consumer(
+            '/agent/pay-bill-on-behalf/', {'bill_type': 'water', 'account_number': '1', 'amount': '1.00'},
+        )
+        self.assertContains(response, 'Invalid consumer username or amount.')
+
+
+class BalanceSnapshotTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='snapshot-consumer', password='pw', user_type='consumer')
+
+    def recharge(self, amount):
+        ledger.post([ledger.entry('cash_in', self.consumer.id, amount)], credit_to=(ConsumerProfile, self.consumer.id, amount))
+
+    def check_drift(self):
+        out = io.StringIO()
+        call_command('check_balance_drift', stdout=out)
+        return out.getvalue()
+
+    def test_postings_keep_the_snapshot_in_step(self):
+        self.recharge(Decimal('4.00'))
+        self.assertEqual(balances.get_snapshot(self.consumer.id).balance, Decimal('4.00'))
+        self.recharge(Decimal('2.50'))
+        self.assertEqual(balances.get_snapshot(self.consumer.id).balance, Decimal('6.50'))
+        self.assertIn('All balances match', self.check_drift())
+
+    def test_drift_is_reported(self):
+        self.recharge(Decimal('4.00'))
+        ConsumerProfile.objects.for_user(self.consumer.id).update(balance=Decimal('5.00'))
+        with self.assertRaisesMessage(CommandError, '1 balances have drifted'):
+            self.check_drift()
+        self.assertEqual(
+            [(profile.user_id, balance) for profile, balance in balances.drift()], [(self.consumer.id, Decimal('4.00'))],
+        )
+
+    def test_rebuild_restores_the_snapshot_from_history(self):
+        self.recharge(Decimal('4.00'))
+        BalanceSnapshot.objects.for_user(self.consumer.id).update(cash_in=0)
+        call_command('rebuild_balance_snapshots', self.consumer.username, stdout=io.StringIO())
+        self.assertEqual(balances.get_snapshot(self.consumer.id).balance, Decimal('4.00'))
+        self.assertIn('All balances match', self.check_drift())
+
+
+class PaginationTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='page-consumer', password='pw', user_type='consumer')
+        self.client.force_login(self.consumer)
+        ledger.post([ledger.entry('cash_in', self.consumer.id, Decimal('1.00')) for _ in range(5)])
+        # Rows posted together share a timestamp, so the id alone orders them
+        Transaction.objects.for_user(self.consumer.id).update(timestamp=timezone.now() - timedelta(days=1))
+        self.ids = sorted(Transaction.objects.for_user(self.consumer.id).values_list('id', flat=True), reverse=True)
+
+    def walk(self, page_size, archived=None):
+        ids, pages, cursor = [], 0, None
+        while True:
+            rows, cursor = pagination.keyset_page(Transaction.objects.for_user(self.consumer.id), cursor, page_size, archived)
+            ids += [row.id for row in rows]
+            pages += 1
+            if cursor is None:
+                return ids, pages
+
+    def test_rows_sharing_a_timestamp_are_each_paged_once(self):
+        self.assertEqual(self.walk(2), (self.ids, 3))
+        # A last page that is exactly full has no next page
+        self.assertEqual(self.walk(5), (self.ids, 1))
+
+    def test_bad_cursors_are_refused(self):
+        paginator = pagination.TransactionCursorPagination()
+        for cursor in ['nonsense', base64.urlsafe_b64encode(b'yesterday|1').decode(), base64.urlsafe_b64encode(b'2024-01-01T00:00:00|x').decode()]:
+            with self.subTest(cursor):
+                with self.assertRaises(ValueError):
+                    pagination.decode_cursor(cursor)
+                request = Request(RequestFactory().get('/transactions/', {'cursor': cursor}))
+                with self.assertRaises(NotFound):
+                    paginator.paginate_queryset(Transaction.objects.for_user(self.consumer.id), request)
+                # The HTML history starts over from the first page
+                response = self.client.get('/consumer/transaction-history/', {'cursor': cursor})
+                self.assertEqual([row.id for row in response.context['transactions']], self.ids)
+
+    def test_archived_rows_are_merged_in_order(self):
+        shard = shard_for(self.consumer.id)
+        self.assertEqual(archive.archive_batch(timezone.now(), 2, shard), 2)
+        self.assertEqual(Transaction.objects.for_user(self.consumer.id).count(), 3)
+        self.assertEqual(self.walk(2, ArchivedTransaction.objects.for_user(self.consumer.id)), (self.ids, 3))
+
+
+class ExportTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumer = User.objects.create_user(username='export-consumer', password='pw', user_type='consumer')
+        self.merchant = User.objects.create_user(username='export-merchant', password='pw', user_type='merchant')
+        self.agent = User.objects.create_user(username='export-agent', password='pw', user_type='agent')
+        old, recent, today = ledger.post([
+            ledger.entry('cash_in', self.consumer.id, Decimal('10.00')),
+            ledger.entry('cash_in', self.consumer.id, Decimal('5.00')),
+            ledger.entry('cash_out', self.consumer.id, Decimal('3.00')),
+        ])
+        ledger.post([ledger.entry('cash_in', self.merchant.id, Decimal('7.00'))])
+        for row, age in [(old, 400), (recent, 2)]:
+            Transaction.objects.for_user(self.consumer.id).filter(id=row.id).update(timestamp=timezone.now() - timedelta(days=age))
+        self.assertEqual(archive.archive_batch(archive.archive_cutoff(), 10, shard_for(self.consumer.id)), 1)
+        self.references = [old.reference_id, recent.reference_id, today.reference_id]
+
+    def export(self, user, path, **params):
+        client = Client()
+        client.force_login(user)
+        response = client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def csv_rows(self, user, path, **params):
+        response, body = self.export(user, path, **params)
+        header, *rows = csv.reader(io.StringIO(body))
+        self.assertEqual(header, exports.EXPORT_FIELDS)
+        return [(row[0], row[2], row[3]) for row in rows]
+
+    def test_csv_includes_archived_rows_oldest_first(self):
+        response, body = self.export(self.consumer, '/consumer/export-transactions/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertRegex(response['Content-Disposition'], r'^attachment; filename="export-consumer-transactions-\d{8}\.csv"$')
+        self.assertEqual(self.csv_rows(self.consumer, '/consumer/export-transactions/'), [
+            (self.references[0], 'cash_in', '10.00'), (self.references[1], 'cash_in', '5.00'), (self.references[2], 'cash_out', '3.00'),
+        ])
+
+    def test_ndjson(self):
+        response, body = self.export(self.consumer, '/consumer/export-transactions/', format='ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([list(row) for row in rows], [exports.EXPORT_FIELDS] * 3)
+        self.assertEqual(rows[0], {
+            'reference_id': self.references[0], 'timestamp': rows[0]['timestamp'], 'transaction_type': 'cash_in', 'amount': '10.00',
+            'status': 'completed',
+        })
+
+    def test_date_and_type_filters(self):
+        path = '/consumer/export-transactions/'
+        self.assertEqual([row[0] for row in self.csv_rows(self.consumer, path, transaction_type='cash_in')], self.references[:2])
+        # A range starting after the archive horizon leaves the archive out
+        recent = (timezone.now() - timedelta(days=3)).date().isoformat()
+        self.assertEqual([row[0] for row in self.csv_rows(self.consumer, path, date_from=recent)], self.references[1:])
+        yesterday = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.assertEqual([row[0] for row in self.csv_rows(self.consumer, path, date_to=yesterday)], self.references[:2])
+
+    def test_merchant_and_agent_exports(self):
+        self.assertEqual([row[1:] for row in self.csv_rows(self.merchant, '/merchant/export-transactions/')], [('cash_in', '7.00')])
+        path = '/agent/export-consumer-transactions/'
+        rows = self.csv_rows(self.agent, path, consumer_username='export-consumer')
+        self.assertEqual([row[0] for row in rows], self.references)
+        client = Client()
+        client.force_login(self.agent)
+        self.assertEqual(client.get(path, {'consumer_username': 'nobody'}).context['error_message'], 'Consumer not found. Please check the username.')
+
+    def test_exports_belong_to_their_role(self):
+        for user, path in [
+            (self.merchant, '/consumer/export-transactions/'),
+            (self.consumer, '/merchant/export-transactions/'),
+            (self.consumer, '/agent/export-consumer-transactions/?consumer_username=export-consumer'),
+        ]:
+            with self.subTest(path):
+                client = Client()
+                client.force_login(user)
+                self.assertEqual(client.get(path).status_code, 403)
+        self.assertEqual(Client().get('/consumer/export-transactions/').status_code, 302)
+
+
+class ReferenceIdTests(TestCase):
+    databases = '__all__'
+
+    def test_format(self):
+        reference = references.new_reference()
+        self.assertEqual(len(reference), references.LENGTH)
+        self.assertLessEqual(set(reference), set(references.ALPHABET))
+
+    def test_references_sort_by_time(self):
+        self.assertLess(references.reference_at(1_700_000_000_000), references.reference_at(1_700_000_000_001))
+        self.assertLess(references.reference_at(1_700_000_000_000), references.new_reference())
+
+    def test_references_increase_within_a_millisecond_and_when_the_clock_steps_back(self):
+        now = time.time_ns()
+        issued = []
+        for clock in [now] * 50 + [now - 5_000_000] * 50:
+            with mock.patch.object(references.time, 'time_ns', return_value=clock):
+                issued.append(references.new_reference())
+        self.assertEqual(issued, sorted(set(issued)))
+
+    def test_rows_posted_in_order_have_ordered_references(self):
+        consumer = User.objects.create_user(username='reference-consumer', password='pw', user_type='consumer')
+        for _ in range(3):
+            ledger.post([ledger.entry('cash_in', consumer.id, Decimal('1.00')) for _ in range(3)])
+        rows = Transaction.objects.for_user(consumer.id).order_by('id').values_list('reference_id', flat=True)
+        self.assertEqual(list(rows), sorted(rows))
+
+
+class IdempotencyTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+        self.addCleanup(logging.getLogger('django.request').setLevel, logging.NOTSET)
+        self.consumer = User.objects.create_user(username='idem-consumer', password='pw', user_type='consumer')
+        self.agent = User.objects.create_user(username='idem-agent', password='pw', user_type='agent')
+
+    def balance(self):
+        return ConsumerProfile.objects.for_user(self.consumer.id).get().balance
+
+    def test_retry_replays_the_first_response(self):
+        self.client.force_login(self.consumer)
+        first = self.client.post('/consumer/recharge-balance/', {'amount': '5.00', 'idempotency_key': 'k1'})
+        retry = self.client.post('/consumer/recharge-balance/', {'amount': '5.00', 'idempotency_key': 'k1'})
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.balance(), Decimal('5.00'))
+        self.assertEqual(Transaction.objects.for_user(self.consumer.id).count(), 1)
+
+    def test_key_reused_for_a_different_body_is_refused(self):
+        self.client.force_login(self.consumer)
+        self.client.post('/consumer/recharge-balance/', {'amount': '5.00', 'idempotency_key': 'k1'})
+        response = self.client.post('/consumer/recharge-balance/', {'amount': '500.00', 'idempotency_key': 'k1'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.balance(), Decimal('5.00'))
+
+    def test_json_key_order_does_not_change_the_fingerprint(self):
+        self.client.force_login(self.agent)
+        name = self.consumer.username
+        for row in [
+            {'consumer_username': name, 'amount': '3.00', 'direction': 'cash_in'},
+            {'direction': 'cash_in', 'amount': '3.00', 'consumer_username': name},
+        ]:
+            response = self.client.post(
+                '/agent/batch-cash/', {'rows': [row]}, content_type='application/json', headers={'Idempotency-Key': 'batch-1'},
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.balance(), Decimal('3.00'))
+
+    def test_purchases_need_a_post(self):
+        merchant = User.objects.create_user(username='idem-merchant', password='pw', user_type='merchant')
+        product = Product.objects.create(merchant=merchant, name='Pen', description='', price=Decimal('1.00'))
+        self.client.force_login(self.consumer)
+        self.assertEqual(self.client.get(f'/purchase-product/{product.id}/').status_code, 405)
+        self.assertFalse(Transaction.objects.for_user(self.consumer.id).exists())
+
+
+class ConsumerLookupTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.consumer = User.objects.create_user(username='lookup-consumer', password='pw', user_type='consumer')
+
+    def test_repeat_lookups_are_served_from_the_cache(self):
+        consumer = consumers.resolve_consumer('lookup-consumer')
+        self.assertEqual((consumer.id, consumer.username), (self.consumer.id, 'lookup-consumer'))
+        with self.assertNumQueries(0):
+            self.assertEqual(consumers.resolve_consumer('lookup-consumer'), consumer)
+
+    async def test_async_lookups_share_the_cache(self):
+        consumer = await consumers.aresolve_consumer('lookup-consumer')
+        self.assertEqual(consumers.resolve_consumer('lookup-consumer'), consumer)
+
+    def test_renamed_and_deleted_consumers_are_not_found(self):
+        consumers.resolve_consumer('lookup-consumer')
+        self.consumer.username = 'lookup-renamed'
+        self.consumer.save()
+        with self.assertRaises(User.DoesNotExist):
+            consumers.resolve_consumer('lookup-consumer')
+        self.assertEqual(consumers.resolve_consumer('lookup-renamed').id, self.consumer.id)
+        self.consumer.delete()
+        with self.assertRaises(User.DoesNotExist):
+            consumers.resolve_consumer('lookup-renamed')
+
+    def test_forget_consumer_drops_a_change_made_without_signals(self):
+        # As another process's change would look from here: the row changes, no signal fires
+        consumers.resolve_consumer('lookup-consumer')
+        User.objects.filter(id=self.consumer.id).update(username='lookup-renamed')
+        self.assertEqual(consumers.resolve_consumer('lookup-consumer').id, self.consumer.id)
+        consumers.forget_consumer(self.consumer.id)
+        with self.assertRaises(User.DoesNotExist):
+            consumers.resolve_consumer('lookup-consumer')
+
+    def test_entries_expire_after_the_ttl(self):
+        consumers.resolve_consumer('lookup-consumer')
+        User.objects.filter(id=self.consumer.id).update(username='lookup-renamed')
+        self.assertEqual(consumers.resolve_consumer('lookup-consumer').id, self.consumer.id)
+        expired = time.time() + settings.CONSUMER_CACHE_TTL + 1
+        with mock.patch('time.time', return_value=expired), self.assertRaises(User.DoesNotExist):
+            consumers.resolve_consumer('lookup-consumer')
+
+
+class CatalogTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+        self.addCleanup(logging.getLogger('django.request').setLevel, logging.NOTSET)
+        cache.clear()
+        self.consumer = User.objects.create_user(username='catalog-consumer', password='pw', user_type='consumer')
+        self.merchants = [
+            User.objects.create_user(username=f'catalog-merchant-{n}', password=None, user_type='merchant') for n in range(2)
+        ]
+        self.products = [
+            Product.objects.create(merchant=merchant, name=f'Kettle {n}', price=Decimal('3.00'))
+            for n, merchant in enumerate(self.merchants)
+        ]
+
+    def test_browse_services_and_subscribe(self):
+        service = Service.objects.create(merchant=self.merchants[0], name='Descaling', subscription_fee=Decimal('2.00'))
+        self.client.force_login(self.consumer)
+        self.assertContains(self.client.get('/browse-services/'), f'formaction="/subscribe-service/{service.id}/"')
+        self.assertEqual(self.client.get(f'/subscribe-service/{service.id}/').status_code, 405)
+        self.assertRedirects(self.client.post(f'/subscribe-service/{service.id}/'), '/browse-services/')
+        self.assertTrue(Subscription.objects.filter(consumer=self.consumer, service=service).exists())
+
+    def test_change_rerenders_only_its_merchant(self):
+        catalog.render_catalog('products')
+        with self.assertNumQueries(0):
+            catalog.render_catalog('products')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].name = 'Teapot'
+            self.products[0].save()
+        # The merchant list is still cached; only the changed merchant's rows are read again
+        with self.assertNumQueries(1):
+            blocks = catalog.render_catalog('products')
+        self.assertIn('Teapot', blocks[0])
+        self.assertIn('Kettle 1', blocks[1])
+
+    def test_new_merchant_joins_the_listing(self):
+        catalog.render_catalog('products')
+        merchant = User.objects.create_user(username='catalog-merchant-new', password=None, user_type='merchant')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(merchant=merchant, name='Toaster', price=Decimal('9.00'))
+        self.assertIn('Toaster', catalog.render_catalog('products')[-1])
+
+    def test_one_caller_recomputes_a_missing_entry(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'block'
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            results = list(pool.map(lambda _: catalog._get_or_compute('catalog:test:single-flight', compute), range(5)))
+        self.assertEqual(results, ['block'] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class SearchTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.merchant = User.objects.create_user(username='search-merchant', password='pw', user_type='merchant')
+        self.kettle = Product.objects.create(merchant=self.merchant, name='Electric kettle', description='Boils water', price=Decimal('20.00'))
+        self.tea = Service.objects.create(merchant=self.merchant, name='Tea club', description='A kettle of tea a month', subscription_fee=Decimal('5.00'))
+
+    def found(self, query, **kwargs):
+        return [(result.kind, result.item.id) for result in search.search_catalog(query, **kwargs).results]
+
+    def test_prefixes_of_every_word_match_across_kinds(self):
+        self.assertEqual(self.found('kett'), [('products', self.kettle.id), ('services', self.tea.id)])
+        self.assertEqual(self.found('kettle boil'), [('products', self.kettle.id)])
+        self.assertEqual(self.found('kettle', kinds=('services',)), [('services', self.tea.id)])
+        self.assertEqual(self.found('toaster'), [])
+
+    def test_query_syntax_is_not_passed_through(self):
+        for query in ['kettle"', '(kettle)', 'kettle*', '-kettle', 'kettle:^']:
+            with self.subTest(query):
+                self.assertIn(('products', self.kettle.id), self.found(query))
+        self.assertEqual(self.found('"* ()'), [])
+
+    def test_saves_and_deletes_keep_the_index_in_step(self):
+        self.kettle.name = 'Electric toaster'
+        self.kettle.description = ''
+        self.kettle.save()
+        self.assertEqual(self.found('toaster'), [('products', self.kettle.id)])
+        self.assertEqual(self.found('kettle'), [('services', self.tea.id)])
+        self.tea.delete()
+        self.assertEqual(self.found('kettle'), [])
+
+    def test_rebuild_picks_up_changes_made_without_saves(self):
+        Product.objects.filter(id=self.kettle.id).update(name='Stovetop percolator')
+        self.assertEqual(self.found('percolator'), [])
+        call_command('rebuild_search_index', 'products', stdout=io.StringIO())
+        self.assertEqual(self.found('percolator'), [('products', self.kettle.id)])
+
+
+class LedgerStressTests(TransactionTestCase):
+    # Postings from concurrent threads and processes through the real views, on file-backed test databases,
+    # then the ledger checked against what the views answered
+    databases = '__all__'
+
+    def setUp(self):
+        # Every purchase the balance cannot cover would log a warning
+        logger = logging.getLogger('django.request')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+
+    def assertSound(self, outcomes, summary, problems):
+        self.assertEqual(problems, [])
+        self.assertEqual([outcome.error for outcome in outcomes if outcome.status_code >= 500], [])
+        self.assertGreater(summary['applied'], 0)
+
+    def test_mixed_postings_from_threads(self):
+        _, outcomes, summary, problems = stress.stress('threads', postings=STRESS_POSTINGS, workers=8)
+        self.assertSound(outcomes, summary, problems)
+
+    def test_mixed_postings_from_processes(self):
+        _, outcomes, summary, problems = stress.stress('processes', postings=STRESS_POSTINGS, workers=8, processes=True)
+        self.assertSound(outcomes, summary, problems)
+
+    def test_agents_cashing_out_the_same_consumer(self):
+        accounts, outcomes, summary, problems = stress.stress(
+            'cash-out', postings=200, workers=8, consumers=1, agents=2,
+            mix={'agent_cash_out': 1}, amount=Decimal('7.00'), opening=Decimal('100.00'),
+        )
+        self.assertSound(outcomes, summary, problems)
+        # 14 cash-outs of 7.00 fit in 100.00; every other one must be turned down
+        self.assertEqual(summary['applied'], 14)
+        consumer_id = accounts.user_ids('consumer')[0]
+        self.assertEqual(ConsumerProfile.objects.for_user(consumer_id).get().balance, Decimal('2.00'))
+
+    def test_consumers_buying_from_the_same_merchant(self):
+        accounts, outcomes, summary, problems = stress.stress(
+            'purchases', postings=STRESS_POSTINGS // 2, workers=8, consumers=50, merchants=1, mix={'purchase': 1},
+        )
+        self.assertSound(outcomes, summary, problems)
+        merchant = MerchantProfile.objects.get(user_id=accounts.user_ids('merchant')[0])
+        self.assertEqual(merchant.balance, Decimal('7.00') * summary['applied'])
+
+    def test_check_ledger_finds_unbacked_balances(self):
+        accounts = stress.Accounts('tampered', consumers=2, merchants=1, agents=1)
+        postings, outcomes = stress.fund(accounts, Decimal('10.00'))
+        self.assertEqual(stress.check_ledger(accounts, postings, outcomes), [])
+        ConsumerProfile.objects.for_user(accounts.user_ids('consumer')[0]).update(balance=Decimal('1000.00'))
+        problems = stress.check_ledger(accounts, postings, outcomes)
+        self.assertEqual(len(problems), 2)
+        self.assertIn('hold 1010.00', problems[0])
+
+
+class SeedDataTests(TestCase):
+    databases = '__all__'
+
+    def test_seeded_history_backs_the_balances(self):
+        call_command(
+            'seed_data', merchants=2, agents=2, consumers=5, transactions=300, bills=3, days=30, prefix='smoke', batch_size=50,
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(list(balances.drift()), [])
+        user_ids = list(User.objects.filter(username__startswith='smoke-').values_list('id', flat=True))
+        rows = [row for user_id in user_ids for row in Transaction.objects.for_user(user_id).values_list('transaction_type', 'timestamp')]
+        self.assertEqual({transaction_type for transaction_type, _ in rows}, {'cash_in', 'cash_out', 'bill_payment'})
+        # The history is spread over the past days rather than stamped with the time of seeding
+        timestamps = [timestamp for _, timestamp in rows]
+        self.assertLess(min(timestamps), timezone.now() - timedelta(days=29))
+        self.assertGreater(len(set(timestamps)), 100)
+        for user_id in user_ids:
+            snapshot = balances.get_snapshot(user_id)
+            totals = {field: getattr(snapshot, field) for field in balances.TOTAL_FIELDS}
+            self.assertEqual(totals, balances.totals_from_history(user_id))
+
+
+class ProfileBackendTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.merchant = User.objects.create_user(username='backend-merchant', password='pw', user_type='merchant')
+
+    def test_user_comes_with_its_profile(self):
+        with self.assertNumQueries(1):
+            user = ProfileBackend().get_user(self.merchant.id)
+            self.assertEqual(user.merchant_profile.user_id, self.merchant.id)
+
+    def test_following_requests_use_the_cached_user(self):
+        client = Client()
+        client.force_login(self.merchant)
+        client.get('/')
+        # The session is a signed cookie and the user is cached: nothing is read
+        with self.assertNumQueries(0):
+            client.get('/')
+
+    def test_password_change_ends_sessions_at_once(self):
+        client = Client()
+        client.force_login(self.merchant)
+        self.assertEqual(client.get('/').status_code, 200)
+        self.merchant.set_password('changed')
+        self.merchant.save()
+        self.assertEqual(client.get('/').status_code, 302)
+
+
+class JWTAuthenticationTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        # Refused requests would log a warning each
+        logger = logging.getLogger('django.request')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+        cache.clear()
+        self.consumer = User.objects.create_user(username='jwt-consumer', password='pw', user_type='consumer')
+        self.tokens = Client().post('/api/login/', {'username': 'jwt-consumer', 'password': 'pw'}).json()
+
+    def bearer(self, token):
+        return Client(headers={'Authorization': f'Bearer {token}'})
+
+    def test_access_token_authenticates_without_queries(self):
+        client = self.bearer(self.tokens['access'])
+        self.assertEqual(client.get('/api/profile/').json()['username'], 'jwt-consumer')
+        self.assertEqual(client.get('/users/').status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(client.get('/api/profile/').status_code, 200)
+
+    def test_refresh_token_gives_a_new_access_token(self):
+        access = Client().post('/api/token/refresh/', {'refresh': self.tokens['refresh']}).json()['access']
+        self.assertEqual(self.bearer(access).get('/api/profile/').status_code, 200)
+        self.assertEqual(Client().post('/api/token/refresh/', {'refresh': self.tokens['access']}).status_code, 401)
+
+    def test_bad_token_is_refused(self):
+        self.assertEqual(self.bearer('not-a-token').get('/api/profile/').status_code, 401)
+        self.assertEqual(self.bearer('not-a-token').get('/users/').status_code, 401)
+
+    def test_password_change_revokes_tokens(self):
+        self.consumer.set_password('changed')
+        self.consumer.save()
+        self.assertEqual(self.bearer(self.tokens['access']).get('/api/profile/').status_code, 401)
+        self.assertEqual(self.bearer(self.tokens['access']).get('/users/').status_code, 401)
+        self.assertEqual(Client().post('/api/token/refresh/', {'refresh': self.tokens['refresh']}).status_code, 401)
+
+
+class ApiTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        # Refused requests would log a warning each
+        logger = logging.getLogger('django.request')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+        cache.clear()
+        self.merchant = User.objects.create_user(username='api-merchant', password='pw', user_type='merchant')
+        self.consumer = User.objects.create_user(username='api-consumer', password='pw', user_type='consumer')
+        self.products = [
+            Product.objects.create(merchant=self.merchant, name=f'Kettle {n}', description='A kettle', price=Decimal(n))
+            for n in range(1, 6)
+        ]
+
+    def client_for(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def test_fields_trims_results_and_columns(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client_for(self.consumer).get('/products/?fields=id,name')
+        self.assertEqual([set(result) for result in response.json()['results']], [{'id', 'name'}] * 5)
+        self.assertNotIn('description', queries.captured_queries[-1]['sql'])
+        self.assertNotIn('merchantprofile', queries.captured_queries[-1]['sql'])
+
+    def test_bad_fields_and_filters_are_rejected(self):
+        client = self.client_for(self.consumer)
+        self.assertEqual(client.get('/products/?fields=id,secret').status_code, 400)
+        self.assertEqual(client.get('/products/?min_price=cheap').status_code, 400)
+
+    def test_filters(self):
+        response = self.client_for(self.consumer).get('/products/?min_price=2&max_price=4.00&name=kettle')
+        self.assertEqual([result['price'] for result in response.json()['results']], ['4.00', '3.00', '2.00'])
+
+    def test_listings_are_paginated(self):
+        client = self.client_for(self.consumer)
+        first = client.get('/products/?page_size=3').json()
+        second = client.get(first['next']).json()
+        self.assertEqual([result['id'] for result in first['results'] + second['results']], [product.id for product in reversed(self.products)])
+        self.assertIsNone(second['next'])
+
+    def test_money_is_serialized_as_a_decimal(self):
+        self.assertIsInstance(ProductSerializer().fields['price'], DecimalField)
+        # DRF's own mapping, shared with every other app's serializers, is left alone
+        self.assertNotIn(MoneyField, ModelSerializer.serializer_field_mapping)
+
+    def test_balances_are_read_only(self):
+        profile = ConsumerProfile.objects.for_user(self.consumer.id).get()
+        response = self.client_for(self.consumer).patch(
+            f'/consumer-profiles/{profile.id}/', {'address': 'Bole', 'balance': '1000.00'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        profile.refresh_from_db()
+        self.assertEqual((profile.address, profile.balance), ('Bole', Decimal('0.00')))
+
+    def test_catalog_changes_belong_to_their_merchant(self):
+        other = User.objects.create_user(username='api-other', password='pw', user_type='merchant')
+        product = self.products[0]
+        self.assertEqual(self.client_for(self.consumer).post('/products/', {'name': 'Lamp', 'price': '2.00'}).status_code, 403)
+        self.assertEqual(self.client_for(other).delete(f'/products/{product.id}/').status_code, 404)
+        created = self.client_for(other).post('/products/', {'name': 'Lamp', 'price': '2.00'}).json()
+        self.assertEqual(created['merchant'], other.id)
+        self.assertEqual(self.client_for(self.merchant).delete(f'/products/{product.id}/').status_code, 204)
+
+    def test_users_see_only_their_own_rows(self):
+        client = self.client_for(self.consumer)
+        self.assertEqual([user['id'] for user in client.get('/users/').json()['results']], [self.consumer.id])
+        self.assertEqual(client.get('/merchant-profiles/').json()['results'], [])
+        self.assertEqual(client.post('/transactions/', {'transaction_type': 'cash_in', 'user': self.consumer.id, 'amount': '5.00'}).status_code, 403)
+        self.assertEqual(Client().get('/products/').status_code, 401)
+
+
+class ShardingTests(TestCase):
+    # Runs on however many shards DB_SHARDS configures, one included
+    databases = '__all__'
+
+    def setUp(self):
+        self.consumers = [
+            User.objects.create_user(username=f'shard-consumer-{n}', password='pw', user_type='consumer') for n in range(6)
+        ]
+        for consumer in self.consumers:
+            ledger.post([ledger.entry('cash_in', consumer.id, Decimal('1.00'))], credit_to=(ConsumerProfile, consumer.id, Decimal('1.00')))
+
+    def test_adding_a_bucket_only_moves_keys_into_it(self):
+        for buckets in range(1, 5):
+            moved = 0
+            for key in range(2000):
+                before, after = sharding.jump_hash(key, buckets), sharding.jump_hash(key, buckets + 1)
+                self.assertIn(after, (before, buckets))
+                moved += after != before
+            self.assertAlmostEqual(moved / 2000, 1 / (buckets + 1), delta=0.05)
+
+    def test_rows_live_on_their_users_shard_only(self):
+        shards = settings.DATABASE_SHARDS
+        for consumer in self.consumers:
+            home = shard_for(consumer.id)
+            for alias in shards:
+                with self.subTest(consumer=consumer.username, alias=alias):
+                    for model in (ConsumerProfile, BalanceSnapshot, Transaction):
+                        self.assertEqual(model._base_manager.using(alias).filter(user_id=consumer.id).exists(), alias == home)
+            # Transaction ids come from the range of the shard that issued them
+            transaction_id = Transaction.objects.for_user(consumer.id).get().id
+            self.assertEqual(transaction_id // sharding.ID_RANGE, shards.index(home))
+
+    def test_deleting_a_user_deletes_their_rows_on_every_shard(self):
+        consumer = self.consumers[0]
+        consumer.delete()
+        for alias in settings.DATABASE_SHARDS:
+            for model in (ConsumerProfile, Transaction):
+                self.assertFalse(model._base_manager.using(alias).filter(user_id=consumer.id).exists())
+
+
+class RouterTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        router = routers.PrimaryReplicaRouter()
+        self.reader = routers.read_from_replica(lambda request: HttpResponse(router.db_for_read(User)))
+        self.writer = lambda request: HttpResponse(router.db_for_write(User))
+        # The decisions are what is tested, so a replica alias stands in without queries being run on it
+        replicas = mock.patch.object(routers, '_replicas', return_value=['replica_1'])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+
+    def get(self, view, cookies=None):
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        return routers.routing_middleware(view)(request)
+
+    def test_replica_views_read_from_a_replica(self):
+        self.assertEqual(self.get(self.reader).content, b'replica_1')
+        self.assertEqual(self.get(lambda request: HttpResponse(routers.PrimaryReplicaRouter().db_for_read(User))).content, b'default')
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        response = self.get(self.writer)
+        self.assertEqual(response.content, b'default')
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], settings.READ_YOUR_WRITES_SECONDS)
+        self.assertNotIn(routers.PIN_COOKIE, self.get(self.reader).cookies)
+        # Read after write: the pinned client reads its own writes from the primary
+        self.assertEqual(self.get(self.reader, {routers.PIN_COOKIE: '1'}).content, b'default')
+
+    def test_views_that_write_set_the_pin(self):
+        consumer = User.objects.create_user(username='router-consumer', password='pw', user_type='consumer')
+        self.client.force_login(consumer)
+        self.assertIn(routers.PIN_COOKIE, self.client.post('/consumer/recharge-balance/', {'amount': '5.00'}).cookies)
+        self.assertNotIn(routers.PIN_COOKIE, self.client.get('/consumer/balance-view/').cookies)
+
+
+class ReplicaMirrorTests(TestCase):
+    databases = '__all__'
+
+    def test_mirrors_of_the_primary_are_read_through_it(self):
+        # Under test every replica alias mirrors the primary, whether or not DB_REPLICAS lists any
+        self.assertEqual(routers._replicas(), [])
+        with override_settings(DATABASE_REPLICAS=['default']):
+            self.assertEqual(routers._replicas(), [])
+
+
+class MetricsTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.staff = User.objects.create_superuser(username='metrics-staff', password='pw', user_type='agent')
+
+    def write(self, name, requests):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            json.dump({'counters': [['http_requests_total', [['view', 'worker']], requests]], 'histograms': []}, f)
+
+    def requests(self, name):
+        with open(os.path.join(self.dir, name)) as f:
+            return json.load(f)['counters'][0][2]
+
+    def test_exposition(self):
+        self.client.force_login(self.staff)
+        self.client.get('/api/profile/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE http_requests_total counter', body)
+        self.assertRegex(body, r'http_requests_total\{view="get_profile",method="GET",status="200"\} \d+')
+        self.assertRegex(body, r'db_queries_per_request_bucket\{view="get_profile",le="\+Inf"\} \d+')
+
+    async def test_requests_leave_writing_the_file_to_a_thread(self):
+        client = AsyncClient()
+        await client.aforce_login(self.staff)
+        with (
+            override_settings(METRICS_DIR=self.dir),
+            mock.patch.object(metrics, '_start_dumper') as start_dumper,
+            mock.patch.object(metrics.registry, 'dump') as dump,
+        ):
+            self.assertEqual((await client.get('/api/profile/')).status_code, 200)
+        start_dumper.assert_called()
+        dump.assert_not_called()
+
+    def test_dumps_write_only_what_changed(self):
+        with override_settings(METRICS_DIR=self.dir):
+            registry = metrics._Registry()
+            registry.inc('http_requests_total', (('view', 'worker'),))
+            registry.dump()
+            path = os.path.join(self.dir, f'{os.getpid()}.json')
+            os.remove(path)
+            # Nothing recorded since: nothing written
+            registry.dump()
+            self.assertFalse(os.path.exists(path))
+            registry.inc('http_requests_total', (('view', 'worker'),))
+            registry.dump()
+            self.assertEqual(self.requests(f'{os.getpid()}.json'), 2)
+            registry.retire()
+
+    def test_files_of_exited_workers_are_folded_together(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        running = os.getppid()
+        with override_settings(METRICS_DIR=self.dir):
+            self.write(f'{exited.pid}.json', 2)
+            self.write(f'{running}.json', 3)
+            self.write(metrics.EXITED_FILE, 4)
+            registry = metrics._Registry()
+            registry.inc('http_requests_total', (('view', 'worker'),))
+            registry.dump()
+            files = {name for name in os.listdir(self.dir) if name.endswith('.json')}
+            self.assertEqual(files, {f'{running}.json', f'{os.getpid()}.json', metrics.EXITED_FILE})
+            self.assertEqual(self.requests(metrics.EXITED_FILE), 6)
+
+            # At exit a process's file joins them, once
+            registry.retire()
+            registry.retire()
+            self.assertFalse(os.path.exists(os.path.join(self.dir, f'{os.getpid()}.json')))
+            self.assertEqual(self.requests(metrics.EXITED_FILE), 7)
+            self.assertIn('http_requests_total{view="worker"} 10\n', metrics.exposition())
+
+
+class ProfilingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        logger = logging.getLogger('django.request')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        self.enterContext(override_settings(PROFILE_DIR=profile_dir.name, PROFILE_RETENTION=2))
+        self.staff = User.objects.create_superuser(username='profile-staff', password='pw', user_type='agent')
+        self.client.force_login(self.staff)
+
+    def profiled(self, path, **headers):
+        response = self.client.get(path, headers=headers)
+        profile = RequestProfile.objects.get(id=response['X-Profile-Id'])
+        self.assertTrue(os.path.exists(os.path.join(settings.PROFILE_DIR, profile.file_name)))
+        return profile
+
+    def test_sync_and_async_views_are_profiled(self):
+        sampled = self.profiled('/api/search/?q=kettle&_profile=sample')
+        self.assertEqual((sampled.profiler, sampled.view_name, sampled.status_code), ('sample', 'api_catalog_search', 200))
+        self.assertTrue(sampled.file_name.endswith('.folded'))
+        # An async view; the agent is refused a merchant's history, which is still profiled
+        traced = self.profiled('/merchant/transaction-history/', X_Profile='cprofile')
+        self.assertEqual((traced.profiler, traced.view_name, traced.status_code), ('cprofile', 'transaction_history', 403))
+        self.assertTrue(traced.file_name.endswith('.prof'))
+
+    def test_only_staff_are_profiled(self):
+        consumer = User.objects.create_user(username='profile-consumer', password='pw', user_type='consumer')
+        self.client.force_login(consumer)
+        response = self.client.get('/api/search/?q=kettle&_profile=sample')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_only_the_newest_profiles_are_kept(self):
+        profiles = [self.profiled('/api/search/?q=kettle&_profile=sample') for _ in range(3)]
+        self.assertEqual(set(RequestProfile.objects.values_list('id', flat=True)), {profiles[1].id, profiles[2].id})
+        self.assertFalse(os.path.exists(os.path.join(settings.PROFILE_DIR, profiles[0].file_name)))
+
+
+class SlowQueryTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        # Statements are flushed here, not by the background thread, which would write outside the test's transaction
+        self.enterContext(mock.patch.object(slow_queries, '_start_flusher'))
+        self.enterContext(mock.patch.dict(slow_queries._explained, clear=True))
+        slow_queries._drain()
+
+    def lookup(self, username):
+        return User.objects.filter(username=username).exists()
+
+    def test_statements_are_grouped_by_shape(self):
+        with override_settings(SLOW_QUERY_MS=0):
+            self.lookup('slow-a')
+            self.lookup('slow-b')
+        slow_queries.flush()
+        entry = SlowQuery.objects.get(example_params__contains="'slow-b'")
+        self.assertEqual(entry.count, 2)
+        self.assertEqual(len(entry.recent_ms), 2)
+        self.assertEqual(entry.database, 'default')
+        self.assertTrue(entry.call_site.startswith('core/tests.py:'), entry.call_site)
+        self.assertIn('core_user', entry.plan)
+
+    def test_nothing_is_logged_when_turned_off(self):
+        with override_settings(SLOW_QUERY_MS=None):
+            self.lookup('slow-a')
+        slow_queries.flush()
+        self.assertFalse(SlowQuery.objects.exists())
+
+
+class StaticFilesTests(TestCase):
+    PATH = '/static/admin/css/base.css'
+
+    def test_served_from_static_root(self):
+        response = self.client.get(self.PATH)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/css; charset="utf-8"')
+
+    @override_settings(DEBUG=True)
+    async def test_no_middleware_is_adapted_to_sync(self):
+        # With DEBUG on, Django logs each middleware it has to run in a thread
+        with self.assertNoLogs('django.request', logging.DEBUG):
+            response = await AsyncClient().get(self.PATH)
+        self.assertEqual(response.status_code, 200)
+
+
+class ArchiveTests(TestCase):
+    databases = '__all__'
+
+    def test_archive_query_uses_indexes(self):
+        for shard in settings.DATABASE_SHARDS:
+            with self.subTest(shard):
+                output = io.StringIO()
+                call_command('check_query_plans', database=shard, verbose_plans=True, stdout=output)
+                self.assertIn('archivable transactions: ok', output.getvalue())
+                # The plan checked is archive_batch's own, with its bill payment join
+                self.assertIn('core_billpayment', output.getvalue())
+
+    def test_only_old_completed_unbilled_rows_move(self):
+        consumer = User.objects.create_user(username='archive-consumer', password='pw', user_type='consumer')
+        old, older, recent, billed, pending = ledger.post(
+            [ledger.entry('cash_in', consumer.id, Decimal('1.00')) for _ in range(4)]
+            + [ledger.entry('cash_in', consumer.id, Decimal('1.00'), status='pending')]
+        )
+        bill = Bill.objects.create(bill_type='water', account_number='A-1', amount_due=Decimal('1.00'), due_date=timezone.now().date())
+        BillPayment.objects.create(transaction=billed, bill=bill, paid_by=consumer)
+        Transaction.objects.for_user(consumer.id).exclude(id=recent.id).update(timestamp=timezone.now() - timedelta(days=400))
+        totals = balances.totals_from_history(consumer.id)
+
+        output = io.StringIO()
+        call_command('archive_transactions', batch_size=1, stdout=output)
+        self.assertIn('Archived 2 transactions in 2 batches', output.getvalue())
+        archived = ArchivedTransaction.objects.for_user(consumer.id)
+        self.assertEqual(set(archived.values_list('id', 'reference_id')), {(old.id, old.reference_id), (older.id, older.reference_id)})
+        self.assertEqual(set(Transaction.objects.for_user(consumer.id).values_list('id', flat=True)), {recent.id, billed.id, pending.id})
+        self.assertEqual(balances.totals_from_history(consumer.id), totals)
+
+        # A second run finds nothing left to move
+        call_command('archive_transactions', stdout=output)
+        self.assertIn('Archived 0 transactions', output.getvalue())
+
+
+# A request QueryBudgetTests makes, as a user of role (None for an anonymous one). path and data are functions
+# of the test case, data being a POST's form body; budget is the most queries it may run, over all databases,
+# with one shard. posts_for are the roles whose ledger rows it writes.
+Page = namedtuple('Page', ['role', 'method', 'path', 'data', 'budget', 'posts_for'], defaults=[()])
+
+# With DB_SHARDS, a posting for users on different shards writes each further shard in a transaction of its own
+# (a savepoint under test) that inserts its transaction rows and updates its balance snapshots
+SHARD_POSTING_QUERIES = 4
+
+PAGES = {
+    'splash': Page('consumer', 'GET', lambda case: '/', None, 1),
+    'signup': Page(None, 'GET', lambda case: '/signup/', None, 0),
+    'login': Page(None, 'GET', lambda case: '/login/', None, 0),
+    'logout': Page(None, 'GET', lambda case: '/logout/', None, 0),
+    'accounts logout': Page(None, 'GET', lambda case: '/accounts/logout/', None, 0),
+    'user list': Page('consumer', 'GET', lambda case: '/users/', None, 2),
+    'user detail': Page('consumer', 'GET', lambda case: f'/users/{case.consumer.id}/', None, 2),
+    'swagger': Page(None, 'GET', lambda case: '/swagger/', None, 0),
+    'redoc': Page(None, 'GET', lambda case: '/redoc/', None, 0),
+    'metrics': Page('staff', 'GET', lambda case: '/metrics', None, 1),
+    'product list': Page('merchant', 'GET', lambda case: '/merchant/product-list/', None, 2),
+    'manage products': Page('merchant', 'GET', lambda case: '/merchant/manage-products/', None, 2),
+    'add product': Page(
+        'merchant', 'POST', lambda case: '/merchant/manage-products/',
+        lambda case: {'name': 'Lamp', 'description': 'A lamp', 'price': '12.50'}, 4,
+    ),
+    'update product form': Page('merchant', 'GET', lambda case: f'/update-product/{case.product.id}/', None, 2),
+    'update product': Page(
+        'merchant', 'POST', lambda case: f'/update-product/{case.product.id}/',
+        lambda case: {'name': 'Kettle', 'description': 'A kettle', 'price': '7.00'}, 5,
+    ),
+    'delete product': Page('merchant', 'POST', lambda case: f'/delete-product/{case.spare_product().id}/', lambda case: {}, 4),
+    'merchant history': Page('merchant', 'GET', lambda case: '/merchant/transaction-history/', None, 3),
+    'merchant export': Page('merchant', 'GET', lambda case: '/merchant/export-transactions/', None, 3),
+    'merchant balance': Page('merchant', 'GET', lambda case: '/merchant/balance-view/', None, 2),
+    'browse products': Page('consumer', 'GET', lambda case: '/browse-products/', None, 3),
+    'purchase': Page(
+        'consumer', 'POST', lambda case: f'/purchase-product/{case.product.id}/', lambda case: {}, 10, ('consumer', 'merchant'),
+    ),
+    'browse services': Page('consumer', 'GET', lambda case: '/browse-services/', None, 3),
+    'subscribe': Page('consumer', 'POST', lambda case: f'/subscribe-service/{case.service.id}/', lambda case: {}, 3),
+    'search': Page('consumer', 'GET', lambda case: '/search/?q=kettle', None, 5),
+    'api search': Page('consumer', 'GET', lambda case: '/api/search/?q=kettle', None, 5),
+    'api profile': Page('consumer', 'GET', lambda case: '/api/profile/', None, 1),
+    'api login': Page(None, 'POST', lambda case: '/api/login/', lambda case: {'username': case.consumer.username, 'password': 'pw'}, 1),
+    'api token refresh': Page(
+        None, 'POST', lambda case: '/api/token/refresh/', lambda case: {'refresh': str(RefreshToken.for_user(case.consumer))}, 1,
+    ),
+    'consumer history': Page('consumer', 'GET', lambda case: '/consumer/transaction-history/', None, 3),
+    'consumer export': Page('consumer', 'GET', lambda case: '/consumer/export-transactions/', None, 3),
+    'consumer balance': Page('consumer', 'GET', lambda case: '/consumer/balance-view/', None, 2),
+    'recharge form': Page('consumer', 'GET', lambda case: '/consumer/recharge-balance/', None, 1),
+    'recharge': Page('consumer', 'POST', lambda case: '/consumer/recharge-balance/', lambda case: {'amount': '20.00'}, 6, ('consumer',)),
+    'cash-in form': Page('agent', 'GET', lambda case: '/agent/accept-cash-payment/', None, 1),
+    'cash-in': Page(
+        'agent', 'POST', lambda case: '/agent/accept-cash-payment/',
+        lambda case: {'consumer_username': case.consumer.username, 'amount': '30.00'}, 8, ('agent', 'consumer'),
+    ),
+    'cash-out': Page(
+        'agent', 'POST', lambda case: '/agent/cash-out-consumer/',
+        lambda case: {'consumer_username': case.consumer.username, 'amount': '5.00'}, 8, ('agent', 'consumer'),
+    ),
+    'batch cash': Page(
+        'agent', 'POST', lambda case: '/agent/batch-cash/',
+        lambda case: {'rows': f'{case.consumer.username},10.00,cash_in\n{case.consumer.username},4.00,cash_out'}, 8,
+        ('agent', 'consumer'),
+    ),
+    'pay bill': Page(
+        'agent', 'POST', lambda case: '/agent/pay-bill-on-behalf/',
+        lambda case: {'consumer_username': case.consumer.username, 'bill_type': 'water', 'account_number': '1', 'amount': '3.00'}, 8,
+        ('agent', 'consumer'),
+    ),
+    'agent history': Page('agent', 'GET', lambda case: '/agent/transaction-history/', None, 3),
+    'agent consumer history': Page(
+        'agent', 'POST', lambda case: '/agent/transaction-history/', lambda case: {'consumer_username': case.consumer.username}, 5,
+    ),
+    'agent consumer export': Page(
+        'agent', 'GET', lambda case: f'/agent/export-consumer-transactions/?consumer_username={case.consumer.username}', None, 5,
+    ),
+    'agent consumer balance': Page(
+        'agent', 'POST', lambda case: '/agent/consumer-balance-view/', lambda case: {'consumer_username': case.consumer.username}, 4,
+    ),
+    'api users': Page('staff', 'GET', lambda case: '/users/?user_type=merchant', None, 2),
+    'api agent profiles': Page('agent', 'GET', lambda case: '/agent-profiles/', None, 2),
+    'api agent profile': Page('agent', 'GET', lambda case: f'/agent-profiles/{case.agent.agent_profile.id}/', None, 2),
+    'api consumer profiles': Page('consumer', 'GET', lambda case: '/consumer-profiles/', None, 3),
+    'api consumer profile': Page(
+        'consumer', 'GET', lambda case: f'/consumer-profiles/{ConsumerProfile.objects.for_user(case.consumer.id).get().id}/', None, 3,
+    ),
+    'api merchant profiles': Page('staff', 'GET', lambda case: '/merchant-profiles/', None, 2),
+    'api merchant profile': Page('merchant', 'GET', lambda case: f'/merchant-profiles/{case.merchant.merchant_profile.id}/', None, 2),
+    'api transactions': Page('consumer', 'GET', lambda case: '/transactions/?transaction_type=cash_in', None, 2),
+    'api transaction': Page(
+        'consumer', 'GET', lambda case: f'/transactions/{Transaction.objects.for_user(case.consumer.id).first().id}/', None, 2,
+    ),
+    'api bills': Page('agent', 'GET', lambda case: '/bills/?bill_type=water', None, 2),
+    'api bill': Page('agent', 'GET', lambda case: f'/bills/{Bill.objects.first().id}/', None, 2),
+    'api bill payments': Page('consumer', 'GET', lambda case: '/bill-payments/', None, 3),
+    'api bill payment': Page(
+        'consumer', 'GET', lambda case: f'/bill-payments/{BillPayment.objects.for_user(case.consumer.id).first().id}/', None, 3,
+    ),
+    'api products': Page('consumer', 'GET', lambda case: '/products/', None, 2),
+    'api products sparse': Page('consumer', 'GET', lambda case: '/products/?fields=id,name,price&min_price=1', None, 2),
+    'api product': Page('consumer', 'GET', lambda case: f'/products/{case.product.id}/', None, 2),
+    'api services': Page('consumer', 'GET', lambda case: '/services/', None, 2),
+    'api service': Page('consumer', 'GET', lambda case: f'/services/{Service.objects.first().id}/', None, 2),
+    'api subscriptions': Page('consumer', 'GET', lambda case: '/subscriptions/?is_active=true', None, 3),
+    'api subscription': Page(
+        'consumer', 'GET', lambda case: f'/subscriptions/{Subscription.objects.for_user(case.consumer.id).first().id}/', None, 3,
+    ),
+    'admin index': Page('staff', 'GET', lambda case: '/admin/', None, 2),
+    'admin request profiles': Page('staff', 'GET', lambda case: '/admin/core/requestprofile/', None, 5),
+    'admin slow queries': Page('staff', 'GET', lambda case: '/admin/core/slowquery/', None, 6),
+    'admin groups': Page('staff', 'GET', lambda case: '/admin/auth/group/', None, 4),
+}
+
+# URL names that are not measured: the router's API root is shadowed by the splash page at the same path, and
+# the agent dashboard has no template
+UNMEASURED = {'api-root', 'agent_dashboard'}
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every page and API endpoint is requested with a small and then a larger
+    amount of data in the database, with the caches cleared first. Each must
+    run the same number of queries both times, so the number does not grow
+    with the rows shown (an N+1 query), and no more than its budget in PAGES.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {
+            'consumer': User.objects.create_user(username='budget-consumer', password='pw', user_type='consumer'),
+            'merchant': User.objects.create_user(username='budget-merchant', password='pw', user_type='merchant'),
+            'agent': User.objects.create_user(username='budget-agent', password='pw', user_type='agent'),
+            'staff': User.objects.create_superuser(username='budget-staff', password='pw', user_type='agent'),
+        }
+        cls.consumer, cls.merchant, cls.agent = cls.users['consumer'], cls.users['merchant'], cls.users['agent']
+        cls.product = Product.objects.create(merchant=cls.merchant, name='Kettle', description='A kettle', price=Decimal('7.00'))
+        cls.service = Service.objects.create(merchant=cls.merchant, name='Kettle care', description='Descaling', subscription_fee=Decimal('4.00'))
+
+    def setUp(self):
+        logger = logging.getLogger('django.request')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+        self.added = 0
+
+    def spare_product(self):
+        return Product.objects.create(merchant=self.merchant, name='Spare', price=Decimal('1.00'))
+
+    def add_rows(self, count):
+        # count more of everything the pages list: merchants with their catalog, transactions of every kind
+        # for each test user, subscriptions, and profiles and slow queries for the admin
+        for n in range(self.added, self.added + count):
+            merchant = User.objects.create_user(username=f'budget-merchant-{n}', password=None, user_type='merchant')
+            Product.objects.create(merchant=merchant, name=f'Kettle {n}', description='Another kettle', price=Decimal('3.00'))
+            Product.objects.create(merchant=self.merchant, name=f'Kettle {n}', description='Our kettle', price=Decimal('3.00'))
+            service = Service.objects.create(merchant=merchant, name=f'Kettle club {n}', description='Kettles', subscription_fee=Decimal('2.00'))
+            Subscription.objects.create(consumer=self.consumer, service=service)
+            bill = Bill.objects.create(bill_type='water', account_number=str(n), amount_due=Decimal('1.00'), due_date='2030-01-01')
+            ledger.post(
+                [ledger.entry('cash_in', self.consumer.id, Decimal('10.00')), ledger.entry('cash_in', self.agent.id, Decimal('10.00'))],
+                credit_to=(ConsumerProfile, self.consumer.id, Decimal('10.00')),
+            )
+            ledger.post(
+                [ledger.entry('cash_out', self.consumer.id, Decimal('3.00')), ledger.entry('cash_in', self.merchant.id, Decimal('3.00'))],
+                debit_from=(ConsumerProfile, self.consumer.id, Decimal('3.00')),
+                credit_to=(MerchantProfile, self.merchant.id, Decimal('3.00')),
+            )
+            payment, _ = ledger.post(
+                [ledger.entry('bill_payment', self.consumer.id, Decimal('1.00')), ledger.entry('bill_payment', self.agent.id, Decimal('1.00'))],
+                debit_from=(ConsumerProfile, self.consumer.id, Decimal('1.00')),
+            )
+            BillPayment.objects.create(transaction=payment, bill=bill, paid_by=self.consumer)
+            RequestProfile.objects.create(
+                user=self.users['staff'], method='GET', path='/', profiler='sample', duration_ms=1, file_name=f'{n}.folded',
+            )
+            SlowQuery.objects.create(shape_hash=str(n), shape=f'SELECT {n}', example_sql=f'SELECT {n}', last_seen=timezone.now())
+        self.added += count
+
+    def budget(self, page):
+        shards = {shard_for(self.users[role].id) for role in page.posts_for}
+        return page.budget + SHARD_POSTING_QUERIES * max(len(shards) - 1, 0)
+
+    def count_queries(self, name):
+        page = PAGES[name]
+        cache.clear()
+        client = Client()
+        if page.role is not None:
+            client.force_login(self.users[page.role])
+        path = page.path(self)
+        data = page.data(self) if page.data else None
+        contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+        with ExitStack() as stack:
+            for context in contexts:
+                stack.enter_context(context)
+            if page.method == 'GET':
+                response = client.get(path)
+            else:
+                response = client.post(path, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, f'{name}: {response.status_code}')
+        return [query['sql'] for context in contexts for query in context.captured_queries]
+
+    def test_pages_run_a_fixed_number_of_queries(self):
+        self.add_rows(2)
+        small = {name: self.count_queries(name) for name in PAGES}
+        self.add_rows(30)
+        large = {name: self.count_queries(name) for name in PAGES}
+        for name, page in PAGES.items():
+            with self.subTest(name):
+                before = Counter(map(metrics.query_shape, small[name]))
+                grown = Counter(map(metrics.query_shape, large[name])) - before
+                extra = '\n'.join(f'{count} more x {shape}' for shape, count in grown.items())
+                self.assertEqual(len(large[name]), len(small[name]), f'{name} ran more queries with more rows:\n{extra}')
+                self.assertLessEqual(len(large[name]), self.budget(page), '\n'.join(large[name]))
+
+    def test_every_url_has_a_budget(self):
+        # Rows for the detail pages' paths
+        self.add_rows(1)
+        measured = {resolve(urlsplit(page.path(self)).path).url_name for page in PAGES.values()}
+        names = {pattern.name for pattern in get_resolver().url_patterns if getattr(pattern, 'name', None)}
+        self.assertEqual(names - measured - UNMEASURED, set())
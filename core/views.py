@@ -1,18 +1,36 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden
-from .models import User, Product, Transaction, Service, Subscription, AgentProfile, ConsumerProfile, MerchantProfile, Bill, BillPayment
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.views.decorators.http import require_POST
+from .models import User, Product, Transaction, ArchivedTransaction, Service, Subscription, AgentProfile, ConsumerProfile, MerchantProfile, Bill, BillPayment
 from .forms import CustomUserCreationForm, ProductForm
 from rest_framework import viewsets, permissions
 from .serializers import ProductSerializer, UserSerializer, AgentProfileSerializer, ConsumerProfileSerializer, MerchantProfileSerializer, TransactionSerializer, BillSerializer, BillPaymentSerializer, ServiceSerializer, SubscriptionSerializer
-from decimal import Decimal, InvalidOperation
-import uuid
+from decimal import InvalidOperation
+from urllib.parse import urlencode
+import csv
+import hmac
+import io
+import json
+from . import auth, balances, ledger, metrics
+from .catalog import arender_catalog, render_catalog
+from .consumers import aresolve_consumer, resolve_consumer
+from .exports import export_response
+from .idempotency import IdempotentCreateMixin, idempotent
+from .money import parse_amount
+from .pagination import TransactionCursorPagination, apaginate_transactions, filter_transactions
+from .routers import read_from_replica
+from .search import PAGE_SIZE as SEARCH_PAGE_SIZE, TARGETS as SEARCH_TARGETS, search_catalog
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from django.contrib.auth import authenticate
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, PermissionDenied
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import RefreshToken
 
 def signup(request):
     if request.method == 'POST':
@@ -79,85 +97,115 @@ def update_product(request, product_id):
     return render(request, 'update_product.html', {'form': form, 'product': product})
 
 @login_required
-def transaction_history(request):
-    if request.user.user_type != 'merchant':
+@read_from_replica
+async def transaction_history(request):
+    user = await request.auser()
+    if user.user_type != 'merchant':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    transactions = Transaction.objects.filter(user=request.user)
-    return render(request, 'transaction_history.html', {'transactions': transactions})
+    page = await apaginate_transactions(
+        Transaction.objects.for_user(user.id), request.GET,
+        archived=ArchivedTransaction.objects.for_user(user.id)
+    )
+    return render(request, 'transaction_history.html', {'transactions': page.transactions, 'page': page})
 
 @login_required
-def balance_view(request):
+@read_from_replica
+def export_merchant_transactions(request):
     if request.user.user_type != 'merchant':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    transactions = Transaction.objects.filter(user=request.user)
-    balance = sum(t.amount for t in transactions if t.transaction_type == 'cash_in') - \
-              sum(t.amount for t in transactions if t.transaction_type == 'cash_out')
+    return export_response(
+        Transaction.objects.for_user(request.user.id), request.GET, request.user.username,
+        archived=ArchivedTransaction.objects.for_user(request.user.id)
+    )
+
+@login_required
+@read_from_replica
+async def balance_view(request):
+    user = await request.auser()
+    if user.user_type != 'merchant':
+        return HttpResponseForbidden("You are not authorized to access this page.")
+
+    balance = (await balances.aget_snapshot(user.id)).balance
 
     return render(request, 'balance_view.html', {'balance': balance})
 
 @login_required
-def browse_products(request):
-    if request.user.user_type != 'consumer':
+@read_from_replica
+async def browse_products(request):
+    user = await request.auser()
+    if user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    # Fetch all products from merchants
-    products = Product.objects.filter(merchant__user_type='merchant')
-    return render(request, 'browse_products.html', {'products': products})
+    # Each merchant's block of the listing comes from the catalog cache
+    return render(request, 'browse_products.html', {'catalog': await arender_catalog('products')})
 
 @login_required
+@require_POST
+@idempotent
 def purchase_product(request, product_id):
     if request.user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    product = get_object_or_404(Product, id=product_id)
-    consumer_profile = request.user.consumer_profile
+    product = get_object_or_404(Product.objects.only('id', 'price', 'merchant_id'), id=product_id)
 
-    # Check if the consumer has enough balance
-    if consumer_profile.balance < product.price:
+    # Move the product price from the consumer to the merchant in one posting
+    try:
+        ledger.post(
+            [
+                ledger.entry('cash_out', request.user.id, product.price),
+                ledger.entry('cash_in', product.merchant_id, product.price),
+            ],
+            debit_from=(ConsumerProfile, request.user.id, product.price),
+            credit_to=(MerchantProfile, product.merchant_id, product.price),
+        )
+    except ledger.InsufficientBalance:
         return HttpResponseForbidden("You do not have enough balance to purchase this product.")
 
-    # Deduct the product price from the consumer's balance
-    consumer_profile.balance -= product.price
-    consumer_profile.save()
-
-    # Add the product price to the merchant's balance
-    merchant_profile = product.merchant.merchant_profile
-    merchant_profile.balance += product.price
-    merchant_profile.save()
-
-    # Create a transaction for the consumer
-    Transaction.objects.create(
-        transaction_type='cash_out',
-        user=request.user,
-        amount=product.price,
-        status='completed',
-        reference_id=f'PUR-{product.id}-{request.user.id}-{uuid.uuid4()}'
-    )
+    # Show confirmation on browse_products
+    return render(request, 'browse_products.html', {'catalog': render_catalog('products'), 'purchase_success': True})
 
-    # Create a transaction for the merchant
-    Transaction.objects.create(
-        transaction_type='cash_in',
-        user=product.merchant,
-        amount=product.price,
-        status='completed',
-        reference_id=f'SALE-{product.id}-{product.merchant.id}-{uuid.uuid4()}'
-    )
+@login_required
+@read_from_replica
+async def browse_services(request):
+    user = await request.auser()
+    if user.user_type != 'consumer':
+        return HttpResponseForbidden("You are not authorized to access this page.")
 
-    # Show confirmation on browse_products
-    products = Product.objects.filter(merchant__user_type='merchant')
-    return render(request, 'browse_products.html', {'products': products, 'purchase_success': True})
+    return render(request, 'browse_services.html', {'catalog': await arender_catalog('services')})
+
+def _search(params):
+    # ?q=words&kind=products|services (default both)&page=N&page_size=N
+    kind = params.get('kind')
+    kinds = (kind,) if kind in SEARCH_TARGETS else tuple(SEARCH_TARGETS)
+    try:
+        page = int(params.get('page', 1))
+        page_size = int(params.get('page_size', SEARCH_PAGE_SIZE))
+    except ValueError:
+        page, page_size = 1, SEARCH_PAGE_SIZE
+    return search_catalog(params.get('q', ''), kinds, page, page_size), (kind if kind in SEARCH_TARGETS else '')
 
 @login_required
-def browse_services(request):
+def catalog_search(request):
     if request.user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    services = Service.objects.all()
-    return render(request, 'browse_services.html', {'services': services})
+    results, kind = _search(request.GET)
+    query = request.GET.get('q', '')
+    links = {'q': query, 'kind': kind}
+    if results.page_size != SEARCH_PAGE_SIZE:
+        links['page_size'] = results.page_size
+    return render(request, 'search_results.html', {
+        'query': query,
+        'kind': kind,
+        'results': results,
+        'previous_query': urlencode({**links, 'page': results.page - 1}) if results.page > 1 else '',
+        'next_query': urlencode({**links, 'page': results.page + 1}) if results.has_next else '',
+    })
 
 @login_required
+@require_POST
 def subscribe_service(request, service_id):
     if request.user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -170,25 +218,42 @@ def subscribe_service(request, service_id):
     return redirect('browse_services')
 
 @login_required
-def consumer_transaction_history(request):
-    if request.user.user_type != 'consumer':
+@read_from_replica
+async def consumer_transaction_history(request):
+    user = await request.auser()
+    if user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    transactions = Transaction.objects.filter(user=request.user)
-    return render(request, 'consumer_transaction_history.html', {'transactions': transactions})
+    page = await apaginate_transactions(
+        Transaction.objects.for_user(user.id), request.GET,
+        archived=ArchivedTransaction.objects.for_user(user.id)
+    )
+    return render(request, 'consumer_transaction_history.html', {'transactions': page.transactions, 'page': page})
 
 @login_required
-def consumer_balance_view(request):
+@read_from_replica
+def export_consumer_transactions(request):
     if request.user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    transactions = Transaction.objects.filter(user=request.user)
-    balance = sum(t.amount for t in transactions if t.transaction_type == 'cash_in') - \
-              sum(t.amount for t in transactions if t.transaction_type == 'cash_out')
+    return export_response(
+        Transaction.objects.for_user(request.user.id), request.GET, request.user.username,
+        archived=ArchivedTransaction.objects.for_user(request.user.id)
+    )
+
+@login_required
+@read_from_replica
+async def consumer_balance_view(request):
+    user = await request.auser()
+    if user.user_type != 'consumer':
+        return HttpResponseForbidden("You are not authorized to access this page.")
+
+    balance = (await balances.aget_snapshot(user.id)).balance
 
     return render(request, 'consumer_balance_view.html', {'balance': balance})
 
 @login_required
+@idempotent
 def recharge_balance(request):
     if request.user.user_type != 'consumer':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -196,22 +261,14 @@ def recharge_balance(request):
     if request.method == 'POST':
         amount = request.POST.get('amount')
         try:
-            amount = Decimal(amount)  # Convert to Decimal instead of float
+            amount = parse_amount(amount)  # A Decimal of whole cents
             if amount <= 0:
                 return HttpResponseForbidden("Invalid amount. Please enter a positive value.")
 
-            # Update the consumer's balance
-            consumer_profile = request.user.consumer_profile
-            consumer_profile.balance += amount
-            consumer_profile.save()
-
-            # Create a transaction for the recharge
-            Transaction.objects.create(
-                transaction_type='cash_in',
-                user=request.user,
-                amount=amount,
-                status='completed',
-                reference_id=f'RECHARGE-{uuid.uuid4()}'  # Ensure unique reference_id
+            # Credit the consumer and record the recharge
+            ledger.post(
+                [ledger.entry('cash_in', request.user.id, amount)],
+                credit_to=(ConsumerProfile, request.user.id, amount),
             )
 
             return redirect('consumer_balance_view')
@@ -221,6 +278,7 @@ def recharge_balance(request):
     return render(request, 'recharge_balance.html')
 
 @login_required
+@idempotent
 def accept_cash_payment(request):
     if request.user.user_type != 'agent':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -229,38 +287,24 @@ def accept_cash_payment(request):
         consumer_username = request.POST.get('consumer_username')
         amount = request.POST.get('amount')
         try:
-            consumer = User.objects.get(username=consumer_username, user_type='consumer')
-            amount = Decimal(amount)
+            consumer = resolve_consumer(consumer_username)
+            amount = parse_amount(amount)
             if amount <= 0:
                 return HttpResponseForbidden("Invalid amount. Please enter a positive value.")
 
-            # Update the consumer's balance
-            consumer_profile = consumer.consumer_profile
-            consumer_profile.balance += amount
-            consumer_profile.save()
-
-            # Create a transaction for the consumer
-            Transaction.objects.create(
-                transaction_type='cash_in',
-                user=consumer,
-                amount=amount,
-                status='completed',
-                reference_id=f'CASHIN-{uuid.uuid4()}'
-            )
-
-            # Create a transaction for the agent
-            Transaction.objects.create(
-                transaction_type='cash_in',
-                user=request.user,  # The agent performing the cash-in
-                amount=amount,
-                status='completed',
-                reference_id=f'AGENTCASHIN-{uuid.uuid4()}'
+            # Credit the consumer and record the cash-in for both consumer and agent
+            ledger.post(
+                [
+                    ledger.entry('cash_in', consumer.id, amount),
+                    ledger.entry('cash_in', request.user.id, amount),  # The agent performing the cash-in
+                ],
+                credit_to=(ConsumerProfile, consumer.id, amount),
             )
 
             return render(request, 'accept_cash_payment.html', {
                 'success_message': f"Successfully added ${amount} to {consumer.username}'s balance."
             })
-        except (User.DoesNotExist, ValueError, InvalidOperation):
+        except (User.DoesNotExist, ledger.AccountNotFound, ValueError, InvalidOperation):
             return render(request, 'accept_cash_payment.html', {
                 'error_message': "Invalid consumer username or amount."
             })
@@ -268,6 +312,7 @@ def accept_cash_payment(request):
     return render(request, 'accept_cash_payment.html')
 
 @login_required
+@idempotent
 def cash_out_consumer(request):
     if request.user.user_type != 'agent':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -276,51 +321,94 @@ def cash_out_consumer(request):
         consumer_username = request.POST.get('consumer_username')
         amount = request.POST.get('amount')
         try:
-            consumer = User.objects.get(username=consumer_username, user_type='consumer')
-            amount = Decimal(amount)
+            consumer = resolve_consumer(consumer_username)
+            amount = parse_amount(amount)
             if amount <= 0:
                 return HttpResponseForbidden("Invalid amount. Please enter a positive value.")
 
-            consumer_profile = consumer.consumer_profile
-
-            # Check if the consumer has enough balance
-            if consumer_profile.balance < amount:
+            # Deduct the amount from the consumer's balance and record it for both consumer and agent
+            try:
+                ledger.post(
+                    [
+                        ledger.entry('cash_out', consumer.id, amount),
+                        ledger.entry('cash_out', request.user.id, amount),  # The agent performing the cash-out
+                    ],
+                    debit_from=(ConsumerProfile, consumer.id, amount),
+                )
+            except ledger.InsufficientBalance:
                 return render(request, 'cash_out_consumer.html', {
                     'error_message': f"Consumer {consumer.username} does not have enough balance."
                 })
 
-            # Deduct the amount from the consumer's balance
-            consumer_profile.balance -= amount
-            consumer_profile.save()
-
-            # Create a transaction for the cash-out
-            Transaction.objects.create(
-                transaction_type='cash_out',
-                user=consumer,
-                amount=amount,
-                status='completed',
-                reference_id=f'CASHOUT-{uuid.uuid4()}'
-            )
-
-            # Create a transaction for the agent
-            Transaction.objects.create(
-                transaction_type='cash_out',
-                user=request.user,  # The agent performing the cash-out
-                amount=amount,
-                status='completed',
-                reference_id=f'AGENTCASHOUT-{uuid.uuid4()}'
-            )
-
             return render(request, 'cash_out_consumer.html', {
                 'success_message': f"Successfully deducted ${amount} from {consumer.username}'s balance."
             })
-        except (User.DoesNotExist, ValueError, InvalidOperation):
+        except (User.DoesNotExist, ledger.AccountNotFound, ValueError, InvalidOperation):
             return render(request, 'cash_out_consumer.html', {
                 'error_message': "Invalid consumer username or amount."
             })
 
     return render(request, 'cash_out_consumer.html')
 
+# Upper bound on rows accepted by agent_batch_cash in one request
+BATCH_MAX_ROWS = 1000
+
+def _parse_batch_rows(request):
+    # JSON: a list of {consumer_username, amount, direction} objects, bare or under "rows".
+    # Otherwise CSV lines from an uploaded file or the "rows" form field, with an optional header.
+    if request.content_type == 'application/json':
+        payload = json.loads(request.body)
+        if isinstance(payload, dict):
+            payload = payload.get('rows')
+        if not isinstance(payload, list) or not all(isinstance(item, dict) for item in payload):
+            raise ValueError("Expected a list of rows.")
+        return [
+            ledger.BatchRow(
+                str(item.get('consumer_username') or '').strip(),
+                str(item.get('amount') or '').strip(),
+                str(item.get('direction') or '').strip(),
+            )
+            for item in payload
+        ]
+
+    upload = request.FILES.get('file')
+    text = upload.read().decode('utf-8-sig') if upload else request.POST.get('rows', '')
+    lines = [line for line in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in line)]
+    if lines and lines[0][0].strip().lower() == 'consumer_username':
+        lines = lines[1:]
+    return [ledger.BatchRow(*(cell.strip() for cell in (line + ['', '', ''])[:3])) for line in lines]
+
+@login_required
+@idempotent
+def agent_batch_cash(request):
+    if request.user.user_type != 'agent':
+        return HttpResponseForbidden("You are not authorized to access this page.")
+
+    if request.method != 'POST':
+        return render(request, 'agent_batch_cash.html')
+
+    wants_json = request.content_type == 'application/json'
+    try:
+        rows = _parse_batch_rows(request)
+        if not rows:
+            raise ValueError("The batch is empty.")
+        if len(rows) > BATCH_MAX_ROWS:
+            raise ValueError(f"A batch can contain at most {BATCH_MAX_ROWS} rows.")
+    except (ValueError, UnicodeDecodeError, csv.Error) as exc:
+        error = str(exc) if isinstance(exc, ValueError) and not isinstance(exc, json.JSONDecodeError) else "Could not read the batch."
+        if wants_json:
+            return JsonResponse({'error': error}, status=400)
+        return render(request, 'agent_batch_cash.html', {'error_message': error})
+
+    results = ledger.post_batch(request.user.id, rows)
+    applied = sum(1 for result in results if result['status'] == 'ok')
+    if wants_json:
+        return JsonResponse({'applied': applied, 'failed': len(results) - applied, 'results': results})
+    return render(request, 'agent_batch_cash.html', {
+        'success_message': f"Applied {applied} of {len(results)} rows.",
+        'results': results
+    })
+
 @login_required
 def agent_dashboard(request):
     if request.user.user_type != 'agent':
@@ -329,6 +417,7 @@ def agent_dashboard(request):
     return render(request, 'agent_dashboard.html')
 
 @login_required
+@idempotent
 def pay_bill_on_behalf(request):
     if request.user.user_type != 'agent':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -339,45 +428,29 @@ def pay_bill_on_behalf(request):
         account_number = request.POST.get('account_number')
         amount = request.POST.get('amount')
         try:
-            consumer = User.objects.get(username=consumer_username, user_type='consumer')
-            amount = Decimal(amount)
+            consumer = resolve_consumer(consumer_username)
+            amount = parse_amount(amount)
             if amount <= 0:
                 return HttpResponseForbidden("Invalid amount. Please enter a positive value.")
 
-            consumer_profile = consumer.consumer_profile
-
-            # Check if the consumer has enough balance
-            if consumer_profile.balance < amount:
+            # Deduct the amount from the consumer's balance and record it for both consumer and agent
+            try:
+                ledger.post(
+                    [
+                        ledger.entry('bill_payment', consumer.id, amount),
+                        ledger.entry('bill_payment', request.user.id, amount),  # The agent performing the bill payment
+                    ],
+                    debit_from=(ConsumerProfile, consumer.id, amount),
+                )
+            except ledger.InsufficientBalance:
                 return render(request, 'pay_bill_on_behalf.html', {
                     'error_message': f"Consumer {consumer.username} does not have enough balance."
                 })
 
-            # Deduct the amount from the consumer's balance
-            consumer_profile.balance -= amount
-            consumer_profile.save()
-
-            # Create a transaction for the bill payment
-            Transaction.objects.create(
-                transaction_type='bill_payment',
-                user=consumer,
-                amount=amount,
-                status='completed',
-                reference_id=f'BILLPAY-{uuid.uuid4()}'
-            )
-
-            # Create a transaction for the agent
-            Transaction.objects.create(
-                transaction_type='bill_payment',
-                user=request.user,  # The agent performing the bill payment
-                amount=amount,
-                status='completed',
-                reference_id=f'AGENTBILLPAY-{uuid.uuid4()}'
-            )
-
             return render(request, 'pay_bill_on_behalf.html', {
                 'success_message': f"Successfully paid ${amount} for {consumer.username}'s bill."
             })
-        except (User.DoesNotExist, ValueError, InvalidOperation):
+        except (User.DoesNotExist, ledger.AccountNotFound, ValueError, InvalidOperation):
             return render(request, 'pay_bill_on_behalf.html', {
                 'error_message': "Invalid consumer username or amount."
             })
@@ -385,34 +458,61 @@ def pay_bill_on_behalf(request):
     return render(request, 'pay_bill_on_behalf.html')
 
 @login_required
-def agent_transaction_history(request):
-    if request.user.user_type != 'agent':
+@read_from_replica
+async def agent_transaction_history(request):
+    user = await request.auser()
+    if user.user_type != 'agent':
         return HttpResponseForbidden("You are not authorized to access this page.")
 
-    if request.method == 'GET':
+    # Later pages of a consumer's history carry the username in the query string
+    consumer_username = request.POST.get('consumer_username') or request.GET.get('consumer_username')
+
+    if not consumer_username:
         # Display all transactions related to the agent by default
-        transactions = Transaction.objects.filter(user=request.user)
+        page = await apaginate_transactions(
+            Transaction.objects.for_user(user.id), request.GET,
+            archived=ArchivedTransaction.objects.for_user(user.id)
+        )
         return render(request, 'agent_transaction_history.html', {
-            'transactions': transactions
+            'transactions': page.transactions,
+            'page': page
         })
 
-    if request.method == 'POST':
-        consumer_username = request.POST.get('consumer_username')
-        try:
-            consumer = User.objects.get(username=consumer_username, user_type='consumer')
-            transactions = Transaction.objects.filter(user=consumer)
-            return render(request, 'agent_transaction_history.html', {
-                'consumer_username': consumer.username,
-                'transactions': transactions
-            })
-        except User.DoesNotExist:
-            return render(request, 'agent_transaction_history.html', {
-                'error_message': "Consumer not found. Please check the username."
-            })
+    try:
+        consumer = await aresolve_consumer(consumer_username)
+        page = await apaginate_transactions(
+            Transaction.objects.for_user(consumer.id), request.GET, {'consumer_username': consumer.username},
+            archived=ArchivedTransaction.objects.for_user(consumer.id)
+        )
+        return render(request, 'agent_transaction_history.html', {
+            'consumer_username': consumer.username,
+            'transactions': page.transactions,
+            'page': page
+        })
+    except User.DoesNotExist:
+        return render(request, 'agent_transaction_history.html', {
+            'error_message': "Consumer not found. Please check the username."
+        })
+
+@login_required
+@read_from_replica
+def agent_export_consumer_transactions(request):
+    if request.user.user_type != 'agent':
+        return HttpResponseForbidden("You are not authorized to access this page.")
 
-    return render(request, 'agent_transaction_history.html')
+    try:
+        consumer = resolve_consumer(request.GET.get('consumer_username'))
+    except User.DoesNotExist:
+        return render(request, 'agent_transaction_history.html', {
+            'error_message': "Consumer not found. Please check the username."
+        })
+    return export_response(
+        Transaction.objects.for_user(consumer.id), request.GET, consumer.username,
+        archived=ArchivedTransaction.objects.for_user(consumer.id)
+    )
 
 @login_required
+@read_from_replica
 def agent_consumer_balance_view(request):
     if request.user.user_type != 'agent':
         return HttpResponseForbidden("You are not authorized to access this page.")
@@ -420,13 +520,13 @@ def agent_consumer_balance_view(request):
     if request.method == 'POST':
         consumer_username = request.POST.get('consumer_username')
         try:
-            consumer = User.objects.get(username=consumer_username, user_type='consumer')
-            consumer_profile = consumer.consumer_profile
+            consumer = resolve_consumer(consumer_username)
+            balance = ConsumerProfile.objects.for_user(consumer.id).values_list('balance', flat=True).get()
             return render(request, 'agent_consumer_balance_view.html', {
                 'consumer_username': consumer.username,
-                'balance': consumer_profile.balance
+                'balance': balance
             })
-        except User.DoesNotExist:
+        except (User.DoesNotExist, ConsumerProfile.DoesNotExist):
             return render(request, 'agent_consumer_balance_view.html', {
                 'error_message': "Consumer not found. Please check the username."
             })
@@ -440,9 +540,24 @@ def api_login(request):
     password = request.data.get('password')
     user = authenticate(username=username, password=password)
     if user:
-        return Response({"message": "Login successful", "user_id": user.id})
+        # A short-lived access token to send as "Authorization: Bearer <access>", and a refresh token to renew it
+        refresh = RefreshToken.for_user(user)
+        return Response({"message": "Login successful", "user_id": user.id, "access": str(refresh.access_token), "refresh": str(refresh)})
     return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
 
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def api_token_refresh(request):
+    token = request.data.get('refresh')
+    if not token:
+        return Response({"error": "A refresh token is required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        refresh = RefreshToken(token)
+        auth.token_user(refresh)
+    except (TokenError, AuthenticationFailed):
+        return Response({"error": "Invalid or expired refresh token"}, status=status.HTTP_401_UNAUTHORIZED)
+    return Response({"access": str(refresh.access_token)})
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def api_signup(request):
@@ -468,72 +583,203 @@ def reset_password(request):
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(['GET'])
-def get_profile(request):
-    user = request.user
+def api_catalog_search(request):
+    results, _ = _search(request.query_params)
     return Response({
+        'page': results.page,
+        'has_next': results.has_next,
+        'results': [
+            {
+                'kind': result.kind,
+                'id': result.item.id,
+                'merchant': result.item.merchant_id,
+                'name': result.item.name,
+                'description': result.item.description,
+                'price': str(result.item.price if result.kind == 'products' else result.item.subscription_fee),
+                'rank': result.rank,
+            }
+            for result in results.results
+        ],
+    })
+
+async def get_profile(request):
+    # A plain async view: DRF's api_view only runs synchronous handlers, so a bearer token is checked here
+    try:
+        authenticated = await auth.ProfileJWTAuthentication().aauthenticate(request)
+    except AuthenticationFailed as error:
+        return JsonResponse(error.detail if isinstance(error.detail, dict) else {"detail": error.detail}, status=401)
+    user = authenticated[0] if authenticated else await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    return JsonResponse({
         "id": user.id,
         "username": user.username,
         "user_type": user.user_type
     })
 
+def prometheus_metrics(request):
+    # Scraped by Prometheus with METRICS_TOKEN as a bearer token; staff can also view it when logged in
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())):
+        return HttpResponseForbidden("You are not authorized to access this page.")
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class IsStaffOrReadOnly(permissions.IsAuthenticated):
+    # For rows that only change along with money, or are managed by staff: others may read the ones they can see
+    def has_permission(self, request, view):
+        return super().has_permission(request, view) and (request.method in permissions.SAFE_METHODS or request.user.is_staff)
+
+# The API's viewsets list the query parameters they filter on in filter_params, and map serializer fields to the
+# relation each one reads in select_related (joined) or prefetch_related (for rows that may be on another database);
+# see core.filters. Their listings are paginated by id, newest first (core.pagination.ApiCursorPagination).
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    permission_classes = [IsStaffOrReadOnly]
+    filter_params = {'username': 'username', 'user_type': 'user_type'}
+
+    def get_queryset(self):
+        # Staff see every user, others only themselves
+        queryset = super().get_queryset()
+        return queryset if self.request.user.is_staff else queryset.filter(pk=self.request.user.id)
+
+# Profiles are made along with their user: they can be read and changed, not added or removed
+PROFILE_METHODS = ['get', 'put', 'patch', 'head', 'options']
 
 class AgentProfileViewSet(viewsets.ModelViewSet):
     queryset = AgentProfile.objects.all()
     serializer_class = AgentProfileSerializer
+    http_method_names = PROFILE_METHODS
+    select_related = {'username': 'user'}
 
     def get_queryset(self):
         user = self.request.user
+        queryset = super().get_queryset()
+        if user.is_staff:
+            return queryset
         if user.user_type == 'agent':
-            return AgentProfile.objects.filter(user=user)
-        return AgentProfile.objects.none()
+            return queryset.filter(user=user)
+        return queryset.none()
 
 class ConsumerProfileViewSet(viewsets.ModelViewSet):
     queryset = ConsumerProfile.objects.all()
     serializer_class = ConsumerProfileSerializer
+    http_method_names = PROFILE_METHODS
+    prefetch_related = {'username': 'user'}
 
     def get_queryset(self):
         user = self.request.user
+        queryset = super().get_queryset()
         if user.user_type == 'consumer':
-            return ConsumerProfile.objects.filter(user=user)
+            return queryset.for_user(user.id)
         elif user.user_type == 'agent':
             username = self.request.query_params.get('username')
             if username:
-                return ConsumerProfile.objects.filter(user__username=username)
-        return ConsumerProfile.objects.none()
+                try:
+                    return queryset.for_user(resolve_consumer(username).id)
+                except User.DoesNotExist:
+                    pass
+        return queryset.none()
 
 class MerchantProfileViewSet(viewsets.ModelViewSet):
     queryset = MerchantProfile.objects.all()
     serializer_class = MerchantProfileSerializer
+    http_method_names = PROFILE_METHODS
+    select_related = {'username': 'user'}
 
     def get_queryset(self):
         user = self.request.user
+        queryset = super().get_queryset()
+        if user.is_staff:
+            return queryset
         if user.user_type == 'merchant':
-            return MerchantProfile.objects.filter(user=user)
-        return MerchantProfile.objects.none()
+            return queryset.filter(user=user)
+        return queryset.none()
+
+class UserRowsMixin:
+    # Rows of a sharded model: the user's own, from their shard; staff may pass ?user=<id> to see another user's
+    def get_queryset(self):
+        user = self.request.user
+        if not user.is_authenticated:
+            return super().get_queryset().none()
+        user_id = self.request.query_params.get('user', '')
+        return super().get_queryset().for_user(int(user_id) if user.is_staff and user_id.isdigit() else user.id)
+
+class MerchantRowsMixin:
+    # Catalog rows: every user may read them, only their merchant add, change or remove them
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method in permissions.SAFE_METHODS:
+            return queryset
+        return queryset.filter(merchant_id=self.request.user.id)
+
+    def perform_create(self, serializer):
+        if self.request.user.user_type != 'merchant':
+            raise PermissionDenied('Only merchants can add to the catalog.')
+        serializer.save(merchant=self.request.user)
 
-class TransactionViewSet(viewsets.ModelViewSet):
+class TransactionViewSet(IdempotentCreateMixin, viewsets.ModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    pagination_class = TransactionCursorPagination
+    permission_classes = [IsStaffOrReadOnly]
+
+    def get_queryset(self):
+        # Staff see every shard's transactions, merged into one listing by the pagination; others their own
+        user = self.request.user
+        queryset = super().get_queryset()
+        if not user.is_staff:
+            queryset = queryset.for_user(user.id) if user.is_authenticated else queryset.none()
+        queryset, _ = filter_transactions(queryset, self.request.query_params)
+        return queryset
+
+    def get_object(self):
+        # Transaction ids are unique across shards, so a lookup tries each shard in turn
+        lookup = {self.lookup_field: self.kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        for queryset in self.filter_queryset(self.get_queryset()).per_shard():
+            obj = queryset.filter(**lookup).first()
+            if obj is not None:
+                self.check_object_permissions(self.request, obj)
+                return obj
+        raise Http404
 
 class BillViewSet(viewsets.ModelViewSet):
     queryset = Bill.objects.all()
     serializer_class = BillSerializer
+    permission_classes = [IsStaffOrReadOnly]
+    filter_params = {'bill_type': 'bill_type', 'account_number': 'account_number'}
 
-class BillPaymentViewSet(viewsets.ModelViewSet):
+class BillPaymentViewSet(UserRowsMixin, viewsets.ModelViewSet):
     queryset = BillPayment.objects.all()
     serializer_class = BillPaymentSerializer
+    permission_classes = [IsStaffOrReadOnly]
+    filter_params = {'bill': 'bill_id'}
+    prefetch_related = {'bill_type': 'bill'}
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(MerchantRowsMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    filter_params = {'merchant': 'merchant_id', 'name': 'name__icontains', 'min_price': 'price__gte', 'max_price': 'price__lte'}
+    select_related = {'store_name': 'merchant__merchant_profile'}
 
-class ServiceViewSet(viewsets.ModelViewSet):
+class ServiceViewSet(MerchantRowsMixin, viewsets.ModelViewSet):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
+    filter_params = {
+        'merchant': 'merchant_id', 'name': 'name__icontains',
+        'min_fee': 'subscription_fee__gte', 'max_fee': 'subscription_fee__lte',
+    }
+    select_related = {'store_name': 'merchant__merchant_profile'}
 
-class SubscriptionViewSet(viewsets.ModelViewSet):
+class SubscriptionViewSet(UserRowsMixin, viewsets.ModelViewSet):
     queryset = Subscription.objects.all()
     serializer_class = SubscriptionSerializer
+    filter_params = {'service': 'service_id', 'is_active': 'is_active'}
+    prefetch_related = {'service_name': 'service'}
+
+    def perform_create(self, serializer):
+        if self.request.user.user_type != 'consumer':
+            raise PermissionDenied('Only consumers can subscribe to a service.')
+        serializer.save(consumer=self.request.user)
@@ -1,5 +1,5 @@
 """
-ASGI config for kft_agent_networkk project.
+ASGI config for kft_agent_network project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
@@ -11,6 +11,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kft_agent_networkk.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kft_agent_network.settings')
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+from datetime import timedelta
 from pathlib import Path
 import os
 
@@ -38,6 +39,8 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    # runserver leaves static files to WhiteNoise too, so development serves them as the ASGI server does
+    'whitenoise.runserver_nostatic',
     'django.contrib.staticfiles',
 ]
 
@@ -50,11 +53,15 @@ INSTALLED_APPS += [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
+    'core.static.static_files_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.profiling.profiling_middleware',
+    'core.routers.routing_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -63,7 +70,7 @@ ROOT_URLCONF = 'kft_agent_network.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -71,45 +78,108 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.idempotency_key',
             ],
         },
     },
 ]
 
 WSGI_APPLICATION = 'kft_agent_network.wsgi.application'
+ASGI_APPLICATION = 'kft_agent_network.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-# if os.getenv('DJANGO_ENV') == 'production':
-#     DATABASES = {
-#         'default': {
-#             'ENGINE': 'django.db.backends.postgresql',
-#             'NAME': os.getenv('POSTGRES_DB', 'kft_agent_network'),
-#             'USER': os.getenv('POSTGRES_USER', 'postgres'),
-#             'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'password'),
-#             'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
-#             'PORT': os.getenv('POSTGRES_PORT', '5432'),
-#         }
-#     }
-# else:
-#     DATABASES = {
-#         'default': {
-#             'ENGINE': 'django.db.backends.sqlite3',
-#             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-#         }
-#     }
-
+# SQLite by default, or DB_ENGINE=postgresql. DB_REPLICAS and DB_SHARDS are comma-separated hosts (PostgreSQL)
+# or file paths (SQLite); shards are only ever appended to (see core.sharding and rebalance_shards).
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite3')
+DB_REPLICAS = [location.strip() for location in os.getenv('DB_REPLICAS', '').split(',') if location.strip()]
+DB_SHARDS = [location.strip() for location in os.getenv('DB_SHARDS', '').split(',') if location.strip()]
+
+
+def _database(location):
+    if DB_ENGINE == 'postgresql':
+        return {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'kft_agent_network'),
+            'USER': os.getenv('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'password'),
+            'HOST': location,
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+        }
+    name = BASE_DIR / location
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        # Take the write lock up front, or a read-then-write transaction fails at once with "database is locked"
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+        # File-backed test databases, so the stress tests' threads and processes share them
+        'TEST': {'NAME': name.with_name(f'test_{name.name}')},
+    }
 
 
 DATABASES = {
+    'default': _database(
+        os.getenv('POSTGRES_HOST', 'localhost') if DB_ENGINE == 'postgresql' else os.getenv('SQLITE_PATH', 'db.sqlite3')
+    ),
+}
+for number, location in enumerate(DB_REPLICAS, 1):
+    replica = _database(location)
+    if DB_ENGINE != 'postgresql':
+        # Replicas are only read; under test, where they are the primary's file, IMMEDIATE would block
+        replica['OPTIONS'] = {**replica['OPTIONS'], 'transaction_mode': 'DEFERRED'}
+    # Tests read the primary through the replica aliases rather than creating test replicas (core.routers)
+    DATABASES[f'replica_{number}'] = {**replica, 'TEST': {'MIRROR': 'default'}}
+for number, location in enumerate(DB_SHARDS, 1):
+    DATABASES[f'shard_{number}'] = _database(location)
+
+DATABASE_REPLICAS = [f'replica_{number}' for number in range(1, len(DB_REPLICAS) + 1)]
+DATABASE_SHARDS = ['default'] + [f'shard_{number}' for number in range(1, len(DB_SHARDS) + 1)]
+DATABASE_ROUTERS = ['core.sharding.ShardRouter', 'core.routers.PrimaryReplicaRouter']
+
+# A client's reads stay on the primary this many seconds after it writes
+READ_YOUR_WRITES_SECONDS = int(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+
+# Completed transactions older than this many days are moved out by archive_transactions
+TRANSACTION_ARCHIVE_AFTER_DAYS = int(os.getenv('TRANSACTION_ARCHIVE_AFTER_DAYS', 365))
+
+# Idempotent responses are replayed from memory (size, TTL) and kept in the database for the retention days
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_CACHE_TTL = int(os.getenv('IDEMPOTENCY_CACHE_TTL', 600))
+IDEMPOTENCY_KEY_RETENTION_DAYS = int(os.getenv('IDEMPOTENCY_KEY_RETENTION_DAYS', 7))
+
+# Agent views' consumer lookups are cached this long; saves and deletes drop them at once
+CONSUMER_CACHE_TTL = int(os.getenv('CONSUMER_CACHE_TTL', 300))
+
+# Per process by default; with several workers, point CACHE_BACKEND and CACHE_LOCATION at e.g. Redis
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'kft-agent-network'),
     }
 }
 
+# Catalog fragment lifetime, and how long a request waits for another one rebuilding a fragment
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 3600))
+CATALOG_RECOMPUTE_TIMEOUT = int(os.getenv('CATALOG_RECOMPUTE_TIMEOUT', 10))
+
+# Requests over QUERY_BUDGET queries are logged. Workers share metrics through METRICS_DIR (core.metrics);
+# Prometheus scrapes /metrics with METRICS_TOKEN as its bearer token.
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', 30))
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Staff can profile a request with ?_profile=sample|cprofile (core.profiling); the newest
+# PROFILE_RETENTION profiles are kept in PROFILE_DIR
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_RETENTION = int(os.getenv('PROFILE_RETENTION', 100))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.001))
+
+# Statements taking SLOW_QUERY_MS or more are logged per shape to SlowQuery (core.slow_queries); 0 turns it off
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100)) or None
+SLOW_QUERY_SAMPLES = int(os.getenv('SLOW_QUERY_SAMPLES', 500))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -152,6 +222,12 @@ STATICFILES_DIRS = [
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# uvicorn serves no static files; core.static serves STATIC_ROOT through WhiteNoise, compressed copies included
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedStaticFilesStorage'},
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -161,6 +237,16 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'core.User'
 
 # Authentication settings
+# Sessions load the user together with its role's profile in one query (see core.auth)
+AUTHENTICATION_BACKENDS = ['core.auth.ProfileBackend']
+
+# The session's user is cached this many seconds (0 turns it off); other processes may serve a stale copy
+# for up to the TTL unless the cache is shared
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', 10))
+
+# Signed-cookie sessions spare a query per request; only a password change revokes a copied cookie
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.signed_cookies')
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = '/'  # Redirect to home after login
 LOGOUT_REDIRECT_URL = 'login'  # Redirect to login after logout
@@ -171,4 +257,26 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
+    # Bearer JWTs for API clients, sessions for the browsable API; the user comes from the user cache either way
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'core.auth.ProfileJWTAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+    ],
+    # The viewsets scope their rows to the requesting user (core.views), so every endpoint needs one
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
+    # Listings come in pages of 50 (?page_size= up to 200); ?fields=a,b trims each result to those fields
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.ApiCursorPagination',
+    'DEFAULT_FILTER_BACKENDS': ['core.filters.ParamsFilter', 'core.filters.SparseFieldsetFilter'],
+}
+
+# The API documentation authenticates its requests with a bearer token, as API clients do
+SWAGGER_SETTINGS = {
+    'SECURITY_DEFINITIONS': {'Bearer': {'type': 'apiKey', 'name': 'Authorization', 'in': 'header'}},
+}
+
+# Tokens from /api/login/ carry a hash of the password, so a password change revokes them
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=int(os.getenv('JWT_ACCESS_MINUTES', 5))),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=int(os.getenv('JWT_REFRESH_DAYS', 1))),
+    'CHECK_REVOKE_TOKEN': True,
 }
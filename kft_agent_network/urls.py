@@ -1,5 +1,5 @@
 """
-URL configuration for kft_agent_networkk project.
+URL configuration for kft_agent_network project.
 
 The `urlpatterns` list routes URLs to views. For more information please see:
     https://docs.djangoproject.com/en/5.2/topics/http/urls/
@@ -18,7 +18,7 @@ from django.contrib import admin
 from django.urls import path
 from django.contrib.auth import views as auth_views
 from rest_framework.routers import DefaultRouter
-from core.views import signup, splash_page, product_list, manage_products, delete_product, update_product, transaction_history, balance_view, browse_products, purchase_product, browse_services, subscribe_service, consumer_transaction_history, consumer_balance_view, recharge_balance, accept_cash_payment, cash_out_consumer, agent_dashboard, pay_bill_on_behalf, agent_transaction_history, agent_consumer_balance_view, UserViewSet, AgentProfileViewSet, ConsumerProfileViewSet, MerchantProfileViewSet, TransactionViewSet, BillViewSet, BillPaymentViewSet, ProductViewSet, ServiceViewSet, SubscriptionViewSet
+from core.views import signup, splash_page, product_list, manage_products, delete_product, update_product, transaction_history, export_merchant_transactions, balance_view, browse_products, purchase_product, browse_services, catalog_search, api_catalog_search, api_login, api_token_refresh, subscribe_service, consumer_transaction_history, export_consumer_transactions, consumer_balance_view, recharge_balance, accept_cash_payment, cash_out_consumer, agent_batch_cash, agent_dashboard, pay_bill_on_behalf, agent_transaction_history, agent_export_consumer_transactions, agent_consumer_balance_view, get_profile, prometheus_metrics, UserViewSet, AgentProfileViewSet, ConsumerProfileViewSet, MerchantProfileViewSet, TransactionViewSet, BillViewSet, BillPaymentViewSet, ProductViewSet, ServiceViewSet, SubscriptionViewSet
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework.permissions import AllowAny
@@ -31,15 +31,15 @@ class CustomLogoutView(LogoutView):
 
 router = DefaultRouter()
 router.register(r'users', UserViewSet)
-# router.register(r'agent-profiles', AgentProfileViewSet)
-# router.register(r'consumer-profiles', ConsumerProfileViewSet)
-# router.register(r'merchant-profiles', MerchantProfileViewSet)
-# router.register(r'transactions', TransactionViewSet)
-# router.register(r'bills', BillViewSet)
-# router.register(r'bill-payments', BillPaymentViewSet)
-# router.register(r'products', ProductViewSet)
-# router.register(r'services', ServiceViewSet)
-# router.register(r'subscriptions', SubscriptionViewSet)
+router.register(r'agent-profiles', AgentProfileViewSet)
+router.register(r'consumer-profiles', ConsumerProfileViewSet)
+router.register(r'merchant-profiles', MerchantProfileViewSet)
+router.register(r'transactions', TransactionViewSet)
+router.register(r'bills', BillViewSet)
+router.register(r'bill-payments', BillPaymentViewSet)
+router.register(r'products', ProductViewSet)
+router.register(r'services', ServiceViewSet)
+router.register(r'subscriptions', SubscriptionViewSet)
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -68,6 +68,7 @@ urlpatterns += [
     path('merchant/product-list/', product_list, name='product_list'),
     path('merchant/manage-products/', manage_products, name='manage_products'),
     path('merchant/transaction-history/', transaction_history, name='transaction_history'),
+    path('merchant/export-transactions/', export_merchant_transactions, name='export_merchant_transactions'),
     path('merchant/balance-view/', balance_view, name='balance_view'),
     
     path('delete-product/<int:product_id>/', delete_product, name='delete_product'),
@@ -75,16 +76,27 @@ urlpatterns += [
     
     path('browse-products/', browse_products, name='browse_products'),
     path('purchase-product/<int:product_id>/', purchase_product, name='purchase_product'),
+    path('browse-services/', browse_services, name='browse_services'),
+    path('subscribe-service/<int:service_id>/', subscribe_service, name='subscribe_service'),
+    path('search/', catalog_search, name='catalog_search'),
+    path('api/search/', api_catalog_search, name='api_catalog_search'),
+    path('api/profile/', get_profile, name='get_profile'),
+    path('api/login/', api_login, name='api_login'),
+    path('api/token/refresh/', api_token_refresh, name='api_token_refresh'),
+    path('metrics', prometheus_metrics, name='metrics'),
     
     path('consumer/transaction-history/', consumer_transaction_history, name='consumer_transaction_history'),
+    path('consumer/export-transactions/', export_consumer_transactions, name='export_consumer_transactions'),
     path('consumer/balance-view/', consumer_balance_view, name='consumer_balance_view'),
     path('consumer/recharge-balance/', recharge_balance, name='recharge_balance'),
     
     path('agent/accept-cash-payment/', accept_cash_payment, name='accept_cash_payment'),
     path('agent/cash-out-consumer/', cash_out_consumer, name='cash_out_consumer'),
+    path('agent/batch-cash/', agent_batch_cash, name='agent_batch_cash'),
     path('agent/dashboard/', agent_dashboard, name='agent_dashboard'),
     path('agent/pay-bill-on-behalf/', pay_bill_on_behalf, name='pay_bill_on_behalf'),
     path('agent/transaction-history/', agent_transaction_history, name='agent_transaction_history'),
+    path('agent/export-consumer-transactions/', agent_export_consumer_transactions, name='agent_export_consumer_transactions'),
     path('agent/consumer-balance-view/', agent_consumer_balance_view, name='agent_consumer_balance_view'),
     path('accounts/logout/', RedirectView.as_view(url='/logout/')),
 ]
@@ -1,5 +1,5 @@
 """
-WSGI config for kft_agent_networkk project.
+WSGI config for kft_agent_network project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
@@ -11,6 +11,6 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kft_agent_networkk.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kft_agent_network.settings')
 
 application = get_wsgi_application()